@@ -0,0 +1,40 @@
+#!/usr/bin/python
+"""Measures how many code requirements per second code_requirement.py parses into their canonical form and compiles
+to requirement blobs, for requirements it has not seen before and (for the canonical form) ones it has."""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import code_requirement  # NOQA
+
+REQUIREMENT = ('identifier "com.example.app{0}" and anchor apple generic and '
+               'certificate 1[field.1.2.840.113635.100.6.2.6] /* exists */ and '
+               'certificate leaf[field.1.2.840.113635.100.6.1.13] /* exists */ and '
+               'certificate leaf[subject.OU] = "ABCDE{0:05d}"')
+
+
+def rate(func, requirements):
+    start = time.time()
+    for requirement in requirements:
+        func(requirement)
+    return len(requirements) / (time.time() - start)
+
+
+def main():
+    requirements = [REQUIREMENT.format(number) for number in range(20000)]
+
+    print('{:<24} {:>12}'.format('', 'Per second'))
+    print('{:<24} {:>12,.0f}'.format('Canonical form', rate(code_requirement.canonical_requirement, requirements)))
+    print('{:<24} {:>12,.0f}'.format('Canonical form, cached', rate(code_requirement.canonical_requirement, requirements)))
+    print('{:<24} {:>12,.0f}'.format('Compile', rate(code_requirement.compile_requirement, requirements)))
+    blobs = [code_requirement.compile_requirement(requirement) for requirement in requirements]
+    print('{:<24} {:>12,.0f}'.format('Decompile', rate(code_requirement.decompile_requirement, blobs)))
+
+
+if __name__ == '__main__':
+    main()
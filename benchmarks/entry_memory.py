@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""Compares the memory used by the 'Services' entries of a built AppleEvents matrix profile, held as slotted
+ServiceEntry objects versus the plist dicts they are written out as. Needs Python 3 for tracemalloc."""
+
+from __future__ import absolute_import, print_function
+
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tccprofile import PrivacyProfiles, Prober, _entry_dict  # NOQA
+
+
+class MatrixProber(Prober):
+    """Answers probes from the app path, so the benchmark measures the entries rather than codesign."""
+    def _code_sign_requirement(self, path):
+        return 'identifier "com.example.{0}" and anchor apple generic and certificate leaf[subject.OU] = "ABCDE12345"'.format(self._app_name(path))
+
+    def _identifier_and_type(self, app_path, override_path=False):
+        return {'identifier': 'com.example.{}'.format(self._app_name(app_path)), 'identifier_type': 'bundleID'}
+
+    @staticmethod
+    def _app_name(path):
+        return os.path.basename(os.path.splitext(path)[0])
+
+
+def measure(func):
+    """Returns what func returns and the memory it allocated that is still held."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>10}'.format('Entries', 'Dicts', 'ServiceEntry', 'Saving'))
+    for senders, receivers in [(100, 100), (400, 250)]:
+        tcc_profile = PrivacyProfiles('Benchmark', 'Benchmark', 'com.example.benchmark', 'Example', None, None, None, None, None, prober=MatrixProber())
+        tcc_profile.set_services_dict({'AppleEvents': {'_apps': [
+            '/Applications/Sender{}.app,/Applications/Receiver{}.app'.format(sender, receiver)
+            for sender in range(senders) for receiver in range(receivers)
+        ], 'apps': list()}})
+
+        # Probe everything up front, so only the entries are measured.
+        for app in tcc_profile._app_lists['AppleEvents']:
+            for path in (app.path, app.receiver_path):
+                tcc_profile._get_code_sign_requirements(path)
+                tcc_profile._get_identifier_and_type(path)
+
+        _, entry_bytes = measure(lambda: tcc_profile.build_profile(allow=True))
+        entries = tcc_profile.template['PayloadContent'][0]['Services']['AppleEvents']
+        dicts, dict_bytes = measure(lambda: [_entry_dict(entry) for entry in entries])
+
+        print('{:>8} {:>12.1f}MB {:>12.1f}MB {:>9.0%}'.format(
+            len(entries),
+            dict_bytes / 1048576.0,
+            entry_bytes / 1048576.0,
+            1 - float(entry_bytes) / dict_bytes,
+        ))
+
+
+if __name__ == '__main__':
+    main()
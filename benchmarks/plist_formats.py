@@ -0,0 +1,40 @@
+#!/usr/bin/python
+"""Compares the size and parse time of XML and binary plists for the profiles in generated_profiles/."""
+
+from __future__ import absolute_import, print_function
+
+import glob
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tccprofile import _plist_dumps, _plist_loads, read_profile  # NOQA
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    profiles_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'generated_profiles', '*.mobileconfig')
+
+    print('{:<66} {:>9} {:>9} {:>7} {:>11} {:>11}'.format('Profile', 'XML', 'Binary', 'Ratio', 'XML parse', 'Bin parse'))
+    for path in sorted(glob.glob(profiles_path)):
+        profile = read_profile(path)
+        xml_data = _plist_dumps(profile, plist_format='xml')
+        binary_data = _plist_dumps(profile, plist_format='binary')
+
+        xml_time = timeit.timeit(lambda: _plist_loads(xml_data), number=repeat) / repeat
+        binary_time = timeit.timeit(lambda: _plist_loads(binary_data), number=repeat) / repeat
+
+        print('{:<66} {:>9} {:>9} {:>6.0%} {:>9.1f}us {:>9.1f}us'.format(
+            os.path.basename(path),
+            len(xml_data),
+            len(binary_data),
+            float(len(binary_data)) / len(xml_data),
+            xml_time * 1000000,
+            binary_time * 1000000,
+        ))
+
+
+if __name__ == '__main__':
+    main()
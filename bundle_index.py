@@ -0,0 +1,284 @@
+#!/usr/bin/python
+"""Keeps an index of the app bundles on a Mac by CFBundleIdentifier, so app lists can name apps as
+'bundle:com.apple.Terminal' rather than by a path that breaks when the app moves.
+
+The index is a JSON file. Refreshing it only lists the directories whose modification time has changed and only reads
+the Info.plist of bundles whose Info.plist has changed, so keeping it up to date costs a stat per directory."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from tccprofile import ProfileBuildError, SaneUsageFormat, read_plist
+
+INDEX_VERSION = 1
+
+DEFAULT_INDEX = os.path.expanduser('~/Library/Caches/tccprofile/bundles.json')
+
+DEFAULT_ROOTS = [
+    '/Applications',
+    '/System/Applications',
+    '/System/Library/CoreServices',
+    '/Library/Application Support',
+    os.path.expanduser('~/Applications'),
+]
+
+BUNDLE_EXTENSIONS = ('.app', '.bundle', '.xpc', '.appex', '.prefPane', '.plugin')
+
+# How many directories deep below a root to look for bundles, so roots like /Library/Application Support are not
+# crawled in full. Bundles are not looked inside.
+MAX_DEPTH = 4
+
+# Listing directories and reading plists mostly waits on the disk, so run a few more than there are CPUs.
+WORKERS = multiprocessing.cpu_count() * 2
+
+BUNDLE_REFERENCE = re.compile(r'bundle:([^,:]+)')
+
+
+def _version_key(version):
+    """Sorts versions like '10.2.1' by their numbers."""
+    return [int(part) for part in re.findall(r'\d+', version or '')]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class BundleIndex(object):
+    """The bundles found under a set of roots: {path: {identifier, version, mtime}}, with the directories they were
+    found in and their modification times, and a dict from identifier to paths for lookups."""
+    def __init__(self, filename=None, roots=None):
+        self.filename = filename
+        self.roots = list(roots or DEFAULT_ROOTS)
+        self.directories = dict()
+        self.bundles = dict()
+        self._by_identifier = None
+        self._refreshed = False
+
+    @classmethod
+    def load(cls, filename=None):
+        """Reads the index in filename (DEFAULT_INDEX by default). Returns an empty index if there is none yet."""
+        filename = filename or DEFAULT_INDEX
+        index = cls(filename)
+        if os.path.exists(filename):
+            with open(filename, 'r') as index_file:
+                data = json.load(index_file)
+
+            if data.get('version') == INDEX_VERSION:
+                index.roots = data['roots']
+                index.directories = data['directories']
+                index.bundles = data['bundles']
+
+        return index
+
+    def save(self):
+        """Writes the index to its file, replacing the previous one in one go."""
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        temporary = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(temporary, 'w') as index_file:
+            json.dump({
+                'version': INDEX_VERSION,
+                'roots': self.roots,
+                'directories': self.directories,
+                'bundles': self.bundles,
+            }, index_file, indent=1, sort_keys=True)
+        os.rename(temporary, self.filename)
+
+    def _scan_directory(self, path):
+        """Returns the record of a directory: its mtime, and the bundles and subdirectories in it. Reuses the record in
+        the index if the directory hasn't changed."""
+        mtime = _mtime(path)
+        previous = self.directories.get(path)
+        if mtime is None or (previous and previous['mtime'] == mtime):
+            return path, previous if mtime is not None else None
+
+        bundles = []
+        subdirectories = []
+        try:
+            names = sorted(os.listdir(path))
+        except OSError:
+            names = []
+
+        for name in names:
+            child = os.path.join(path, name)
+            if name.endswith(BUNDLE_EXTENSIONS) and os.path.isdir(child):
+                bundles.append(child)
+            elif not name.startswith('.') and os.path.isdir(child) and not os.path.islink(child):
+                subdirectories.append(child)
+
+        return path, {'mtime': mtime, 'bundles': bundles, 'subdirectories': subdirectories}
+
+    def _scan_bundle(self, path):
+        """Returns the record of a bundle: its identifier and version, and the mtime of its Info.plist. Reuses the record
+        in the index if the Info.plist hasn't changed."""
+        info_plist = os.path.join(path, 'Contents/Info.plist')
+        if not os.path.exists(info_plist):
+            info_plist = os.path.join(path, 'Info.plist')  # Shallow bundles, such as iOS style apps and some plugins.
+
+        mtime = _mtime(info_plist)
+        previous = self.bundles.get(path)
+        if mtime is None or (previous and previous['mtime'] == mtime):
+            return path, previous if mtime is not None else None
+
+        try:
+            info = read_plist(info_plist)
+        except Exception:
+            return path, None
+
+        identifier = info.get('CFBundleIdentifier')
+        if not identifier:
+            return path, None
+
+        return path, {
+            'identifier': identifier,
+            'version': info.get('CFBundleShortVersionString') or info.get('CFBundleVersion'),
+            'mtime': mtime,
+        }
+
+    def refresh(self, workers=WORKERS):
+        """Brings the index up to date with the roots, one directory level at a time with every directory of a level
+        scanned in parallel. Returns how many bundles were found, added and removed."""
+        directories = dict()
+        bundle_paths = []
+        pool = ThreadPool(workers)
+        try:
+            level = [root for root in self.roots if os.path.isdir(root)]
+            for depth in range(MAX_DEPTH + 1):
+                next_level = []
+                for path, record in pool.imap(self._scan_directory, level):
+                    if record is None:
+                        continue
+                    directories[path] = record
+                    bundle_paths.extend(record['bundles'])
+                    if depth < MAX_DEPTH:
+                        next_level.extend(record['subdirectories'])
+                level = next_level
+
+            bundles = dict((path, record) for path, record in pool.imap(self._scan_bundle, bundle_paths) if record)
+        finally:
+            pool.close()
+            pool.join()
+
+        counts = {
+            'found': len(bundles),
+            'added': sum(1 for path, record in bundles.items() if self.bundles.get(path) != record),
+            'removed': sum(1 for path in self.bundles if path not in bundles),
+        }
+        self.directories = directories
+        self.bundles = bundles
+        self._by_identifier = None
+        self._refreshed = True
+        return counts
+
+    def paths(self, identifier):
+        """Returns the [(path, version)] of the bundles with identifier, newest version first."""
+        if self._by_identifier is None:
+            self._by_identifier = dict()
+            for path, record in self.bundles.items():
+                self._by_identifier.setdefault(record['identifier'], []).append((path, record['version']))
+            for paths in self._by_identifier.values():
+                paths.sort(key=lambda item: (_version_key(item[1]), -len(item[0])), reverse=True)
+
+        return self._by_identifier.get(identifier, [])
+
+    def resolve(self, identifier):
+        """Returns the path of the bundle with identifier (the newest version if there are several). If the index doesn't
+        know the identifier or the bundle is gone, the index is refreshed (once) and saved."""
+        for attempt in range(2):
+            for path, version in self.paths(identifier):
+                if os.path.isdir(path):
+                    return path
+
+            if self._refreshed:
+                break
+
+            self.refresh()
+            if self.filename:
+                self.save()
+
+        raise ProfileBuildError('not_found', 'No bundle with the identifier {} under {}'.format(identifier, ', '.join(self.roots)), path='bundle:' + identifier)
+
+    def resolve_references(self, app):
+        """Returns an app string with every 'bundle:<identifier>' in it replaced by the path of the bundle."""
+        return BUNDLE_REFERENCE.sub(lambda match: self.resolve(match.group(1)), app)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py bundle-index',
+        description='Build or refresh the index of app bundles that "bundle:<identifier>" app references are resolved with.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'roots',
+        type=str,
+        nargs='*',
+        metavar='<directories>',
+        help='The directories to look for bundles in. Default: the directories the index was built from, or {}'.format(
+            ', '.join(DEFAULT_ROOTS)),
+    )
+
+    parser.add_argument(
+        '--index',
+        type=str,
+        dest='index',
+        metavar='<index.json>',
+        help='The index file. Default: {}'.format(DEFAULT_INDEX),
+        required=False,
+    )
+
+    parser.add_argument(
+        '--lookup',
+        type=str,
+        nargs='+',
+        dest='lookup',
+        metavar='<identifier>',
+        help='Print the paths and versions of the bundles with these identifiers, after refreshing the index.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    index = BundleIndex.load(args.index)
+    if args.roots:
+        index.roots = [os.path.abspath(root) for root in args.roots]
+
+    start = time.time()
+    counts = index.refresh()
+    index.save()
+    print('Indexed {found} bundles in {elapsed:.1f}s: {added} new or changed, {removed} removed.'.format(
+        elapsed=time.time() - start, **counts), file=sys.stderr)
+
+    status = 0
+    for identifier in args.lookup or []:
+        paths = index.paths(identifier)
+        if not paths:
+            print('{}: not found'.format(identifier))
+            status = 1
+        for path, version in paths:
+            print('{}: {} ({})'.format(identifier, path, version or 'no version'))
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
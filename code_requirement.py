@@ -0,0 +1,637 @@
+#!/usr/bin/python
+"""Parses code signing requirements (the language 'codesign -d -r-' prints them in) into a tree, formats them in a
+canonical form, and compiles them to the binary requirement blob that TCC.db keeps in its csreq column.
+
+Requirements that only differ in whitespace, quoting or the order of and/or clauses have the same canonical form, so
+they can be matched on it (or on requirement_hash()) when deduplicating or comparing entries.
+
+The tree is made of tuples, the first item naming the node:
+    ('true',) ('false',) ('identifier', str) ('anchor_apple',) ('anchor_apple_generic',) ('anchor_trusted',)
+    ('named_anchor', str) ('anchor_hash', slot, bytes) ('trusted_cert', slot) ('cert_field', slot, key, match)
+    ('cert_generic', slot, oid, match) ('cert_policy', slot, oid, match) ('info', key, match) ('entitlement', key, match)
+    ('cdhash', bytes) ('platform', int) ('notarized',) ('legacy',) ('not', node) ('and', node, node, ...)
+    ('or', node, node, ...)
+Certificate slots are 0 for the leaf, -1 for the root (anchor), and the position in the chain otherwise. A match is an
+(operator, value) tuple, with operator one of =, <, >, <=, >=, exists or absent, and value None for exists and absent.
+Values matched with = keep their * wildcards, the same as they are written."""
+
+from __future__ import absolute_import, print_function
+
+import binascii
+import hashlib
+import re
+import struct
+import threading
+
+REQUIREMENT_MAGIC = 0xfade0c00
+EXPR_FORM = 1
+
+# Expression opcodes of the requirement blob format
+OP_FALSE = 0
+OP_TRUE = 1
+OP_IDENT = 2
+OP_APPLE_ANCHOR = 3
+OP_ANCHOR_HASH = 4
+OP_AND = 6
+OP_OR = 7
+OP_CD_HASH = 8
+OP_NOT = 9
+OP_INFO_KEY_FIELD = 10
+OP_CERT_FIELD = 11
+OP_TRUSTED_CERT = 12
+OP_TRUSTED_CERTS = 13
+OP_CERT_GENERIC = 14
+OP_APPLE_GENERIC_ANCHOR = 15
+OP_ENTITLEMENT_FIELD = 16
+OP_CERT_POLICY = 17
+OP_NAMED_ANCHOR = 18
+OP_PLATFORM = 20
+OP_NOTARIZED = 21
+OP_CERT_FIELD_DATE = 22
+OP_LEGACY_DEV_ID = 23
+
+# Match operations, the wildcard forms of = get their own
+MATCH_EXISTS = 0
+MATCH_EQUAL = 1
+MATCH_CONTAINS = 2
+MATCH_BEGINS_WITH = 3
+MATCH_ENDS_WITH = 4
+MATCH_ABSENT = 14
+MATCH_OPS = {'exists': MATCH_EXISTS, '=': MATCH_EQUAL, '<': 5, '>': 6, '<=': 7, '>=': 8, 'absent': MATCH_ABSENT}
+MATCH_NAMES = dict((code, name) for name, code in MATCH_OPS.items())
+
+# Nodes without arguments, and their opcodes
+SIMPLE_OPS = {
+    'false': OP_FALSE,
+    'true': OP_TRUE,
+    'anchor_apple': OP_APPLE_ANCHOR,
+    'anchor_apple_generic': OP_APPLE_GENERIC_ANCHOR,
+    'anchor_trusted': OP_TRUSTED_CERTS,
+    'notarized': OP_NOTARIZED,
+    'legacy': OP_LEGACY_DEV_ID,
+}
+SIMPLE_NAMES = dict((code, name) for name, code in SIMPLE_OPS.items())
+SIMPLE_TEXT = {
+    'false': 'never',
+    'true': 'always',
+    'anchor_apple': 'anchor apple',
+    'anchor_apple_generic': 'anchor apple generic',
+    'anchor_trusted': 'anchor trusted',
+    'notarized': 'notarized',
+    'legacy': 'legacy',
+}
+
+# Comments and whitespace are skipped. H"..." hashes, "..." strings, operators and bare words are tokens, anything else
+# is an error.
+TOKENS = re.compile(r'\s+|/\*.*?\*/|//[^\n]*|(H"[0-9A-Fa-f]*")|("(?:[^"\\]|\\.)*")|(<=|>=|=>|[=<>!()\[\]])|([^\s"()\[\]=<>!]+)|(.)', re.S)
+ESCAPE = re.compile(r'\\(.)', re.S)
+BARE_WORD = re.compile(r'^[A-Za-z_][\w.\-]*$')
+
+CANONICAL_CACHE_SIZE = 100000
+
+# The certificate extensions Apple marks its code signing certificates with.
+OID_WWDR_CA = '1.2.840.113635.100.6.2.1'                 # Apple Worldwide Developer Relations intermediate
+OID_DEVELOPER_ID_CA = '1.2.840.113635.100.6.2.6'         # Developer ID intermediate
+OID_DEVELOPER_ID_APPLICATION = '1.2.840.113635.100.6.1.13'  # Developer ID Application leaf
+
+# The leaf certificate names (the first 'Authority' codesign -dvv shows) of the signatures generic_requirement() can
+# make a generic requirement for, and the certificate marks that requirement checks for.
+GENERIC_MARKS = [
+    (('Developer ID Application:',), [('cert_generic', 1, OID_DEVELOPER_ID_CA, ('exists', None)),
+                                      ('cert_generic', 0, OID_DEVELOPER_ID_APPLICATION, ('exists', None))]),
+    (('Apple Development:', 'Mac Developer:'), [('cert_generic', 1, OID_WWDR_CA, ('exists', None))]),
+]
+
+
+class RequirementError(ValueError):
+    """A requirement that can't be parsed, compiled or decompiled."""
+    pass
+
+
+def _tokenize(text):
+    """Returns the (kind, value) tokens of a requirement, kind being 'hash', 'string', 'op' or 'word'."""
+    tokens = []
+    for hash_value, string, operator, word, unexpected in TOKENS.findall(text):
+        if word:
+            tokens.append(('word', word))
+        elif operator:
+            tokens.append(('op', operator))
+        elif string:
+            tokens.append(('string', ESCAPE.sub(r'\1', string[1:-1]) if '\\' in string else string[1:-1]))
+        elif hash_value:
+            tokens.append(('hash', hash_value[2:-1]))
+        elif unexpected:
+            raise RequirementError('Unexpected {!r} in requirement: {}'.format(unexpected, text))
+
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser for the requirement language. 'and' binds tighter than 'or', '!' tighter than both."""
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text) + [('end', None)]
+        self.position = 0
+
+        # 'codesign -d -r-' prints 'designated => <requirement>'
+        if self.tokens[:2] == [('word', 'designated'), ('op', '=>')]:
+            self.position = 2
+
+    def parse(self):
+        node = self.expression()
+        if self.tokens[self.position][0] != 'end':
+            self.fail('Unexpected {!r}'.format(self.tokens[self.position][1]))
+        return node
+
+    def fail(self, message):
+        raise RequirementError('{} in requirement: {}'.format(message, self.text))
+
+    def peek(self, kind, value=None):
+        token = self.tokens[self.position]
+        if token[0] == kind and (value is None or token[1] == value):
+            return token
+        return None
+
+    def accept(self, kind, value=None):
+        token = self.tokens[self.position]
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return token
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if not token:
+            self.fail('Expected {} but found {!r}'.format(value or kind, self.tokens[self.position][1] or 'end of requirement'))
+        return token[1]
+
+    def expression(self):
+        # a or b or c is kept as one ('or', a, b, c) node, which compiles the same as or(or(a, b), c)
+        operands = [self.term()]
+        while self.accept('word', 'or'):
+            operands.append(self.term())
+        return ('or',) + tuple(operands) if len(operands) > 1 else operands[0]
+
+    def term(self):
+        operands = [self.primary()]
+        while self.accept('word', 'and'):
+            operands.append(self.primary())
+        return ('and',) + tuple(operands) if len(operands) > 1 else operands[0]
+
+    def value(self):
+        token = self.accept('string') or self.accept('word')
+        if not token:
+            self.fail('Expected a value')
+        return token[1]
+
+    def key(self):
+        self.expect('op', '[')
+        key = self.value()
+        self.expect('op', ']')
+        return key
+
+    def match(self):
+        """Returns the (operator, value) of a match. A field without one is tested for existence."""
+        token = self.peek('op')
+        if token and token[1] in ('=', '<', '>', '<=', '>='):
+            self.position += 1
+            return (token[1], self.value())
+        elif self.accept('word', 'exists'):
+            return ('exists', None)
+        elif self.accept('word', 'absent'):
+            return ('absent', None)
+        return ('exists', None)
+
+    def slot(self):
+        word = self.expect('word')
+        if word == 'leaf':
+            return 0
+        elif word in ('root', 'anchor'):
+            return -1
+        try:
+            return int(word)
+        except ValueError:
+            self.fail('Expected a certificate slot but found {!r}'.format(word))
+
+    def certificate(self, slot):
+        """The rest of a certificate clause, after its slot."""
+        if self.accept('word', 'trusted'):
+            return ('trusted_cert', slot)
+        elif self.accept('op', '='):
+            return ('anchor_hash', slot, binascii.unhexlify(self.expect('hash')))
+
+        key = self.key()
+        if key.startswith('field.'):
+            return ('cert_generic', slot, key[6:], self.match())
+        elif key.startswith('policy.'):
+            return ('cert_policy', slot, key[7:], self.match())
+        elif key.startswith('timestamp.'):
+            return ('cert_date', slot, key[10:], self.match())
+        return ('cert_field', slot, key, self.match())
+
+    def primary(self):
+        if self.accept('op', '('):
+            node = self.expression()
+            self.expect('op', ')')
+            return node
+        elif self.accept('op', '!'):
+            return ('not', self.primary())
+
+        word = self.expect('word')
+        if word in ('always', 'true'):
+            return ('true',)
+        elif word in ('never', 'false'):
+            return ('false',)
+        elif word == 'identifier':
+            self.accept('op', '=')
+            return ('identifier', self.value())
+        elif word == 'anchor':
+            if self.accept('word', 'apple'):
+                if self.accept('word', 'generic'):
+                    return ('anchor_apple_generic',)
+                elif self.peek('string'):
+                    return ('named_anchor', self.value())
+                return ('anchor_apple',)
+            elif self.accept('word', 'trusted'):
+                return ('anchor_trusted',)
+            return self.certificate(-1)
+        elif word in ('certificate', 'cert'):
+            return self.certificate(self.slot())
+        elif word == 'info':
+            return ('info', self.key(), self.match())
+        elif word == 'entitlement':
+            return ('entitlement', self.key(), self.match())
+        elif word == 'cdhash':
+            self.accept('op', '=')
+            return ('cdhash', binascii.unhexlify(self.expect('hash')))
+        elif word == 'platform':
+            self.expect('op', '=')
+            try:
+                return ('platform', int(self.value()))
+            except ValueError:
+                self.fail('Expected a platform number')
+        elif word == 'notarized':
+            return ('notarized',)
+        elif word == 'legacy':
+            return ('legacy',)
+
+        self.fail('Unexpected {!r}'.format(word))
+
+
+def parse_requirement(text):
+    """Returns the tree of a requirement. Raises RequirementError if it isn't one."""
+    return _Parser(text).parse()
+
+
+def _quote(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _key(key):
+    return key if BARE_WORD.match(key) else _quote(key)
+
+
+def _format_match(match):
+    operator, value = match
+    return ' {}'.format(operator) if value is None else ' {} {}'.format(operator, _quote(value))
+
+
+def _format_slot(slot):
+    return {0: 'leaf', -1: 'root'}.get(slot, str(slot))
+
+
+def format_requirement(node):
+    """Returns the text of a requirement tree, in the same form 'codesign -d -r-' prints requirements in."""
+    name = node[0]
+    if name in SIMPLE_TEXT:
+        return SIMPLE_TEXT[name]
+    elif name in ('and', 'or'):
+        operands = []
+        for operand in node[1:]:
+            text = format_requirement(operand)
+            operands.append('({})'.format(text) if name == 'and' and operand[0] == 'or' else text)
+        return ' {} '.format(name).join(operands)
+    elif name == 'not':
+        text = format_requirement(node[1])
+        return '! ({})'.format(text) if node[1][0] in ('and', 'or') else '! {}'.format(text)
+    elif name == 'identifier':
+        return 'identifier {}'.format(_quote(node[1]))
+    elif name == 'named_anchor':
+        return 'anchor apple {}'.format(_quote(node[1]))
+    elif name == 'anchor_hash':
+        return 'certificate {} = H"{}"'.format(_format_slot(node[1]), binascii.hexlify(node[2]).decode('ascii'))
+    elif name == 'trusted_cert':
+        return 'certificate {} trusted'.format(_format_slot(node[1]))
+    elif name == 'cert_field':
+        return 'certificate {}[{}]{}'.format(_format_slot(node[1]), node[2], _format_match(node[3]))
+    elif name == 'cert_generic':
+        return 'certificate {}[field.{}]{}'.format(_format_slot(node[1]), node[2], _format_match(node[3]))
+    elif name == 'cert_policy':
+        return 'certificate {}[policy.{}]{}'.format(_format_slot(node[1]), node[2], _format_match(node[3]))
+    elif name == 'cert_date':
+        return 'certificate {}[timestamp.{}]{}'.format(_format_slot(node[1]), node[2], _format_match(node[3]))
+    elif name == 'info':
+        return 'info [{}]{}'.format(_key(node[1]), _format_match(node[2]))
+    elif name == 'entitlement':
+        return 'entitlement [{}]{}'.format(_key(node[1]), _format_match(node[2]))
+    elif name == 'cdhash':
+        return 'cdhash H"{}"'.format(binascii.hexlify(node[1]).decode('ascii'))
+    elif name == 'platform':
+        return 'platform = {}'.format(node[1])
+
+    raise RequirementError('Unknown requirement node {!r}'.format(name))
+
+
+def _canonicalize(node):
+    """Returns the canonical text and tree of a requirement tree, and for and/or the texts of the operands, so each
+    clause is only formatted once."""
+    name = node[0]
+    if name in ('and', 'or'):
+        operands = dict()
+        for operand in node[1:]:
+            text, operand, operand_texts = _canonicalize(operand)
+            if operand[0] == name:
+                operands.update(zip(operand_texts, operand[1:]))
+            else:
+                operands[text] = operand
+
+        texts = sorted(operands)
+        if len(texts) == 1:
+            return _canonicalize(operands[texts[0]])
+
+        joined = ['({})'.format(text) if name == 'and' and operands[text][0] == 'or' else text for text in texts]
+        return ' {} '.format(name).join(joined), (name,) + tuple(operands[text] for text in texts), texts
+    elif name == 'not':
+        operand = _canonicalize(node[1])[1]
+        return format_requirement(('not', operand)), ('not', operand), None
+    return format_requirement(node), node, None
+
+
+def canonicalize(node):
+    """Returns the canonical tree of a requirement: nested and/or clauses flattened, repeated operands dropped and the
+    operands sorted, so equivalent requirements written differently get the same tree."""
+    return _canonicalize(node)[1]
+
+
+_canonical_cache = dict()
+_canonical_cache_lock = threading.Lock()
+
+
+def canonical_requirement(text):
+    """Returns the canonical text of a requirement. Results are remembered, as the same requirements come up again
+    and again. Raises RequirementError if text isn't a requirement."""
+    try:
+        return _canonical_cache[text]
+    except KeyError:
+        pass
+
+    canonical = _canonicalize(parse_requirement(text))[0]
+    with _canonical_cache_lock:
+        if len(_canonical_cache) >= CANONICAL_CACHE_SIZE:
+            _canonical_cache.clear()
+        _canonical_cache[text] = canonical
+
+    return canonical
+
+
+def requirement_hash(text):
+    """Returns the SHA-1 hex digest of the canonical text of a requirement, to index requirements by."""
+    return hashlib.sha1(canonical_requirement(text).encode('utf-8')).hexdigest()
+
+
+def generic_requirement(text, authorities, team_identifier):
+    """Returns a requirement that stays the same across updates of an app, in place of its designated requirement text:
+    the identifier, signed by the team with a certificate from the same kind of Apple intermediate, for example
+
+        identifier "com.example.app" and anchor apple generic and certificate 1[field.1.2.840.113635.100.6.2.6] exists
+        and certificate leaf[field.1.2.840.113635.100.6.1.13] exists and certificate leaf[subject.OU] = "ABCDE12345"
+
+    authorities is the certificate chain of the signature (leaf first) and team_identifier its team, as codesign -dvv
+    shows them. Requirements of other signatures (Apple's own, App Store, ad-hoc or unsigned), requirements that
+    aren't anchored to Apple, and requirements that name a different team are returned as they are."""
+    if not team_identifier or not authorities or authorities[-1] != 'Apple Root CA':
+        return text
+
+    marks = None
+    for leaf_names, leaf_marks in GENERIC_MARKS:
+        if authorities[0].startswith(leaf_names):
+            marks = leaf_marks
+    if marks is None:
+        return text
+
+    try:
+        node = parse_requirement(text)
+    except RequirementError:
+        return text
+
+    clauses = node[1:] if node[0] == 'and' else (node,)
+    identifiers = [clause for clause in clauses if clause[0] == 'identifier']
+    teams = set(clause[3][1] for clause in clauses if clause[0] == 'cert_field' and clause[1:3] == (0, 'subject.OU'))
+    if ('anchor_apple_generic',) not in clauses or len(identifiers) != 1 or teams - set([team_identifier]):
+        return text
+
+    return format_requirement(('and', identifiers[0], ('anchor_apple_generic',)) + tuple(marks) +
+                              (('cert_field', 0, 'subject.OU', ('=', team_identifier)),))
+
+
+def _data(value):
+    """Length prefixed data, padded to a multiple of 4 bytes."""
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return struct.pack('>I', len(value)) + value + b'\0' * (-len(value) % 4)
+
+
+def _oid(oid):
+    """The DER content bytes of a dotted OID."""
+    try:
+        numbers = [int(number) for number in oid.split('.')]
+    except ValueError:
+        raise RequirementError('Invalid OID {}'.format(oid))
+
+    encoded = bytearray()
+    for number in [40 * numbers[0] + numbers[1]] + numbers[2:]:
+        chunk = [number & 0x7f]
+        number >>= 7
+        while number:
+            chunk.append(0x80 | (number & 0x7f))
+            number >>= 7
+        encoded.extend(reversed(chunk))
+
+    return bytes(encoded)
+
+
+def _compile_match(match):
+    operator, value = match
+    if value is None:
+        return struct.pack('>I', MATCH_OPS[operator])
+    elif operator == '=' and len(value) > 1 and value.startswith('*') and value.endswith('*'):
+        return struct.pack('>I', MATCH_CONTAINS) + _data(value[1:-1])
+    elif operator == '=' and value.endswith('*'):
+        return struct.pack('>I', MATCH_BEGINS_WITH) + _data(value[:-1])
+    elif operator == '=' and value.startswith('*'):
+        return struct.pack('>I', MATCH_ENDS_WITH) + _data(value[1:])
+    return struct.pack('>I', MATCH_OPS[operator]) + _data(value)
+
+
+def _compile(node, out):
+    name = node[0]
+    if name in SIMPLE_OPS:
+        out.append(struct.pack('>I', SIMPLE_OPS[name]))
+    elif name in ('and', 'or'):
+        # Binary and left associative, the same as the codesign compiler: a and b and c is and(and(a, b), c)
+        out.append(struct.pack('>I', OP_AND if name == 'and' else OP_OR) * (len(node) - 2))
+        for operand in node[1:]:
+            _compile(operand, out)
+    elif name == 'not':
+        out.append(struct.pack('>I', OP_NOT))
+        _compile(node[1], out)
+    elif name == 'identifier':
+        out.append(struct.pack('>I', OP_IDENT) + _data(node[1]))
+    elif name == 'named_anchor':
+        out.append(struct.pack('>I', OP_NAMED_ANCHOR) + _data(node[1]))
+    elif name == 'anchor_hash':
+        out.append(struct.pack('>Ii', OP_ANCHOR_HASH, node[1]) + _data(node[2]))
+    elif name == 'trusted_cert':
+        out.append(struct.pack('>Ii', OP_TRUSTED_CERT, node[1]))
+    elif name == 'cert_field':
+        out.append(struct.pack('>Ii', OP_CERT_FIELD, node[1]) + _data(node[2]) + _compile_match(node[3]))
+    elif name in ('cert_generic', 'cert_policy'):
+        opcode = OP_CERT_GENERIC if name == 'cert_generic' else OP_CERT_POLICY
+        out.append(struct.pack('>Ii', opcode, node[1]) + _data(_oid(node[2])) + _compile_match(node[3]))
+    elif name == 'cert_date':
+        # Dates are compared as CFAbsoluteTime values, which the text form here has no way to write; only whether the
+        # field is there can be compiled.
+        if node[3][1] is not None:
+            raise RequirementError('Comparing certificate timestamp fields with a date is not supported')
+        out.append(struct.pack('>Ii', OP_CERT_FIELD_DATE, node[1]) + _data(_oid(node[2])) + _compile_match(node[3]))
+    elif name == 'info':
+        out.append(struct.pack('>I', OP_INFO_KEY_FIELD) + _data(node[1]) + _compile_match(node[2]))
+    elif name == 'entitlement':
+        out.append(struct.pack('>I', OP_ENTITLEMENT_FIELD) + _data(node[1]) + _compile_match(node[2]))
+    elif name == 'cdhash':
+        out.append(struct.pack('>I', OP_CD_HASH) + _data(node[1]))
+    elif name == 'platform':
+        out.append(struct.pack('>Ii', OP_PLATFORM, node[1]))
+    else:
+        raise RequirementError('Unknown requirement node {!r}'.format(name))
+
+
+def compile_requirement(requirement):
+    """Returns the requirement blob (as kept in the csreq column of TCC.db) of a requirement, given as text or a tree."""
+    node = requirement if isinstance(requirement, tuple) else parse_requirement(requirement)
+    out = []
+    _compile(node, out)
+    body = b''.join(out)
+    return struct.pack('>III', REQUIREMENT_MAGIC, 12 + len(body), EXPR_FORM) + body
+
+
+class _Reader(object):
+    """Reads the expression of a requirement blob back into a tree."""
+    def __init__(self, blob):
+        self.blob = blob
+        self.offset = 12
+
+    def unpack(self, fmt):
+        try:
+            values = struct.unpack_from(fmt, self.blob, self.offset)
+        except struct.error:
+            raise RequirementError('Truncated requirement blob')
+        self.offset += struct.calcsize(fmt)
+        return values[0] if len(values) == 1 else values
+
+    def data(self):
+        length = self.unpack('>I')
+        value = self.blob[self.offset:self.offset + length]
+        if len(value) != length:
+            raise RequirementError('Truncated requirement blob')
+        self.offset += length + (-length % 4)
+        return value
+
+    def string(self):
+        return self.data().decode('utf-8')
+
+    def oid(self):
+        numbers = []
+        number = 0
+        for byte in bytearray(self.data()):
+            number = (number << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                numbers.append(number)
+                number = 0
+        first = min(numbers[0] // 40, 2)
+        return '.'.join(str(number) for number in [first, numbers[0] - 40 * first] + numbers[1:])
+
+    def match(self):
+        operation = self.unpack('>I')
+        if operation in (MATCH_EXISTS, MATCH_ABSENT):
+            return (MATCH_NAMES[operation], None)
+        value = self.string()
+        if operation == MATCH_CONTAINS:
+            return ('=', '*{}*'.format(value))
+        elif operation == MATCH_BEGINS_WITH:
+            return ('=', '{}*'.format(value))
+        elif operation == MATCH_ENDS_WITH:
+            return ('=', '*{}'.format(value))
+        elif operation in MATCH_NAMES:
+            return (MATCH_NAMES[operation], value)
+        raise RequirementError('Unsupported match operation {}'.format(operation))
+
+    def expression(self):
+        opcode = self.unpack('>I')
+        if opcode in SIMPLE_NAMES:
+            return (SIMPLE_NAMES[opcode],)
+        elif opcode in (OP_AND, OP_OR):
+            name = 'and' if opcode == OP_AND else 'or'
+            left = self.expression()
+            right = self.expression()
+            # Back to the ('and', a, b, c) form the parser gives a and b and c
+            return (left if left[0] == name else (name, left)) + (right,)
+        elif opcode == OP_NOT:
+            return ('not', self.expression())
+        elif opcode == OP_IDENT:
+            return ('identifier', self.string())
+        elif opcode == OP_NAMED_ANCHOR:
+            return ('named_anchor', self.string())
+        elif opcode == OP_ANCHOR_HASH:
+            return ('anchor_hash', self.unpack('>i'), self.data())
+        elif opcode == OP_TRUSTED_CERT:
+            return ('trusted_cert', self.unpack('>i'))
+        elif opcode == OP_CERT_FIELD:
+            slot = self.unpack('>i')
+            key = self.string()
+            return ('cert_field', slot, key, self.match())
+        elif opcode in (OP_CERT_GENERIC, OP_CERT_POLICY):
+            slot = self.unpack('>i')
+            oid = self.oid()
+            return ('cert_generic' if opcode == OP_CERT_GENERIC else 'cert_policy', slot, oid, self.match())
+        elif opcode == OP_CERT_FIELD_DATE:
+            slot = self.unpack('>i')
+            oid = self.oid()
+            operation = self.unpack('>I')
+            if operation not in (MATCH_EXISTS, MATCH_ABSENT):
+                raise RequirementError('Comparing certificate timestamp fields with a date is not supported')
+            return ('cert_date', slot, oid, (MATCH_NAMES[operation], None))
+        elif opcode == OP_INFO_KEY_FIELD:
+            key = self.string()
+            return ('info', key, self.match())
+        elif opcode == OP_ENTITLEMENT_FIELD:
+            key = self.string()
+            return ('entitlement', key, self.match())
+        elif opcode == OP_CD_HASH:
+            return ('cdhash', self.data())
+        elif opcode == OP_PLATFORM:
+            return ('platform', self.unpack('>i'))
+        raise RequirementError('Unsupported requirement opcode {}'.format(opcode))
+
+
+def decompile_requirement(blob):
+    """Returns the tree of a requirement blob."""
+    blob = bytes(blob)
+    if len(blob) < 12:
+        raise RequirementError('Truncated requirement blob')
+
+    magic, length, kind = struct.unpack_from('>III', blob)
+    if magic != REQUIREMENT_MAGIC or kind != EXPR_FORM:
+        raise RequirementError('Not a requirement blob')
+
+    return _Reader(blob[:length]).expression()
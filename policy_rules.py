@@ -0,0 +1,284 @@
+#!/usr/bin/python
+"""Turns policy rules into the app lists of a profile, by matching them against an inventory of apps.
+
+A rules file has one rule per line, the payload type and what it applies to, with '#' starting a comment:
+
+    SystemPolicyAllFiles  bundle:com.adobe.*
+    Accessibility         team:ABC123DEF4
+    Accessibility         path:/usr/local/bin/agent
+    AppleEvents           team:ABC123DEF4 -> bundle:com.apple.finder
+
+'bundle:' matches a bundle identifier exactly, or every identifier under a prefix when it ends in '.*' (but not the
+prefix itself). 'team:' matches the team identifier apps are signed with, and 'path:' the path of an app. AppleEvents
+rules match senders and receivers, and every sender is paired with every receiver.
+
+'bundle:' and 'team:' only match apps and plain executables, not the plugins, XPC services and other bundles a bundle
+index also has, unless the matcher is followed by the kinds it should match:
+
+    Accessibility         team:ABC123DEF4 kinds=app,xpc,plugin
+
+Rules are compiled into a trie of bundle identifier components and dicts of team identifiers and paths, so each app is
+matched against all the rules at once, in the time it takes to walk its identifier."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import multiprocessing
+import os
+import re
+
+from multiprocessing.pool import ThreadPool
+
+from bundle_index import BUNDLE_EXTENSIONS
+from tccprofile import AppSpec, PrivacyProfiles, ProfileBuildError
+
+MATCHER_KINDS = ('bundle', 'team', 'path')
+
+# What 'bundle:' and 'team:' matchers match without kinds=: apps, and code that is not in a bundle.
+DEFAULT_APP_KINDS = ('app', 'executable')
+
+# A comment: a whole line starting with '#', or ' # ...' at the end of a rule (paths can contain '#').
+COMMENT = re.compile(r'(^|\s)#.*$')
+
+BUNDLE_KINDS = set(extension.lower() for extension in BUNDLE_EXTENSIONS)
+
+# Probing an app for its identifier or team mostly waits on the disk and codesign, so run a few more than there are CPUs.
+WORKERS = multiprocessing.cpu_count() * 2
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = dict()
+        self.exact = []   # Rules matching the identifier that ends here.
+        self.prefix = []  # Rules matching every identifier below here.
+
+
+class Matcher(object):
+    """Matches apps against many 'bundle:', 'team:' and 'path:' matchers at once. Each matcher is added with the rule it
+    belongs to, and match() returns the rules of every matcher an app matches."""
+    def __init__(self):
+        self._trie = _TrieNode()
+        self._teams = dict()
+        self._paths = dict()
+
+    @property
+    def needs_team(self):
+        """Whether any matcher is on a team identifier, which needs a codesign probe per app."""
+        return bool(self._teams)
+
+    def add(self, kind, value, rule):
+        if kind == 'bundle':
+            node = self._trie
+            prefix = value.endswith('.*')
+            for component in (value[:-2] if prefix else value).split('.'):
+                node = node.children.setdefault(component, _TrieNode())
+            (node.prefix if prefix else node.exact).append(rule)
+        elif kind == 'team':
+            self._teams.setdefault(value, []).append(rule)
+        else:
+            self._paths.setdefault(os.path.normpath(value), []).append(rule)
+
+    def match(self, path, identifier, team=None):
+        """Returns the rules matching an app, given its path, bundle identifier and team identifier."""
+        rules = list(self._paths.get(path, []))
+
+        if identifier:
+            node = self._trie
+            components = identifier.split('.')
+            for position, component in enumerate(components, 1):
+                node = node.children.get(component)
+                if node is None:
+                    break
+                if position < len(components):  # A prefix only matches identifiers with more after it.
+                    rules.extend(node.prefix)
+            else:
+                rules.extend(node.exact)
+
+        if team and self._teams:
+            rules.extend(self._teams.get(team, []))
+
+        return rules
+
+
+class Rule(object):
+    __slots__ = ('number', 'payload', 'sender', 'receiver')
+
+    def __init__(self, number, payload, sender, receiver=None):
+        self.number = number
+        self.payload = payload
+        self.sender = sender
+        self.receiver = receiver
+
+
+def app_kind(path):
+    """Returns the kind of code at path for kinds=: the extension of a bundle ('app', 'xpc', 'plugin', ...), or
+    'executable' for code that is not in a bundle."""
+    extension = os.path.splitext(path.rstrip('/'))[1]
+    return extension[1:].lower() if extension.lower() in BUNDLE_KINDS else 'executable'
+
+
+def _parse_matcher(text, number, filename):
+    """Returns the (kind, value, app kinds) of a matcher, such as 'team:ABC123DEF4 kinds=app,xpc'."""
+    words = text.split()
+    kind, separator, value = (words[0] if words else '').partition(':')
+    if not separator or kind not in MATCHER_KINDS or not value:
+        raise ProfileBuildError('invalid_rules', 'Line {}: expected {} followed by a value, got {!r}'.format(
+            number, ', '.join('{}:'.format(name) for name in MATCHER_KINDS), text.strip()), path=filename)
+
+    kinds = DEFAULT_APP_KINDS
+    for option in words[1:]:
+        name, separator, values = option.partition('=')
+        if name != 'kinds' or not values:
+            raise ProfileBuildError('invalid_rules', 'Line {}: expected kinds=<kind>[,<kind>...] after the matcher, got {!r}'.format(
+                number, option), path=filename)
+        kinds = tuple(value.lower() for value in values.split(','))
+
+    return kind, value, kinds
+
+
+class RuleSet(object):
+    """Compiled policy rules: one Matcher for the apps a rule applies to, and one for the AppleEvents receivers."""
+    def __init__(self, rules):
+        self.rules = rules
+        self.senders = Matcher()
+        self.receivers = Matcher()
+        for rule in rules:
+            self.senders.add(rule.sender[0], rule.sender[1], rule)
+            if rule.receiver:
+                self.receivers.add(rule.receiver[0], rule.receiver[1], rule)
+
+    @property
+    def needs_team(self):
+        return self.senders.needs_team or self.receivers.needs_team
+
+    @classmethod
+    def read(cls, filename):
+        """Reads and compiles a rules file."""
+        rules = []
+        with open(filename, 'r') as rules_file:
+            for number, line in enumerate(rules_file, 1):
+                line = COMMENT.sub('', line).strip()
+                if not line:
+                    continue
+
+                payload, matchers = (line.split(None, 1) + [''])[:2]
+                if payload not in PrivacyProfiles.PAYLOADS:
+                    raise ProfileBuildError('invalid_rules', 'Line {}: unknown payload type {!r}, expected one of {}'.format(
+                        number, payload, ', '.join(PrivacyProfiles.PAYLOADS)), path=filename)
+
+                sender, arrow, receiver = matchers.partition('->')
+                if (payload == 'AppleEvents') != bool(arrow):
+                    raise ProfileBuildError('invalid_rules', 'Line {}: AppleEvents rules, and only those, need a "-> receiver".'.format(number), path=filename)
+
+                rules.append(Rule(
+                    number=number,
+                    payload=payload,
+                    sender=_parse_matcher(sender, number, filename),
+                    receiver=_parse_matcher(receiver, number, filename) if arrow else None,
+                ))
+
+        if not rules:
+            raise ProfileBuildError('invalid_rules', 'There are no rules in {}'.format(filename), path=filename)
+
+        return cls(rules)
+
+    def evaluate(self, apps, prober=None, workers=WORKERS):
+        """Matches the rules against apps, a list of (path, bundle identifier or None). Team identifiers are probed with
+        prober (in parallel, up front) only if there are team rules. Returns the apps per payload type, in the form
+        PrivacyProfiles.set_services_dict() takes, and the number of rules that matched no app."""
+        app_lists = dict()
+        senders = dict()
+        receivers = dict()
+        matched = set()
+
+        teams = dict()
+        if self.needs_team:
+            # Only the kinds of code some team rule matches are worth a codesign probe.
+            team_kinds = set(kind for rule in self.rules for matcher in (rule.sender, rule.receiver)
+                             if matcher and matcher[0] == 'team' for kind in matcher[2])
+            team_paths = [path for path, identifier in apps if app_kind(path) in team_kinds]
+            pool = ThreadPool(max(1, min(len(team_paths), workers)))
+            try:
+                teams = dict(pool.map(lambda path: (path, _team_identifier(prober, path)), team_paths))
+            finally:
+                pool.close()
+                pool.join()
+
+        for path, identifier in apps:
+            team = teams.get(path)
+            kind = app_kind(path)
+
+            for rule in self.senders.match(path, identifier, team):
+                if rule.sender[0] != 'path' and kind not in rule.sender[2]:
+                    continue
+                matched.add(rule.number)
+                if rule.receiver:
+                    senders.setdefault(rule.number, []).append(path)
+                else:
+                    app_lists.setdefault(rule.payload, {'_apps': []})['_apps'].append(AppSpec(path=path))
+
+            for rule in self.receivers.match(path, identifier, team):
+                if rule.receiver[0] != 'path' and kind not in rule.receiver[2]:
+                    continue
+                receivers.setdefault(rule.number, []).append(path)
+
+        for rule in self.rules:
+            if rule.receiver:
+                for sender in senders.get(rule.number, []):
+                    for receiver in receivers.get(rule.number, []):
+                        app_lists.setdefault('AppleEvents', {'_apps': []})['_apps'].append(
+                            AppSpec(path=sender, receiver_path=receiver))
+
+        unmatched = sum(1 for rule in self.rules if rule.number not in matched or (rule.receiver and rule.number not in receivers))
+        return app_lists, unmatched
+
+
+def _team_identifier(prober, path):
+    try:
+        return prober.team_identifier(path)
+    except ProfileBuildError:
+        return None
+
+
+def read_inventory(filename, prober, workers=WORKERS):
+    """Returns the (path, bundle identifier or None) of the apps in an inventory: a bundle index (see bundle_index.py),
+    or a text file with one app path per line whose identifiers are probed with prober. Without a filename, the
+    default bundle index is refreshed and used."""
+    import bundle_index
+
+    if filename is None:
+        index = bundle_index.BundleIndex.load()
+        index.refresh()
+        index.save()
+        return sorted((path, record['identifier']) for path, record in index.bundles.items())
+
+    with open(filename, 'r') as inventory_file:
+        text = inventory_file.read()
+
+    if text.lstrip().startswith('{'):
+        bundles = json.loads(text).get('bundles', dict())
+        return sorted((path, record['identifier']) for path, record in bundles.items())
+
+    paths = []
+    seen = set()
+    for line in text.splitlines():
+        path = os.path.normpath(line.strip()) if line.strip() else None
+        if path and not line.lstrip().startswith('#') and path not in seen:
+            seen.add(path)
+            paths.append(path)
+
+    def identify(path):
+        try:
+            found = prober.identifier_and_type(path)
+        except ProfileBuildError:
+            return path, None
+        return path, found['identifier'] if found['identifier_type'] == 'bundleID' else None
+
+    pool = ThreadPool(max(1, min(len(paths), workers)))
+    try:
+        return pool.map(identify, paths)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""Probes apps on a Mac and saves what a profile needs to know about them (mime type, code signing state, designated
+requirement, signing certificates, identifier) as a facts snapshot. tccprofile.py --facts builds profiles from the
+snapshot, anywhere."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import datetime
+import json
+import os
+import sys
+
+from tccprofile import PrivacyProfiles, Prober, ProfileBuildError, SaneUsageFormat, fingerprint, read_facts
+
+SNAPSHOT_VERSION = 1
+
+
+def collect_facts(apps, prober, previous=None):
+    """Probes every path in the app strings (in any form tccprofile.py takes them: 'path', 'path:override',
+    'sender,receiver') with prober. Facts in previous are reused for paths whose fingerprint has not changed.
+    Returns the facts and the list of ProfileBuildErrors for apps that could not be probed."""
+    if previous:
+        prober.load_facts(dict((path, record) for path, record in previous.items()
+                               if record.get('fingerprint') and record['fingerprint'] == fingerprint(path)))
+
+    errors = []
+    for app in apps:
+        try:
+            spec = PrivacyProfiles._parse_app(app, apple_event=',' in app)
+            targets = [(spec.path, spec.override)]
+            if spec.receiver_path:
+                targets.append((spec.receiver_path, spec.receiver_override))
+
+            for path, override in targets:
+                prober.code_sign_requirement(path)
+                prober.signing_info(path)
+                prober.identifier_and_type(path, override_path=override)
+        except ProfileBuildError as e:
+            errors.append(e)
+
+    return prober.facts(), errors
+
+
+def write_snapshot(facts, filename, search_path):
+    """Writes facts out as a snapshot file, or to stdout if there is no filename."""
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'search_path': search_path,
+        'facts': facts,
+    }
+
+    if filename:
+        with open(filename, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file, indent=1, sort_keys=True)
+    else:
+        json.dump(snapshot, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py collect-facts',
+        description='Probe apps and save the results as a facts snapshot for tccprofile.py --facts.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'apps',
+        type=str,
+        nargs='*',
+        metavar='<app paths>',
+        help='The apps to probe, in the same form as the payload arguments of tccprofile.py, for example '
+             '/Applications/App.app, /path/App.app:/override/App.app or /path/Sender.app,/path/Receiver.app',
+    )
+
+    parser.add_argument(
+        '-f', '--from-file',
+        type=str,
+        dest='apps_file',
+        metavar='<file>',
+        help='Read the apps to probe from a file, one per line.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        dest='snapshot_filename',
+        metavar='<snapshot.json>',
+        help='Filename to save the snapshot as. Prints to stdout if not given.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--update',
+        action='store_true',
+        dest='update',
+        default=False,
+        help='Reuse the facts already in the --output snapshot for apps that have not changed since, and only probe '
+             'new or changed apps.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--shebang-path',
+        type=str,
+        dest='shebang_path',
+        metavar='<PATH>',
+        help='The PATH used to find the interpreter of unsigned scripts with a "#!/usr/bin/env python" style shebang.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    apps = list(args.apps)
+    if args.apps_file:
+        with open(args.apps_file, 'r') as apps_file:
+            apps.extend(line.strip() for line in apps_file if line.strip() and not line.startswith('#'))
+
+    if not apps:
+        print('No apps to probe were provided.')
+        return 1
+
+    previous = None
+    if args.update and args.snapshot_filename and os.path.exists(args.snapshot_filename):
+        previous = read_facts(args.snapshot_filename)
+
+    prober = Prober(search_path=args.shebang_path)
+    facts, errors = collect_facts(apps, prober, previous=previous)
+    write_snapshot(facts, args.snapshot_filename, prober.search_path)
+
+    for error in errors:
+        print(error.message, file=sys.stderr)
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,466 @@
+#!/usr/bin/python
+"""Spreads probing the apps of a profile over worker processes, on this Mac or on the hosts the apps are staged on, so
+a build of many thousands of apps isn't held up by the disk and codesign of one machine.
+
+The coordinator (tccprofile.py --probe-workers) splits the apps into work units and hands them out to the workers over
+a plain TCP connection, one JSON object per line:
+
+    coordinator -> worker   {"unit": 3, "targets": [["/Applications/App.app", null, true], ...], "signing_info": false,
+                             "optional": false}
+    worker -> coordinator   {"unit": 3, "path": "/Applications/App.app", "facts": {...}, "nested": [...]}  for each app
+                            {"unit": 3, "path": "/Applications/Gone.app", "error": {"code": ..., "message": ..., "path": ...}}
+                            {"unit": 3, "path": "/Applications/App.app/Contents/Helpers/tool", "skipped": "..."}
+                            {"unit": 3, "done": true}
+
+A target is [path, override, nested]. With nested, the worker also finds the code nested in the app (see
+probe_nested.py) and probes it, and the paths it found are sent along with the facts of the app. Nested code that can't
+be used, and the apps of an "optional" unit that can't be, are reported as skipped rather than as errors.
+
+The facts are records of a facts snapshot (see probe_facts.py), and are loaded into the Prober of the profile, which
+is then built as if it had probed the apps itself. Each connection has a Prober of its own, so a worker probes an
+interpreter shared by many scripts once. A unit whose worker fails or disconnects is given to another worker, until it
+has been tried too often. The apps have to be at the same paths on every worker host."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import probe_nested
+
+from tccprofile import Prober, ProfileBuildError, SaneUsageFormat
+
+# Apps per work unit: big enough that a round trip is cheap next to probing the apps, small enough that a failed unit
+# doesn't cost much to redo and work spreads evenly.
+UNIT_SIZE = 50
+
+RETRIES = 2
+
+# Seconds to wait before connecting to a worker again, times the number of times in a row it failed.
+RECONNECT_DELAY = 0.5
+
+# Seconds to wait for the next line from a worker before giving up on it.
+TIMEOUT = 300
+
+# Probes mostly wait on the disk and codesign, so a worker runs a few more than there are CPUs.
+WORKERS = multiprocessing.cpu_count() * 2
+
+
+def _merge_facts(facts, new):
+    """Adds the records of new to facts, keeping the identifiers of every override that was probed for a path."""
+    for path, record in new.items():
+        identifiers = dict(facts.get(path, dict()).get('identifiers', dict()))
+        identifiers.update(record.get('identifiers', dict()))
+        facts[path] = dict(record, identifiers=identifiers)
+
+
+def _send(stream, message):
+    stream.write((json.dumps(message) + '\n').encode('utf-8'))
+    stream.flush()
+
+
+def _receive(stream):
+    line = stream.readline()
+    if not line:
+        raise EOFError('connection closed')
+    return json.loads(line.decode('utf-8'))
+
+
+def _probe_target(prober, target, signing_info, optional=False):
+    """Probes everything the profile needs to know about an app, and with the nested flag of the target, about the code
+    nested in it. Returns the messages with their facts, or why they can't be used."""
+    path, override, nested = target
+    try:
+        prober.identifier_and_type(path, override_path=override or False)
+        prober.code_sign_requirement(path)
+        if signing_info:
+            prober.signing_info(path)
+    except ProfileBuildError as e:
+        # The app is there but can't be used (or isn't there), probing it again won't change that.
+        return [{'path': path, 'skipped': e.message} if optional else {'path': path, 'error': e.as_dict()}]
+
+    messages = [{'path': path, 'facts': {path: prober.record(path, [override])}}]
+    if nested:
+        children = prober.nested(path, probe_nested.find_nested)
+        messages[0]['nested'] = children
+        for child, child_override in probe_nested.nested_targets(path, override or False, children):
+            messages.extend(_probe_target(prober, (child, child_override, False), signing_info, optional=True))
+
+    return messages
+
+
+def probe_unit(request, prober, workers=WORKERS):
+    """Probes the targets of a work unit in parallel with prober, yielding a message per app as it is probed, then one
+    that the unit is done. Anything but a ProfileBuildError (codesign missing, say) fails the whole unit."""
+    targets = request['targets']
+    pool = ThreadPool(max(1, min(len(targets), workers)))
+    try:
+        for messages in pool.imap_unordered(
+                lambda target: _probe_target(prober, target, request.get('signing_info'), request.get('optional')), targets):
+            for message in messages:
+                message['unit'] = request['unit']
+                yield message
+    except Exception as e:
+        yield {'unit': request['unit'], 'failed': '{}: {}'.format(type(e).__name__, e)}
+        return
+    finally:
+        pool.close()
+        pool.join()
+
+    yield {'unit': request['unit'], 'done': True}
+
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # One Prober for the units of a connection, which is one probe() of a coordinator.
+        prober = Prober(search_path=self.server.search_path)
+        for line in iter(self.rfile.readline, b''):
+            for message in probe_unit(json.loads(line.decode('utf-8')), prober):
+                _send(self.wfile, message)
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """A probe worker, serving any number of coordinators at once."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, search_path=None):
+        socketserver.TCPServer.__init__(self, address, _WorkerHandler)
+        self.search_path = search_path
+
+
+def parse_address(text):
+    """Returns the (host, port) of 'host:port'."""
+    host, separator, port = text.rpartition(':')
+    if not separator or not port.isdigit():
+        raise ProfileBuildError('invalid_input', 'Expected host:port, got {!r}'.format(text))
+    return host or '127.0.0.1', int(port)
+
+
+def start_local_workers(count, search_path=None):
+    """Starts count worker processes on this machine. Returns the processes and the addresses they listen on."""
+    cmd = [sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + '.py', '--listen', '127.0.0.1:0']
+    if search_path:
+        cmd.extend(['--shebang-path', search_path])
+
+    processes = []
+    addresses = []
+    try:
+        for number in range(count):
+            processes.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True))
+            # The worker prints 'Listening on host:port' once it is ready, and nothing if it exits first.
+            line = processes[-1].stdout.readline()
+            try:
+                addresses.append(parse_address(line.split()[-1]))
+            except (IndexError, ProfileBuildError):
+                raise ProfileBuildError('probe_failed', 'Local probe worker {} did not start: {}'.format(
+                    number + 1, line.strip() or 'it exited with {}'.format(processes[-1].wait())))
+    except BaseException:
+        stop_local_workers(processes)
+        raise
+
+    return processes, addresses
+
+
+def stop_local_workers(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+
+class _Unit(object):
+    __slots__ = ('number', 'targets', 'attempts', 'problem')
+
+    def __init__(self, number, targets):
+        self.number = number
+        self.targets = targets
+        self.attempts = 0
+        self.problem = None
+
+
+class Coordinator(object):
+    """Hands out work units to the workers at addresses, one connection (and thread) per worker, and collects the facts
+    and errors they send back. A unit that fails is given to the next free worker, up to retries times. A worker that
+    fails (to connect, or on a unit) more than retries times in a row is not used again. Only failures on a unit count
+    against the unit."""
+    def __init__(self, addresses, unit_size=UNIT_SIZE, retries=RETRIES, timeout=TIMEOUT):
+        self.addresses = addresses
+        self.unit_size = unit_size
+        self.retries = retries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def probe(self, targets, signing_info=False, optional=False):
+        """Probes targets, a list of (path, override or None, nested). Returns the facts, the ProfileBuildErrors of
+        apps that can't be used, the units that failed as a list of ([targets], problem), the paths of the code nested
+        in each app probed with nested, and the (path, problem) of nested code (or with optional, of apps) that can't
+        be used."""
+        self._queue = queue.Queue()
+        self._remaining = 0
+        self._done = threading.Event()
+        self._facts = dict()
+        self._errors = []
+        self._failed = []
+        self._nested = dict()
+        self._skipped = []
+        self._worker_problems = dict()
+        options = {'signing_info': signing_info, 'optional': optional}
+
+        for start in range(0, len(targets), self.unit_size):
+            self._queue.put(_Unit(start // self.unit_size, targets[start:start + self.unit_size]))
+            self._remaining += 1
+
+        threads = [threading.Thread(target=self._work, args=(address, options)) for address in self.addresses]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every worker gave up, what's left fails with them.
+        while not self._queue.empty():
+            unit = self._queue.get()
+            self._failed.append((unit.targets, unit.problem or 'no worker left to probe it ({})'.format(
+                '; '.join(sorted(self._worker_problems.values())) or 'no workers')))
+
+        return self._facts, self._errors, self._failed, self._nested, self._skipped
+
+    def _next_unit(self):
+        while True:
+            with self._lock:
+                if not self._remaining:
+                    return None
+            try:
+                return self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue  # A unit may still come back from a failing worker.
+
+    def _run_unit(self, stream, unit, options):
+        """Sends a unit to a worker and reads its results, only keeping them once the whole unit is done."""
+        _send(stream, dict(options, unit=unit.number, targets=unit.targets))
+        facts = dict()
+        errors = []
+        nested = dict()
+        skipped = []
+        while True:
+            message = _receive(stream)
+            if message.get('unit') != unit.number:
+                raise ValueError('expected results of unit {}, got {!r}'.format(unit.number, message))
+            elif message.get('failed'):
+                raise ValueError(message['failed'])
+            elif message.get('done'):
+                return facts, errors, nested, skipped
+            elif 'error' in message:
+                errors.append(ProfileBuildError(**message['error']))
+            elif 'skipped' in message:
+                skipped.append((message['path'], message['skipped']))
+            else:
+                _merge_facts(facts, message['facts'])
+                if 'nested' in message:
+                    nested[message['path']] = message['nested']
+
+    def _work(self, address, options):
+        connection = stream = None
+        failures = 0
+        while failures <= self.retries:
+            with self._lock:
+                if not self._remaining:
+                    break
+
+            # Connect before taking a unit, so a worker that can't be reached doesn't use up the retries of units that
+            # the other workers could probe.
+            if connection is None:
+                try:
+                    connection = socket.create_connection(address, timeout=self.timeout)
+                    stream = connection.makefile('rwb')
+                except EnvironmentError as e:
+                    failures += 1
+                    self._worker_problems[address] = '{}:{}: {}'.format(address[0], address[1], e)
+                    self._done.wait(RECONNECT_DELAY * failures)
+                    continue
+
+            unit = self._next_unit()
+            if unit is None:
+                break
+
+            try:
+                facts, errors, nested, skipped = self._run_unit(stream, unit, options)
+            except (EnvironmentError, EOFError, ValueError, KeyError, TypeError) as e:
+                connection.close()
+                connection = stream = None
+                failures += 1
+                self._worker_problems[address] = '{}:{}: {}'.format(address[0], address[1], e)
+                self._retry(unit, self._worker_problems[address])
+                continue
+
+            failures = 0
+            with self._lock:
+                _merge_facts(self._facts, facts)
+                self._errors.extend(errors)
+                self._nested.update(nested)
+                self._skipped.extend(skipped)
+                self._finish_unit()
+
+        if connection is not None:
+            connection.close()
+
+    def _finish_unit(self):
+        """Counts a unit as done (probed or failed), under the lock."""
+        self._remaining -= 1
+        if not self._remaining:
+            self._done.set()
+
+    def _retry(self, unit, problem):
+        unit.attempts += 1
+        unit.problem = problem
+        if unit.attempts > self.retries:
+            with self._lock:
+                self._failed.append((unit.targets, problem))
+                self._finish_unit()
+        else:
+            self._queue.put(unit)
+
+
+def probe_apps(tcc_profile, addresses=(), local_workers=0, search_path=None, retries=RETRIES, unit_size=UNIT_SIZE,
+               include_nested=False):
+    """Probes the apps of tcc_profile (after set_services_dict()) on the workers at addresses and on local_workers
+    worker processes started for the purpose, and loads the facts into its Prober, so building the profile finds them
+    all cached. Apps the Prober already knows (from an earlier build that --watch rebuilds, say) are not sent again.
+    Raises a ProfileBuildError if units failed, or for the first app that can't be used, as building the profile on
+    this machine would.
+
+    With include_nested, the workers also find and probe the code nested in the apps, which is then added to the
+    profile as probe_nested.add_nested() does. Returns the (path, problem) of nested code that can't be used."""
+    prober = tcc_profile._prober
+    signing_info = tcc_profile._generic_requirements
+
+    apps = set()
+    receivers = set()
+    for specs in tcc_profile._app_lists.values():
+        for spec in specs:
+            apps.add((spec.path, spec.override))
+            if spec.receiver_path:
+                receivers.add((spec.receiver_path, spec.receiver_override))
+    targets = [(path, override, include_nested) for path, override in apps]
+    targets.extend((path, override, False) for path, override in receivers - apps)
+
+    addresses = list(addresses)
+    processes = []
+
+    def probe(targets, optional=False):
+        """Probes the targets the Prober doesn't know yet on the workers. Returns the (path, problem) of those skipped."""
+        targets = sorted((path, override or None, nested) for path, override, nested in targets
+                         if not prober.probed(path, override, signing_info) or (nested and not prober.probed_nested(path)))
+        if not targets:
+            return []
+        if local_workers and not processes:
+            started, local_addresses = start_local_workers(local_workers, search_path)
+            processes.extend(started)
+            addresses.extend(local_addresses)
+
+        coordinator = Coordinator(addresses, unit_size=unit_size, retries=retries)
+        facts, errors, failed, nested, skipped = coordinator.probe(targets, signing_info=signing_info, optional=optional)
+
+        if failed:
+            raise ProfileBuildError('probe_failed', '{} of {} apps could not be probed by the workers:\n{}'.format(
+                sum(len(unit_targets) for unit_targets, problem in failed), len(targets),
+                '\n'.join('  {} apps from {}: {}'.format(len(unit_targets), unit_targets[0][0], problem) for unit_targets, problem in failed)))
+
+        if errors:
+            raise sorted(errors, key=lambda error: error.path or '')[0]
+
+        prober.load_facts(facts)
+        for path, children in nested.items():
+            prober.nested(path, lambda path, children=children: children)
+        return skipped
+
+    try:
+        skipped = dict(probe(targets))
+        if not include_nested:
+            return []
+
+        nested = dict(((path, override), probe_nested.nested_targets(path, override, prober.nested(path, probe_nested.find_nested)))
+                      for path, override in apps)
+        # Nested code left out of an earlier build is not known to the Prober either, so it is tried again.
+        children = set(target for found in nested.values() for target in found if target[0] not in skipped)
+        skipped.update(probe([(path, override, False) for path, override in children], optional=True))
+    finally:
+        stop_local_workers(processes)
+
+    probe_nested.expand_nested(tcc_profile, nested, set(target for found in nested.values() for target in found if target[0] in skipped))
+    return sorted(skipped.items())
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py probe-worker',
+        description='Probe apps for coordinators started with tccprofile.py --probe-workers.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        '--listen',
+        type=str,
+        dest='listen',
+        metavar='<host:port>',
+        default='127.0.0.1:0',
+        help='The address to listen on, for example 0.0.0.0:7412 to take work from other hosts. '
+             'Default: a free port on 127.0.0.1',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--shebang-path',
+        type=str,
+        dest='shebang_path',
+        metavar='<PATH>',
+        help='The PATH that the interpreter of "#!/usr/bin/env python" style scripts is looked up in on this host. '
+             'Default: the PATH of this process.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    try:
+        server = WorkerServer(parse_address(args.listen), search_path=args.shebang_path)
+    except ProfileBuildError as e:
+        print(e.message)
+        return 1
+
+    print('Listening on {}:{}'.format(*server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+"""Finds the code nested in app bundles that TCC prompts can come from (helper apps and tools, login items, XPC
+services, and the helpers and XPC services of embedded frameworks), so each can get its own entry in the profile.
+
+Nested code is found by where the bundle layout puts it rather than by walking the whole bundle, so a bundle costs a
+few directory listings however many resources it has."""
+
+from __future__ import absolute_import, print_function
+
+import multiprocessing
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from tccprofile import AppSpec
+
+# Where nested code lives, relative to the bundle, and the bundle extensions found there. Plain executables are only
+# taken from Helpers directories.
+NESTED_LOCATIONS = [
+    ('Contents/Helpers', ('.app',)),
+    ('Contents/Library/LoginItems', ('.app',)),
+    ('Contents/XPCServices', ('.xpc',)),
+    ('Contents/Frameworks', ('.app',)),
+]
+
+FRAMEWORK_LOCATIONS = [
+    ('Versions/Current/Helpers', ('.app',)),
+    ('Versions/Current/XPCServices', ('.xpc',)),
+]
+
+# Nested bundles can have nested code of their own (a helper app with an XPC service), but not without end.
+MAX_DEPTH = 3
+
+# Probes mostly wait on file and codesign, so run a few more than there are CPUs.
+WORKERS = multiprocessing.cpu_count() * 2
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def _is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def _nested_in(path, locations):
+    found = []
+    for location, extensions in locations:
+        directory = os.path.join(path, location)
+        for name in _listdir(directory):
+            child = os.path.join(directory, name)
+            if name.endswith(extensions) and os.path.isdir(child):
+                found.append(child)
+            elif location.endswith('Helpers') and _is_executable(child):
+                found.append(child)
+    return found
+
+
+def find_nested(path, depth=MAX_DEPTH):
+    """Returns the paths of the code nested in the bundle at path, outermost first. Returns nothing for apps that are
+    not bundles."""
+    if depth == 0 or not os.path.isdir(path):
+        return []
+
+    nested = _nested_in(path, NESTED_LOCATIONS)
+    frameworks = os.path.join(path, 'Contents/Frameworks')
+    for name in _listdir(frameworks):
+        if name.endswith('.framework'):
+            nested.extend(_nested_in(os.path.join(frameworks, name), FRAMEWORK_LOCATIONS))
+
+    found = []
+    for child in nested:
+        found.append(child)
+        found.extend(find_nested(child, depth - 1))
+
+    return found
+
+
+def _nested_override(path, parent, override):
+    """Returns the override path of nested code, which is where it is inside the parent app at its override path.
+    Nested bundles are identified by their bundle identifier wherever they are, so they don't get one."""
+    if not override or os.path.isdir(path):
+        return False
+    return os.path.join(override.rstrip('/'), os.path.relpath(path, parent.rstrip('/')))
+
+
+def nested_targets(path, override, children):
+    """Returns the (path, override) of each of the children nested in the app at path."""
+    return [(child, _nested_override(child, path, override)) for child in children]
+
+
+def _probe(prober, path, override=False):
+    """Probes everything the profile needs to know about an app. Returns None, or why it can't be used."""
+    try:
+        prober.identifier_and_type(path, override_path=override)
+        prober.code_sign_requirement(path)
+    except Exception as e:
+        return getattr(e, 'message', str(e))
+
+
+def add_nested(tcc_profile, workers=WORKERS):
+    """Adds an entry for the code nested in each bundle of tcc_profile (after set_services_dict()), next to the entry of
+    the bundle, under the same payload types. For AppleEvents, nested code is added as a sender to the same receiver.
+    For an app given as 'path:override', nested executables are identified by their path inside the override path.
+
+    The bundles are searched and then probed, along with the apps themselves, in parallel. Nested items that can't be
+    used (for example an unsigned helper) are left out, and returned as a list of (path, problem)."""
+    apps = set()
+    for specs in tcc_profile._app_lists.values():
+        for spec in specs:
+            apps.add((spec.path, spec.override))
+    apps = sorted(apps)
+    paths = sorted(set(path for path, override in apps))
+
+    pool = ThreadPool(max(1, min(len(apps), workers)))
+    try:
+        # The apps themselves are probed alongside; their problems are raised when the profile is built.
+        app_problems = pool.map_async(lambda app: _probe(tcc_profile._prober, *app), apps)
+        found = dict(zip(paths, pool.map(find_nested, paths)))
+        nested = dict(((path, override), nested_targets(path, override, found[path])) for path, override in apps)
+        targets = sorted(set(target for found_targets in nested.values() for target in found_targets))
+        problems = pool.map(lambda target: _probe(tcc_profile._prober, *target), targets)
+        app_problems.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    skipped = dict((target, problem) for target, problem in zip(targets, problems) if problem)
+    expand_nested(tcc_profile, nested, skipped)
+
+    return sorted((path, problem) for (path, override), problem in skipped.items())
+
+
+def expand_nested(tcc_profile, nested, skipped=()):
+    """Adds the entries for nested code next to the entry of each app in tcc_profile. nested maps the (path, override)
+    of an app to the (path, override) of the code nested in it, the targets in skipped are left out."""
+    for specs in tcc_profile._app_lists.values():
+        expanded = []
+        seen = set()
+        for spec in specs:
+            for item in [spec] + [AppSpec(path=path, override=override, receiver_path=spec.receiver_path, receiver_override=spec.receiver_override)
+                                  for path, override in nested.get((spec.path, spec.override), []) if (path, override) not in skipped]:
+                if item.key() not in seen:
+                    seen.add(item.key())
+                    expanded.append(item)
+        specs[:] = expanded
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+"""Probes the apps of a profile with bounded latency. Apps on network shares and removable media are probed by a few
+workers of their own, with a timeout and retries, so a slow or dead volume can't hold up (or block) the build.
+Apps that still can't be probed are left out of the profile and reported."""
+
+from __future__ import absolute_import, print_function
+
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from tccprofile import ProfileBuildError
+
+REMOTE_FS_TYPES = set([
+    '9p', 'afpfs', 'ceph', 'cifs', 'davfs', 'fuse.rclone', 'fuse.sshfs', 'ftp', 'glusterfs', 'nfs', 'nfs4', 'smb3',
+    'smbfs', 'sshfs', 'webdav',
+])
+
+REMOVABLE_FS_TYPES = set(['cd9660', 'exfat', 'iso9660', 'msdos', 'udf', 'vfat'])
+
+# Where removable media is mounted: /Volumes on macOS (the system volumes are under /System/Volumes), /media on Linux.
+REMOVABLE_MOUNT_POINTS = ('/Volumes/', '/media/', '/run/media/')
+
+# Linux: "/dev/sda1 /mnt/data ext4 rw,relatime 0 0", spaces in paths escaped as \040
+PROC_MOUNT = re.compile(r'^(\S+) (\S+) (\S+) (\S+)')
+# macOS: "//user@server/share on /Volumes/share (smbfs, nodev, nosuid, mounted by user)"
+MOUNT_OUTPUT = re.compile(r'^(.+) on (.+) \(([^,)]+)(?:, ([^)]*))?\)$')
+
+
+class MountTable(object):
+    """The mounted volumes, to tell which kind of volume a path is on without touching the (possibly stalled) volume."""
+    def __init__(self, mounts=None):
+        # (mount point, filesystem type, options), longest mount point first so the first match is the closest one.
+        self.mounts = sorted(self.read() if mounts is None else mounts, key=lambda mount: len(mount[0]), reverse=True)
+
+    @staticmethod
+    def read():
+        """Returns the (mount point, filesystem type, options) of every mounted volume."""
+        mounts = []
+        if os.path.exists('/proc/self/mounts'):
+            with open('/proc/self/mounts', 'r') as mounts_file:
+                for line in mounts_file:
+                    match = PROC_MOUNT.match(line)
+                    if match:
+                        mount_point = match.group(2).replace('\\040', ' ')
+                        mounts.append((mount_point, match.group(3), match.group(4).split(',')))
+        else:
+            process = subprocess.Popen(['/sbin/mount'], stdout=subprocess.PIPE, universal_newlines=True)
+            for line in process.communicate()[0].splitlines():
+                match = MOUNT_OUTPUT.match(line)
+                if match:
+                    mounts.append((match.group(2), match.group(3), (match.group(4) or '').split(', ')))
+
+        return mounts
+
+    def kind(self, path):
+        """Returns 'remote', 'removable' or 'local' for the volume path is on."""
+        path = os.path.abspath(path)
+        for mount_point, fs_type, options in self.mounts:
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                if fs_type in REMOTE_FS_TYPES:
+                    return 'remote'
+                elif fs_type in REMOVABLE_FS_TYPES or (mount_point + '/').startswith(REMOVABLE_MOUNT_POINTS):
+                    return 'removable'
+                return 'local'
+
+        return 'local'
+
+
+def _probe(prober, path, override):
+    """Probes everything the profile needs to know about an app, so building the profile finds it all cached."""
+    prober.identifier_and_type(path, override_path=override)
+    prober.code_sign_requirement(path)
+
+
+def _probe_bounded(prober, path, override, timeout, retries, backoff):
+    """Probes an app, giving up on an attempt after timeout seconds. Failed attempts are retried after backoff seconds,
+    doubling each time. Returns None once probed, or why it couldn't be.
+
+    A stalled attempt can't be interrupted, it is left to finish (or not) in the background. Its probes are abandoned
+    in the prober, so the retry probes the app again instead of waiting on the stalled attempt."""
+    problem = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        result = dict()
+
+        def attempt_probe():
+            try:
+                _probe(prober, path, override)
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=attempt_probe)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+
+        if thread.is_alive():
+            prober.abandon(path)
+            problem = 'timed out after {}s'.format(timeout)
+        elif isinstance(result.get('error'), ProfileBuildError):
+            return result['error'].message  # The app is there but can't be used, trying again won't change that.
+        elif 'error' in result:
+            problem = str(result['error'])
+        else:
+            return None
+
+    return '{} ({} attempts)'.format(problem, retries + 1)
+
+
+def probe_apps(tcc_profile, timeout, retries=2, backoff=1.0, slow_workers=2, mounts=None):
+    """Probes all the apps of tcc_profile (after set_services_dict()) ahead of building it. Apps on local volumes are
+    probed with full concurrency, apps on remote and removable volumes by slow_workers threads with a timeout per app.
+
+    Apps on remote or removable volumes that couldn't be probed are removed from the profile. Returns them as a list of
+    (path, volume kind, problem). Problems with local apps are left to raise when the profile is built."""
+    mounts = mounts or MountTable()
+    targets = set()
+    for specs in tcc_profile._app_lists.values():
+        for spec in specs:
+            targets.add((spec.path, spec.override))
+            if spec.receiver_path:
+                targets.add((spec.receiver_path, spec.receiver_override))
+
+    kinds = dict((path, mounts.kind(path)) for path, override in targets)
+    local = [target for target in targets if kinds[target[0]] == 'local']
+    slow = [target for target in targets if kinds[target[0]] != 'local']
+
+    def probe_local(target):
+        try:
+            _probe(tcc_profile._prober, *target)
+        except Exception:
+            pass
+
+    def probe_slow(target):
+        return _probe_bounded(tcc_profile._prober, target[0], target[1], timeout, retries, backoff)
+
+    local_pool = ThreadPool(max(1, min(len(local), multiprocessing.cpu_count() * 2)))
+    slow_pool = ThreadPool(max(1, min(len(slow), slow_workers)))
+    try:
+        local_results = local_pool.map_async(probe_local, local)
+        slow_results = slow_pool.map_async(probe_slow, slow)
+        problems = slow_results.get()
+        local_results.get()
+    finally:
+        for pool in (local_pool, slow_pool):
+            pool.close()
+            pool.join()
+
+    report = sorted(set((path, kinds[path], problem) for (path, override), problem in zip(slow, problems) if problem))
+    if report:
+        tcc_profile.remove_apps(path for path, kind, problem in report)
+
+    return report
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+"""Compares the 'Services' entries of a profile with the grants in a TCC.db, reporting per service which entries are
+covered by a grant, which grants differ (code requirement or allowed), which entries have no grant, and which grants
+aren't in the profile."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+from collections import OrderedDict
+
+from code_requirement import RequirementError, canonical_requirement, compile_requirement, decompile_requirement, format_requirement
+from profile_merge import profile_services
+from tccdbRead import Sqlite_db
+from tccprofile import PrivacyProfiles, SaneUsageFormat, read_profile
+
+# TCC.db client_type values
+CLIENT_TYPES = {'bundleID': 0, 'path': 1}
+IDENTIFIER_TYPES = dict((client_type, name) for name, client_type in CLIENT_TYPES.items())
+
+# auth_value (macOS 11 and later) of an allowed grant, older databases have a boolean 'allowed' column instead.
+AUTH_VALUE_ALLOWED = 2
+
+SERVICE_PREFIX = 'kTCCService'
+
+
+def read_grants(tcc_db):
+    """Returns the grants in the access table of a TCC.db as dicts, with 'allowed' as a bool whichever column the
+    database keeps it in."""
+    sqlite = Sqlite_db()
+    sqlite.connect(tcc_db)
+    try:
+        columns = set(row[1] for row in sqlite.query('PRAGMA table_info(access)', fetch=True))
+        allowed = 'auth_value' if 'auth_value' in columns else 'allowed'
+        receiver = ', indirect_object_identifier' if 'indirect_object_identifier' in columns else ', NULL'
+        rows = sqlite.query('SELECT service, client, client_type, {}, csreq{} FROM access'.format(allowed, receiver), fetch=True)
+    finally:
+        sqlite.disconnect(tcc_db)
+
+    return [{
+        'service': service,
+        'client': client,
+        'client_type': client_type,
+        'allowed': value == AUTH_VALUE_ALLOWED if allowed == 'auth_value' else bool(value),
+        'csreq': bytes(csreq) if csreq is not None else None,
+        'receiver': receiver if receiver and receiver != 'UNUSED' else None,
+    } for service, client, client_type, value, csreq, receiver in rows]
+
+
+class RequirementMatcher(object):
+    """Tells if a profile CodeRequirement and a csreq blob are the same requirement. Each requirement is compiled once
+    and compared with the blob as bytes, falling back to comparing canonical forms when the bytes differ."""
+    def __init__(self):
+        self._compiled = dict()
+        self._decompiled = dict()
+
+    def _compile(self, requirement):
+        if requirement not in self._compiled:
+            try:
+                self._compiled[requirement] = compile_requirement(requirement)
+            except RequirementError:
+                self._compiled[requirement] = None
+        return self._compiled[requirement]
+
+    def _canonical_blob(self, blob):
+        if blob not in self._decompiled:
+            try:
+                self._decompiled[blob] = canonical_requirement(format_requirement(decompile_requirement(blob)))
+            except RequirementError:
+                self._decompiled[blob] = None
+        return self._decompiled[blob]
+
+    def matches(self, requirement, blob):
+        if not requirement or blob is None:
+            return not requirement and blob is None
+        elif self._compile(requirement) == blob:
+            return True
+
+        try:
+            return self._canonical_blob(blob) == canonical_requirement(requirement)
+        except RequirementError:
+            return False
+
+
+def _describe(client, client_type, receiver):
+    description = '{} ({})'.format(client, IDENTIFIER_TYPES.get(client_type, client_type))
+    return '{} -> {}'.format(description, receiver) if receiver else description
+
+
+def compare(services, grants):
+    """Joins the profile entries with the grants on (service, client, client type, AppleEvents receiver) through a dict
+    of the grants, so comparing is linear in the number of entries and grants. Returns {service: {'covered': [...],
+    'mismatched': [...], 'missing': [...], 'extra': [...]}} with a description of each entry or grant."""
+    index = dict()
+    for grant in grants:
+        index[(grant['service'], grant['client'], grant['client_type'], grant['receiver'])] = grant
+
+    matcher = RequirementMatcher()
+    report = OrderedDict()
+
+    def service_report(service):
+        name = service[len(SERVICE_PREFIX):] if service.startswith(SERVICE_PREFIX) else service
+        if name not in report:
+            report[name] = OrderedDict((status, []) for status in ('covered', 'mismatched', 'missing', 'extra'))
+        return report[name]
+
+    for payload, entries in services.items():
+        service = SERVICE_PREFIX + payload
+        for entry in entries:
+            client_type = CLIENT_TYPES.get(entry.get('IdentifierType'))
+            receiver = entry.get('AEReceiverIdentifier')
+            description = _describe(entry.get('Identifier'), client_type, receiver)
+            grant = index.pop((service, entry.get('Identifier'), client_type, receiver), None)
+
+            if grant is None:
+                service_report(service)['missing'].append(description)
+                continue
+
+            problems = []
+            if not matcher.matches(entry.get('CodeRequirement'), grant['csreq']):
+                problems.append('code requirement differs')
+            if bool(entry.get('Allowed')) != grant['allowed']:
+                problems.append('allowed in the {}'.format('profile' if entry.get('Allowed') else 'TCC.db'))
+
+            if problems:
+                service_report(service)['mismatched'].append('{}: {}'.format(description, ', '.join(problems)))
+            else:
+                service_report(service)['covered'].append(description)
+
+    for grant in index.values():
+        service_report(grant['service'])['extra'].append(_describe(grant['client'], grant['client_type'], grant['receiver']))
+
+    # Services in the order PrivacyProfiles builds them in, then any others the TCC.db has.
+    order = dict((payload, position) for position, payload in enumerate(PrivacyProfiles.PAYLOADS))
+    return OrderedDict(sorted(report.items(), key=lambda item: (order.get(item[0], len(order)), item[0])))
+
+
+def print_report(report, stream=sys.stdout):
+    """Prints the counts per service, followed by every entry that isn't covered."""
+    print('{:<30} {:>8} {:>10} {:>8} {:>8}'.format('Service', 'Covered', 'Mismatched', 'Missing', 'Extra'), file=stream)
+    for service, statuses in report.items():
+        print('{:<30} {:>8} {:>10} {:>8} {:>8}'.format(service, *[len(items) for items in statuses.values()]), file=stream)
+
+    for service, statuses in report.items():
+        for status in ('mismatched', 'missing', 'extra'):
+            for description in sorted(statuses[status]):
+                print('{}: {} {}'.format(service, status, description), file=stream)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py compare',
+        description='Compare the entries of a profile with the grants in a TCC.db.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'profile',
+        type=str,
+        metavar='<profile path>',
+        help='The profile to compare, signed or unsigned.',
+    )
+
+    parser.add_argument(
+        'tcc_db',
+        type=str,
+        metavar='<TCC.db path>',
+        help='The TCC database to compare with, for example "/Library/Application Support/com.apple.TCC/TCC.db".',
+    )
+
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        dest='json',
+        default=False,
+        help='Print the report as JSON.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    tcc_db = os.path.expanduser(os.path.expandvars(args.tcc_db))
+    if not os.path.exists(tcc_db):
+        print('No TCC database at {}'.format(tcc_db))
+        return 1
+
+    try:
+        grants = read_grants(tcc_db)
+    except sqlite3.Error as e:
+        print('Could not read {}: {}. Reading the TCC databases needs Full Disk Access (and root for the system one).'.format(tcc_db, e))
+        return 1
+
+    report = compare(profile_services(read_profile(args.profile)), grants)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        print_report(report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
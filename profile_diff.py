@@ -0,0 +1,227 @@
+#!/usr/bin/python
+"""Compares two profiles (signed or unsigned) by what they mean rather than how they are written: 'Services' entries
+added and removed per payload type, entries whose 'Allowed' or code requirements changed, and changed header fields.
+The order of entries, the comments and (by default) the UUIDs don't count as changes."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import binascii
+import datetime
+import json
+import sys
+
+from collections import OrderedDict
+
+from profile_merge import describe, profile_services
+from tccprofile import PrivacyProfiles, SaneUsageFormat, read_profile, requirement_key
+
+TCC_PAYLOAD_TYPE = 'com.apple.TCC.configuration-profile-policy'
+
+# What identifies a 'Services' entry between two profiles. The code requirements are compared, not matched on.
+IDENTITY_FIELDS = ('Identifier', 'IdentifierType', 'AEReceiverIdentifier', 'AEReceiverIdentifierType')
+
+REQUIREMENT_FIELDS = ('CodeRequirement', 'AEReceiverCodeRequirement')
+
+
+def _identity(entry):
+    return tuple(entry.get(field) for field in IDENTITY_FIELDS)
+
+
+def _same_requirement(old, new):
+    """Compares requirements as they are first, and only in their canonical form if the text differs."""
+    return old == new or requirement_key(old) == requirement_key(new)
+
+
+def _entry_changes(old, new):
+    """Returns the changes between two entries with the same identity, as a list of (field, old value, new value)."""
+    changes = []
+    if bool(old.get('Allowed')) != bool(new.get('Allowed')):
+        changes.append(('Allowed', bool(old.get('Allowed')), bool(new.get('Allowed'))))
+    for field in REQUIREMENT_FIELDS:
+        if not _same_requirement(old.get(field), new.get(field)):
+            changes.append((field, old.get(field), new.get(field)))
+    return changes
+
+
+def diff_services(old_services, new_services):
+    """Matches the entries of two 'Services' dicts per payload type on their identity through a dict, so diffing is
+    linear in the number of entries. Returns {payload: {'added': [entry], 'removed': [entry], 'changed': [(old entry,
+    new entry, changes)]}} for the payload types with differences, in the order PrivacyProfiles builds them in."""
+    report = dict()
+    for payload in set(old_services) | set(new_services):
+        old_entries = old_services.get(payload, [])
+        new_entries = new_services.get(payload, [])
+
+        # An identity usually has one entry, but can have several (an app listed with two requirements).
+        old_index = OrderedDict()
+        for entry in old_entries:
+            old_index.setdefault(_identity(entry), []).append(entry)
+
+        added = []
+        changed = []
+        for entry in new_entries:
+            candidates = old_index.get(_identity(entry))
+            if not candidates:
+                added.append(entry)
+                continue
+
+            # Prefer an entry with the same requirements, otherwise take the first one with this identity.
+            position = 0
+            if len(candidates) > 1:
+                position = next((position for position, old in enumerate(candidates)
+                                 if all(_same_requirement(old.get(field), entry.get(field)) for field in REQUIREMENT_FIELDS)), 0)
+            old = candidates.pop(position)
+            changes = _entry_changes(old, entry)
+            if changes:
+                changed.append((old, entry, changes))
+
+        removed = [entry for entries in old_index.values() for entry in entries]
+        if added or removed or changed:
+            report[payload] = {'added': added, 'removed': removed, 'changed': changed}
+
+    order = dict((payload, position) for position, payload in enumerate(PrivacyProfiles.PAYLOADS))
+    return OrderedDict(sorted(report.items(), key=lambda item: (order.get(item[0], len(order)), item[0])))
+
+
+def header_fields(profile, uuids=False):
+    """Returns the header fields of a profile and of each of its payloads (other than the TCC 'Services') as a flat dict
+    of 'Key' or 'PayloadType:Key' to value. Without uuids, the UUIDs are left out, including the one the TCC payload
+    identifier ends in."""
+    fields = dict((key, value) for key, value in profile.items() if key != 'PayloadContent')
+    for payload in profile.get('PayloadContent', []):
+        payload_type = payload.get('PayloadType')
+        for key, value in payload.items():
+            if key == 'Services' and payload_type == TCC_PAYLOAD_TYPE:
+                continue
+            if not uuids and key == 'PayloadIdentifier' and payload.get('PayloadUUID'):
+                suffix = '.' + payload['PayloadUUID']
+                value = value[:-len(suffix)] if value.endswith(suffix) else value
+            fields['{}:{}'.format(payload_type, key)] = value
+
+    if not uuids:
+        fields = dict((key, value) for key, value in fields.items() if not key.endswith('PayloadUUID'))
+
+    return fields
+
+
+def diff_headers(old_profile, new_profile, uuids=False):
+    """Returns the changed header fields as a sorted list of (field, old value, new value), None for a missing field."""
+    old_fields = header_fields(old_profile, uuids)
+    new_fields = header_fields(new_profile, uuids)
+    return [(key, old_fields.get(key), new_fields.get(key)) for key in sorted(set(old_fields) | set(new_fields))
+            if old_fields.get(key) != new_fields.get(key)]
+
+
+def diff_profiles(old_profile, new_profile, uuids=False):
+    """Returns the header and 'Services' differences of two profiles, see diff_headers() and diff_services()."""
+    return {
+        'header': diff_headers(old_profile, new_profile, uuids),
+        'services': diff_services(profile_services(old_profile), profile_services(new_profile)),
+    }
+
+
+def _json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    elif isinstance(value, bytes):
+        return binascii.hexlify(value).decode('ascii')
+    return value
+
+
+def as_json(differences):
+    """Returns the differences in a form json can dump."""
+    return {
+        'header': [{'field': key, 'old': _json_value(old), 'new': _json_value(new)} for key, old, new in differences['header']],
+        'services': OrderedDict((payload, {
+            'added': [describe(entry) for entry in changes['added']],
+            'removed': [describe(entry) for entry in changes['removed']],
+            'changed': [{
+                'entry': describe(new),
+                'changes': [{'field': field, 'old': old_value, 'new': new_value} for field, old_value, new_value in entry_changes],
+            } for old, new, entry_changes in changes['changed']],
+        }) for payload, changes in differences['services'].items()),
+    }
+
+
+def print_differences(differences, stream=sys.stdout):
+    """Prints the changed header fields, then per payload type the added (+), removed (-) and changed (~) entries."""
+    for key, old, new in differences['header']:
+        print('header {}: {!r} -> {!r}'.format(key, old, new), file=stream)
+
+    for payload, changes in differences['services'].items():
+        print('{}:'.format(payload), file=stream)
+        for entry in sorted(changes['added'], key=describe):
+            print('  + {}'.format(describe(entry)), file=stream)
+        for entry in sorted(changes['removed'], key=describe):
+            print('  - {}'.format(describe(entry)), file=stream)
+        for old, new, entry_changes in sorted(changes['changed'], key=lambda change: describe(change[1])):
+            for field, old_value, new_value in entry_changes:
+                if field == 'Allowed':
+                    print('  ~ {}: {} -> {}'.format(describe(new), 'allowed' if old_value else 'denied',
+                                                    'allowed' if new_value else 'denied'), file=stream)
+                else:
+                    print('  ~ {}: {} changed'.format(describe(new), field), file=stream)
+                    print('      - {}'.format(old_value), file=stream)
+                    print('      + {}'.format(new_value), file=stream)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py diff',
+        description='Show what changed between two profiles: entries added, removed or changed, and header fields.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'old_profile',
+        type=str,
+        metavar='<old profile>',
+        help='The profile to compare from, signed or unsigned.',
+    )
+
+    parser.add_argument(
+        'new_profile',
+        type=str,
+        metavar='<new profile>',
+        help='The profile to compare to, signed or unsigned.',
+    )
+
+    parser.add_argument(
+        '--uuids',
+        action='store_true',
+        dest='uuids',
+        default=False,
+        help='Also report changed UUIDs, which are new every time a profile is generated unless --deterministic is used.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        dest='json',
+        default=False,
+        help='Print the differences as JSON.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Exits 0 if the profiles are the same, 1 if they differ, like diff does."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    differences = diff_profiles(read_profile(args.old_profile), read_profile(args.new_profile), uuids=args.uuids)
+
+    if args.json:
+        json.dump(as_json(differences), sys.stdout, indent=1)
+        print()
+    else:
+        print_differences(differences)
+
+    return 1 if differences['header'] or differences['services'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+#!/usr/bin/python
+"""Indexes the 'Services' entries of a tree of profiles (signed or unsigned) in an SQLite database, to find which
+profiles grant a service to an app, and with which code requirement, without reading the profiles again.
+
+Updating the index only parses the profiles that are new or have changed since: a profile whose modification time and
+size are unchanged is skipped, and one whose content hash is unchanged is not parsed again."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+from code_requirement import RequirementError, requirement_hash
+from profile_merge import profile_services
+from tccprofile import SaneUsageFormat, loads_profile
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS profiles (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    signed INTEGER NOT NULL,
+    payload_identifier TEXT,
+    payload_display_name TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+    service TEXT NOT NULL,
+    identifier TEXT,
+    identifier_type TEXT,
+    requirement TEXT,
+    requirement_hash TEXT,
+    allowed INTEGER,
+    receiver_identifier TEXT,
+    receiver_identifier_type TEXT,
+    receiver_requirement TEXT,
+    comment TEXT
+);
+CREATE INDEX IF NOT EXISTS profiles_payload_identifier ON profiles (payload_identifier);
+CREATE INDEX IF NOT EXISTS entries_identifier ON entries (identifier, service);
+CREATE INDEX IF NOT EXISTS entries_service ON entries (service);
+CREATE INDEX IF NOT EXISTS entries_requirement_hash ON entries (requirement_hash);
+CREATE INDEX IF NOT EXISTS entries_receiver_identifier ON entries (receiver_identifier);
+CREATE INDEX IF NOT EXISTS entries_profile_id ON entries (profile_id);
+'''
+
+PROFILE_EXTENSIONS = ('.mobileconfig',)
+
+# The columns a query prints, in order.
+RESULT_FIELDS = ['path', 'payload_identifier', 'service', 'identifier', 'identifier_type', 'allowed', 'requirement',
+                 'receiver_identifier']
+
+
+def index_requirement_hash(requirement):
+    """Returns the hash a requirement is indexed by: that of its canonical form, so requirements that only differ in
+    whitespace, quoting or clause order hash the same, or that of its text if it can't be parsed."""
+    if not requirement:
+        return None
+
+    try:
+        return requirement_hash(requirement)
+    except RequirementError:
+        return hashlib.sha1(requirement.encode('utf-8')).hexdigest()
+
+
+def open_index(filename):
+    """Opens (creating if needed) the index database in filename."""
+    connection = sqlite3.connect(filename)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.execute('PRAGMA journal_mode = WAL')
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version not in (0, SCHEMA_VERSION):
+        connection.close()
+        raise sqlite3.DatabaseError('{} is an index of version {}, expected {}'.format(filename, version, SCHEMA_VERSION))
+
+    connection.executescript(SCHEMA)
+    connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    return connection
+
+
+def find_profiles(paths):
+    """Returns the profiles in paths (files, or directories searched recursively)."""
+    profiles = []
+    for path in paths:
+        if os.path.isfile(path):
+            profiles.append(os.path.abspath(path))
+            continue
+
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            profiles.extend(os.path.abspath(os.path.join(directory, filename)) for filename in sorted(filenames)
+                            if filename.lower().endswith(PROFILE_EXTENSIONS))
+
+    return profiles
+
+
+def parse_profile(job):
+    """Reads the profile of a (path, mtime, size, previous sha256) job. Runs in a worker process.
+
+    Returns the path, mtime, size and sha256 of the profile and, unless the content matches the previous sha256, a dict
+    of the profile columns and a list of the entry rows."""
+    path, mtime, size, previous_sha256 = job
+    with open(path, 'rb') as profile_file:
+        data = profile_file.read()
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    if sha256 == previous_sha256:
+        return path, mtime, size, sha256, None, None
+
+    signed = data[:1] == b'\x30'
+    try:
+        profile = loads_profile(data, path)
+    except Exception as e:
+        return path, mtime, size, sha256, {'signed': signed, 'error': str(e)}, []
+
+    entries = []
+    for service, service_entries in profile_services(profile).items():
+        for entry in service_entries:
+            entries.append((
+                service,
+                entry.get('Identifier'),
+                entry.get('IdentifierType'),
+                entry.get('CodeRequirement'),
+                index_requirement_hash(entry.get('CodeRequirement')),
+                None if entry.get('Allowed') is None else int(bool(entry.get('Allowed'))),
+                entry.get('AEReceiverIdentifier'),
+                entry.get('AEReceiverIdentifierType'),
+                entry.get('AEReceiverCodeRequirement'),
+                entry.get('Comment'),
+            ))
+
+    columns = {
+        'signed': signed,
+        'payload_identifier': profile.get('PayloadIdentifier'),
+        'payload_display_name': profile.get('PayloadDisplayName'),
+        'error': None,
+    }
+    return path, mtime, size, sha256, columns, entries
+
+
+def update_index(connection, paths, processes=None):
+    """Brings the index up to date with the profiles in paths, parsing new and changed profiles in parallel. Profiles
+    that were indexed under one of the paths but are gone are removed.
+
+    Returns the counts of profiles 'seen', 'parsed', 'unchanged' (same content, new modification time), 'removed' and
+    'failed' (can't be parsed, indexed without entries)."""
+    roots = [os.path.abspath(path) for path in paths]
+    counts = dict.fromkeys(['seen', 'parsed', 'unchanged', 'removed', 'failed'], 0)
+
+    indexed = dict((path, (profile_id, mtime, size, sha256)) for profile_id, path, mtime, size, sha256 in
+                   connection.execute('SELECT id, path, mtime, size, sha256 FROM profiles'))
+
+    jobs = []
+    seen = set()
+    for path in find_profiles(roots):
+        if path in seen:
+            continue
+        seen.add(path)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        previous = indexed.get(path)
+        if previous and previous[1] == stat.st_mtime and previous[2] == stat.st_size:
+            continue
+        jobs.append((path, stat.st_mtime, stat.st_size, previous[3] if previous else None))
+
+    counts['seen'] = len(seen)
+
+    with connection:
+        gone = [(indexed[path][0],) for path in indexed if path not in seen and
+                any(path == root or path.startswith(root.rstrip('/') + '/') for root in roots)]
+        connection.executemany('DELETE FROM profiles WHERE id = ?', gone)
+        counts['removed'] = len(gone)
+
+        if not jobs:
+            return counts
+
+        # Parsing is CPU bound (plist, CMS and code requirement parsing), so use processes rather than threads.
+        pool = multiprocessing.Pool(processes) if len(jobs) > 1 else None
+        try:
+            results = pool.imap_unordered(parse_profile, jobs, chunksize=16) if pool else map(parse_profile, jobs)
+            for path, mtime, size, sha256, columns, entries in results:
+                if columns is None:
+                    counts['unchanged'] += 1
+                    connection.execute('UPDATE profiles SET mtime = ?, size = ? WHERE path = ?', (mtime, size, path))
+                    continue
+
+                counts['parsed'] += 1
+                counts['failed'] += 1 if columns['error'] else 0
+                connection.execute('DELETE FROM profiles WHERE path = ?', (path,))
+                profile_id = connection.execute(
+                    'INSERT INTO profiles (path, mtime, size, sha256, signed, payload_identifier, payload_display_name, '
+                    'error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, mtime, size, sha256, int(columns['signed']), columns.get('payload_identifier'),
+                     columns.get('payload_display_name'), columns['error'])).lastrowid
+                connection.executemany(
+                    'INSERT INTO entries VALUES ({})'.format(', '.join(['?'] * 11)),
+                    [(profile_id,) + entry for entry in entries])
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    return counts
+
+
+def query_index(connection, identifier=None, service=None, requirement=None, payload_identifier=None,
+                receiver_identifier=None):
+    """Returns the indexed entries matching every given filter as dicts. A requirement matches entries with the same
+    canonical requirement, or can be given as the hash of one."""
+    filters = []
+    values = []
+    for column, value in (('e.identifier', identifier),
+                          ('e.service', service),
+                          ('p.payload_identifier', payload_identifier),
+                          ('e.receiver_identifier', receiver_identifier)):
+        if value is not None:
+            filters.append('{} = ?'.format(column))
+            values.append(value)
+
+    if requirement is not None:
+        filters.append('e.requirement_hash = ?')
+        is_hash = len(requirement) == 40 and all(char in '0123456789abcdef' for char in requirement)
+        values.append(requirement if is_hash else index_requirement_hash(requirement))
+
+    cursor = connection.execute(
+        'SELECT p.path, p.payload_identifier, e.service, e.identifier, e.identifier_type, e.allowed, e.requirement, '
+        'e.receiver_identifier FROM entries e JOIN profiles p ON p.id = e.profile_id {} '
+        'ORDER BY p.path, e.service, e.identifier'.format('WHERE ' + ' AND '.join(filters) if filters else ''),
+        values)
+
+    results = []
+    for row in cursor:
+        result = dict(zip(RESULT_FIELDS, row))
+        result['allowed'] = None if result['allowed'] is None else bool(result['allowed'])
+        results.append(result)
+
+    return results
+
+
+def print_results(results, stream=sys.stdout):
+    """Prints one line per entry: profile, service, identifier (and receiver), allowed, then the requirement."""
+    for result in results:
+        identifier = result['identifier']
+        if result['receiver_identifier']:
+            identifier = '{} -> {}'.format(identifier, result['receiver_identifier'])
+
+        print('{}: {} {} {}'.format(
+            result['path'],
+            result['service'],
+            identifier,
+            'allowed' if result['allowed'] else 'denied',
+        ), file=stream)
+        if result['requirement']:
+            print('    {}'.format(result['requirement']), file=stream)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py index',
+        description='Index the entries of a tree of profiles, and query the index.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'index',
+        type=str,
+        metavar='<index path>',
+        help='The SQLite index to update or query. Created if it does not exist.',
+    )
+
+    parser.add_argument(
+        'paths',
+        type=str,
+        nargs='*',
+        metavar='<profile paths>',
+        help='Profiles, or directories of .mobileconfig files, to add to the index. Profiles that are already indexed '
+             'are only read again if they have changed, and profiles that are gone are removed.',
+    )
+
+    parser.add_argument(
+        '--identifier',
+        type=str,
+        dest='identifier',
+        metavar='<identifier>',
+        help='Find the entries for this bundle identifier or path. Example: com.foo.agent',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--service',
+        type=str,
+        dest='service',
+        metavar='<service>',
+        help='Find the entries for this payload type. Example: Accessibility',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--requirement',
+        type=str,
+        dest='requirement',
+        metavar='<requirement>',
+        help='Find the entries with this code requirement (matched in its canonical form), or the SHA-1 of its '
+             'canonical form.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--receiver',
+        type=str,
+        dest='receiver_identifier',
+        metavar='<identifier>',
+        help='Find the AppleEvents entries with this receiver.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--pi', '--payload-identifier',
+        type=str,
+        dest='payload_identifier',
+        metavar='<payload identifier>',
+        help='Find the entries of the profiles with this PayloadIdentifier.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        dest='json',
+        default=False,
+        help='Print the matching entries as JSON.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    try:
+        connection = open_index(args.index)
+    except sqlite3.Error as e:
+        print('Could not open the index {}: {}'.format(args.index, e))
+        return 1
+
+    try:
+        if args.paths:
+            missing = [path for path in args.paths if not os.path.exists(path)]
+            if missing:
+                print('No such profile or directory: {}'.format(', '.join(missing)))
+                return 1
+
+            start = time.time()
+            counts = update_index(connection, args.paths)
+            print('Indexed {seen} profiles in {elapsed:.1f}s: {parsed} parsed ({failed} failed), {unchanged} unchanged, '
+                  '{removed} removed.'.format(elapsed=time.time() - start, **counts), file=sys.stderr)
+
+        filters = dict((name, getattr(args, name)) for name in
+                       ('identifier', 'service', 'requirement', 'payload_identifier', 'receiver_identifier'))
+        if not args.paths or any(value is not None for value in filters.values()):
+            results = query_index(connection, **filters)
+            if args.json:
+                json.dump(results, sys.stdout, indent=1)
+                print()
+            else:
+                print_results(results)
+    finally:
+        connection.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
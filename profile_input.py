@@ -0,0 +1,120 @@
+#!/usr/bin/python
+"""Reads the apps for a profile as newline delimited JSON records, probing them while the input is still arriving.
+
+Each line is one record: {"service": "AppleEvents", "path": "/Applications/App.app", "override": "/Applications/Other.app",
+"receiver": "/System/Library/CoreServices/Finder.app", "receiver_override": ...}. Only "service" and "path" are needed,
+and "receiver" only for AppleEvents."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import multiprocessing
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from tccprofile import AppSpec, PrivacyProfiles, ProfileBuildError
+
+# Records waiting to be probed. When the probes fall behind, reading stops until there is room again, which in turn
+# blocks whatever is writing the input, rather than the records piling up in memory.
+QUEUE_SIZE = 256
+
+# Probes mostly wait on file and codesign, so run a few more than there are CPUs.
+WORKERS = multiprocessing.cpu_count() * 2
+
+
+def parse_record(line, number):
+    """Returns the (payload type, AppSpec) of an input line."""
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ProfileBuildError('invalid_input', 'Line {}: {}'.format(number, e))
+
+    service = record.get('service') if isinstance(record, dict) else None
+    if service not in PrivacyProfiles.PAYLOADS:
+        raise ProfileBuildError('invalid_input', 'Line {}: unknown service {!r}, expected one of {}'.format(
+            number, service, ', '.join(PrivacyProfiles.PAYLOADS)))
+
+    if not record.get('path'):
+        raise ProfileBuildError('invalid_input', 'Line {}: a path is needed.'.format(number))
+
+    if (service == 'AppleEvents') != bool(record.get('receiver')):
+        raise ProfileBuildError('invalid_input', 'Line {}: a receiver is needed for AppleEvents, and only for AppleEvents.'.format(number))
+
+    return service, AppSpec(
+        path=record['path'],
+        override=record.get('override') or False,
+        receiver_path=record.get('receiver'),
+        receiver_override=record.get('receiver_override') or False,
+    )
+
+
+def _probe(prober, target):
+    """Probes everything the profile needs to know about an app, so building the profile finds it all cached."""
+    path, override = target
+    prober.identifier_and_type(path, override_path=override)
+    prober.code_sign_requirement(path)
+
+
+def read_input(filename, prober, resolve=None, workers=WORKERS, queue_size=QUEUE_SIZE):
+    """Reads the records in filename ('-' for stdin), probing each app with prober as soon as it is read.
+    Returns the apps per payload type, in the form PrivacyProfiles.set_services_dict() takes.
+
+    resolve is called on each AppSpec before it is probed, to replace 'bundle:<identifier>' references with paths
+    (PrivacyProfiles._resolve_bundles). Without it, apps named that way are not probed ahead, but when the profile is
+    built. Repeated records are only kept once, so memory grows with the number of unique apps, not of records."""
+    pending = queue.Queue(maxsize=queue_size)
+
+    def work():
+        while True:
+            target = pending.get()
+            if target is None:
+                return
+            try:
+                _probe(prober, target)
+            except Exception:
+                # Raised again, in input order, when the profile is built. A worker must not die, or the queue fills up.
+                pass
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    app_lists = dict()
+    listed = set()
+    queued = set()
+    stream = sys.stdin if filename == '-' else open(filename, 'r')
+    try:
+        # readline() rather than iterating, which reads ahead in blocks on Python 2 and would hold back the first records.
+        for number, line in enumerate(iter(stream.readline, ''), 1):
+            if not line.strip():
+                continue
+
+            service, spec = parse_record(line, number)
+            if resolve is not None:
+                spec = resolve(spec)
+            if (service, spec.key()) in listed:
+                continue
+            listed.add((service, spec.key()))
+            app_lists.setdefault(service, {'_apps': []})['_apps'].append(spec)
+
+            # Senders and receivers are probed one app at a time, so an app listed many times is only queued once.
+            for target in ((spec.path, spec.override), (spec.receiver_path, spec.receiver_override)):
+                if target[0] and target not in queued and not any(value and 'bundle:' in value for value in target):
+                    queued.add(target)
+                    pending.put(target)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+
+    return app_lists
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+"""Merges several TCC profiles into one compact profile, collapsing duplicate 'Services' entries."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import sys
+
+from collections import OrderedDict
+
+from tccprofile import PrivacyProfiles, SaneUsageFormat, read_profile, service_entry_key
+
+# How to settle two entries with the same identity that disagree on 'Allowed'.
+CONFLICT_POLICIES = ['deny', 'allow', 'first', 'last']
+
+
+def profile_services(profile):
+    """Returns the 'Services' dict of the TCC payload in a profile, or an empty dict if there is none."""
+    for payload in profile.get('PayloadContent', []):
+        if payload.get('PayloadType') == 'com.apple.TCC.configuration-profile-policy':
+            return payload.get('Services', dict())
+
+    return dict()
+
+
+def describe(entry):
+    """Returns 'identifier (type)', with '-> receiver (type)' for AppleEvents entries."""
+    description = '{} ({})'.format(entry.get('Identifier'), entry.get('IdentifierType'))
+    if entry.get('AEReceiverIdentifier'):
+        description += ' -> {} ({})'.format(entry.get('AEReceiverIdentifier'), entry.get('AEReceiverIdentifierType'))
+    return description
+
+
+def _set_allowed(entry, allowed):
+    """Sets 'Allowed' on an entry, and the 'Allow'/'Deny' its comment starts with to match."""
+    entry['Allowed'] = allowed
+    verb, separator, rest = entry.get('Comment', '').partition(' ')
+    if verb in ('Allow', 'Deny'):
+        entry['Comment'] = '{} {}'.format('Allow' if allowed else 'Deny', rest)
+
+
+def merge_services(services_list, conflict='deny'):
+    """Unions the entries of each 'Services' dict in services_list, per payload type.
+
+    Entries are matched on their identity (see service_entry_key) through a dict, so merging is linear in the number
+    of entries. Returns the merged 'Services' dict and a report per payload type: the counts, the entries that were
+    collapsed (as described by describe()), and the conflicts with how each was resolved."""
+    if conflict not in CONFLICT_POLICIES:
+        raise ValueError('Unknown conflict policy {}, expected one of {}'.format(conflict, ', '.join(CONFLICT_POLICIES)))
+
+    merged = OrderedDict()
+    report = OrderedDict()
+    indexes = dict()
+
+    for services in services_list:
+        for payload, entries in services.items():
+            if payload not in merged:
+                merged[payload] = []
+                report[payload] = {'entries': 0, 'duplicates': 0, 'conflicts': 0, 'collapsed': [], 'resolved': []}
+                indexes[payload] = dict()
+
+            payload_entries = merged[payload]
+            payload_report = report[payload]
+            index = indexes[payload]
+
+            for entry in entries:
+                payload_report['entries'] += 1
+                key = service_entry_key(entry)
+                position = index.get(key)
+
+                if position is None:
+                    index[key] = len(payload_entries)
+                    payload_entries.append(dict(entry))
+                    continue
+
+                payload_report['duplicates'] += 1
+                existing = payload_entries[position]
+
+                if existing.get('Allowed') != entry.get('Allowed'):
+                    payload_report['conflicts'] += 1
+
+                    # Payload types that can only be denied are settled that way whatever the policy.
+                    if payload in PrivacyProfiles.DENY_PAYLOADS:
+                        _set_allowed(existing, False)
+                        reason = 'can only be denied'
+                    else:
+                        if conflict == 'deny':
+                            _set_allowed(existing, False)
+                        elif conflict == 'allow':
+                            _set_allowed(existing, True)
+                        elif conflict == 'last':
+                            payload_entries[position] = dict(entry)
+                        reason = '--conflict {}'.format(conflict)
+
+                    resolution = 'allowed' if payload_entries[position].get('Allowed') else 'denied'
+                    payload_report['resolved'].append((describe(entry), '{} ({})'.format(resolution, reason)))
+                else:
+                    payload_report['collapsed'].append(describe(entry))
+                    if conflict == 'last':
+                        payload_entries[position] = dict(entry)
+
+    # Keep payload types in the same order PrivacyProfiles builds them in.
+    order = dict((payload, position) for position, payload in enumerate(PrivacyProfiles.PAYLOADS))
+    merged = OrderedDict(sorted(merged.items(), key=lambda item: order.get(item[0], len(order))))
+
+    return merged, report
+
+
+def print_report(report, stream=sys.stderr):
+    """Prints the merge report, one line per payload type, then the entries that were collapsed and the conflicts."""
+    print('{:<30} {:>8} {:>8} {:>10} {:>10}'.format('Payload', 'Entries', 'Merged', 'Collapsed', 'Conflicts'), file=stream)
+    for payload, counts in report.items():
+        print('{:<30} {:>8} {:>8} {:>10} {:>10}'.format(
+            payload,
+            counts['entries'],
+            counts['entries'] - counts['duplicates'],
+            counts['duplicates'],
+            counts['conflicts'],
+        ), file=stream)
+
+    collapsed = [(payload, description) for payload, counts in report.items() for description in counts['collapsed']]
+    if collapsed:
+        print('\nCollapsed duplicates:', file=stream)
+        for payload, description in collapsed:
+            print('  {}: {}'.format(payload, description), file=stream)
+
+    resolved = [(payload, description, resolution) for payload, counts in report.items() for description, resolution in counts['resolved']]
+    if resolved:
+        print('\nConflicts (allowed in one profile, denied in another):', file=stream)
+        for payload, description, resolution in resolved:
+            print('  {}: {}, resolved to {}'.format(payload, description, resolution), file=stream)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py merge',
+        description='Merge several TCC profiles into one, removing duplicate entries.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'profiles',
+        type=str,
+        nargs='+',
+        metavar='<profile paths>',
+        help='The profiles to merge, signed or unsigned. Header values are taken from the first profile unless '
+             'overridden.',
+    )
+
+    parser.add_argument(
+        '--conflict',
+        type=str,
+        choices=CONFLICT_POLICIES,
+        default='deny',
+        dest='conflict',
+        help='How to resolve entries that are both allowed and denied. "deny" and "allow" pick that value, '
+             '"first" and "last" keep the entry from the first or last profile it appears in. Payload types that '
+             'can only be denied are always resolved to deny. Default: deny',
+        required=False,
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        dest='payload_filename',
+        metavar='payload_filename',
+        help='Filename to save the merged profile as.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--pd', '--payload-description',
+        type=str,
+        dest='payload_description',
+        metavar='payload_description',
+        help='A short and sweet description of the payload.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--pi', '--payload-identifier',
+        type=str,
+        dest='payload_identifier',
+        metavar='payload_identifier',
+        help='An identifier to use for the profile. Example: org.foo.bar',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--pn', '--payload-name',
+        type=str,
+        dest='payload_name',
+        metavar='payload_name',
+        help='A short and sweet name for the payload.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--po', '--payload-org',
+        type=str,
+        dest='payload_org',
+        metavar='payload_org',
+        help='Organization to use for the profile.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--removable',
+        type=str,
+        nargs=1,
+        dest='profile_removal_password',
+        metavar='<password>',
+        help='Sets the profile to only be removable if the password provided '
+        'is used to remove it.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--deterministic',
+        action='store_true',
+        dest='deterministic',
+        default=False,
+        help='Order the entries and derive the UUIDs from the profile content, so merging the same profiles always '
+             'writes the same profile.',
+        required=False
+    )
+
+    parser.add_argument(
+        '-s', '--sign',
+        type=str,
+        nargs=1,
+        dest='sign_profile',
+        metavar='certificate_name',
+        help='Signs the merged profile using the specified Certificate Name.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    profiles = [read_profile(path) for path in args.profiles]
+    services, report = merge_services([profile_services(profile) for profile in profiles], conflict=args.conflict)
+
+    if not services:
+        print('None of the profiles contain a TCC payload to merge.')
+        return 1
+
+    first = profiles[0]
+    tcc_profile = PrivacyProfiles(
+        payload_description=args.payload_description or first.get('PayloadDescription'),
+        payload_name=args.payload_name or first.get('PayloadDisplayName'),
+        payload_identifier=args.payload_identifier or first.get('PayloadIdentifier'),
+        payload_organization=args.payload_org or first.get('PayloadOrganization'),
+        profile_removal_password=args.profile_removal_password,
+        sign_cert=args.sign_profile,
+        filename=args.payload_filename,
+        removal_date=None,
+        timezone=None,
+    )
+    tcc_profile.template['PayloadContent'][0]['Services'] = services
+
+    if args.deterministic:
+        tcc_profile.make_deterministic()
+
+    tcc_profile.write()
+
+    print_report(report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
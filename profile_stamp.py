@@ -0,0 +1,319 @@
+#!/usr/bin/python
+"""Stamps out variants of one profile from an inventory, for example one per department or host. Variants only differ
+in their header fields, so the 'Services' content is built (and probed) once and each variant is spliced together."""
+
+from __future__ import absolute_import, print_function
+
+import binascii
+import csv
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import struct
+import uuid
+
+import pytz
+
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
+
+from tccprofile import PrivacyProfiles, ProfileBuildError, _materialize, _plist_dumps, _services_digest
+
+# The inventory columns (CSV header fields, or NDJSON object keys). Empty or missing values use the command line ones.
+STAMP_FIELDS = ['payload_identifier', 'payload_org', 'removal_password', 'removal_date', 'timezone', 'filename']
+
+# Serialized in place of the removal date, then swapped for a placeholder. Plist dates can't hold one themselves.
+SENTINEL_DATE = datetime.datetime(1901, 1, 1)
+PLIST_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Binary plist dates are seconds since this.
+BINARY_PLIST_EPOCH = datetime.datetime(2001, 1, 1)
+
+# Characters kept from a payload identifier when it names a file, anything else becomes '_'.
+UNSAFE_FILENAME_CHARACTERS = re.compile(r'[^A-Za-z0-9._-]')
+
+
+def read_inventory(filename):
+    """Returns the rows of a CSV (with a header row) or NDJSON inventory file as dicts with the STAMP_FIELDS keys."""
+    with open(filename, 'r') as inventory_file:
+        first_line = inventory_file.readline()
+        inventory_file.seek(0)
+        if first_line.lstrip().startswith('{'):
+            rows = [json.loads(line) for line in inventory_file if line.strip()]
+        else:
+            rows = list(csv.DictReader(inventory_file))
+
+    unknown = set(key for row in rows for key in row if key not in STAMP_FIELDS)
+    if unknown:
+        raise ProfileBuildError(
+            'invalid_inventory',
+            'Unknown inventory columns: {}. Expected: {}'.format(', '.join(sorted(unknown)), ', '.join(STAMP_FIELDS)),
+            path=filename,
+        )
+
+    return [dict((field, (row.get(field) or '').strip() or None) for field in STAMP_FIELDS) for row in rows]
+
+
+def _read_uint(data):
+    return int(binascii.hexlify(data), 16) if data else 0
+
+
+def _pack_uint(value, size):
+    return binascii.unhexlify('{:0{}x}'.format(value, size * 2))
+
+
+def _uint_size(value):
+    """Returns the number of bytes (1, 2, 4 or 8) a binary plist needs for value."""
+    size = 1
+    while value >= 1 << (8 * size):
+        size *= 2
+    return size
+
+
+def _binary_string(text):
+    """Returns text as a binary plist string object: ASCII if it can be, UTF-16 otherwise."""
+    try:
+        data, marker, length = text.encode('ascii'), 0x50, len(text)
+    except UnicodeError:
+        data = text.encode('utf-16-be')
+        marker, length = 0x60, len(data) // 2
+
+    if length < 0xF:
+        return _pack_uint(marker | length, 1) + data
+    size = _uint_size(length)
+    return _pack_uint(marker | 0xF, 1) + _pack_uint(0x10 | (size.bit_length() - 1), 1) + _pack_uint(length, size) + data
+
+
+def _binary_date(date):
+    return b'\x33' + struct.pack('>d', (date - BINARY_PLIST_EPOCH).total_seconds())
+
+
+def _binary_text(data, offset):
+    """Returns the text of the binary plist object at offset, or None if it is not a string."""
+    marker = ord(data[offset:offset + 1])
+    kind, length = marker >> 4, marker & 0xF
+    if kind not in (0x5, 0x6):
+        return None
+
+    start = offset + 1
+    if length == 0xF:
+        size = 1 << (ord(data[start:start + 1]) & 0xF)
+        length = _read_uint(data[start + 1:start + 1 + size])
+        start += 1 + size
+
+    if kind == 0x5:
+        return data[start:start + length].decode('ascii')
+    return data[start:start + 2 * length].decode('utf-16-be')
+
+
+class StampTemplate(object):
+    """A profile serialized once with placeholders for the fields that differ per variant.
+
+    render() only escapes the values and joins them with the pre-serialized pieces, so a variant costs about as much
+    as copying the profile data. The shape of the profile changes with a removal password or date, so there is one
+    StampTemplate per combination used.
+
+    Binary plists are spliced too: the objects holding a placeholder are written again after the other objects, and
+    only their entries in the offset table are changed. The objects they replace are left in place, unreferenced.
+
+    With services_digest, 'Services' is replaced by it and the template renders the XML that deterministic variants
+    derive their UUIDs from (see _content_hash() in tccprofile.py)."""
+    def __init__(self, tcc_profile, removable, expires, services_digest=None):
+        self._plist_format = 'xml' if services_digest else tcc_profile._plist_format
+        self._nonce = uuid.uuid4().hex
+        placeholder = '@{}:{{}}@'.format(self._nonce).format
+
+        template = _materialize(tcc_profile.template)
+        payload = template['PayloadContent'][0]
+        if services_digest:
+            payload['Services'] = services_digest
+
+        template['PayloadIdentifier'] = placeholder('payload_identifier')
+        template['PayloadOrganization'] = placeholder('payload_org')
+        template['PayloadUUID'] = placeholder('profile_uuid')
+        template['PayloadRemovalDisallowed'] = removable
+        payload['PayloadIdentifier'] = '{}.{}'.format(placeholder('payload_identifier'), placeholder('payload_uuid'))
+        payload['PayloadOrganization'] = placeholder('payload_org')
+        payload['PayloadUUID'] = placeholder('payload_uuid')
+
+        payload.pop('RemovalPassword', None)
+        if removable:
+            payload['RemovalPassword'] = placeholder('removal_password')
+
+        template.pop('RemovalDate', None)
+        if expires:
+            template['RemovalDate'] = SENTINEL_DATE
+
+        if self._plist_format == 'binary':
+            self._split_binary(_plist_dumps(template, plist_format='binary'), expires)
+            return
+
+        data = _plist_dumps(template)
+        if expires:
+            data = data.replace(SENTINEL_DATE.strftime(PLIST_DATE_FORMAT).encode('utf-8'), placeholder('removal_date').encode('utf-8'))
+
+        # Literal data and field names alternate: [data, field, data, field, ..., data]
+        self._parts = re.split(b'@' + self._nonce.encode('utf-8') + b':(\\w+)@', data)
+        self._fields = [part.decode('utf-8') for part in self._parts[1::2]]
+
+    def _split_binary(self, data, expires):
+        """Finds the objects of binary plist data that hold a placeholder, and keeps everything else as it is."""
+        trailer = data[-32:]
+        self._ref_size = ord(trailer[7:8])
+        self._count, self._top, table = _read_uint(trailer[8:16]), _read_uint(trailer[16:24]), _read_uint(trailer[24:32])
+        offset_size = ord(trailer[6:7])
+        self._offsets = [_read_uint(data[table + ref * offset_size:table + (ref + 1) * offset_size]) for ref in range(self._count)]
+        self._objects = data[:table]
+        self._tables = dict()
+
+        # (ref, text split into [text, field, text, ..., text]), or (ref, None) for the removal date.
+        self._spliced = []
+        sentinel = _binary_date(SENTINEL_DATE)
+        for ref, offset in enumerate(self._offsets):
+            if expires and data[offset:offset + len(sentinel)] == sentinel:
+                self._spliced.append((ref, None))
+                continue
+            text = _binary_text(data, offset)
+            if text and self._nonce in text:
+                self._spliced.append((ref, re.split('@' + self._nonce + ':(\\w+)@', text)))
+
+    def _offset_table(self, offset_size):
+        """Returns the offset table with offset_size bytes per offset, as the pieces between the spliced objects."""
+        if offset_size not in self._tables:
+            pieces, start = [], 0
+            for ref, parts in self._spliced:
+                pieces.append(b''.join(_pack_uint(offset, offset_size) for offset in self._offsets[start:ref]))
+                start = ref + 1
+            pieces.append(b''.join(_pack_uint(offset, offset_size) for offset in self._offsets[start:]))
+            self._tables[offset_size] = pieces
+        return self._tables[offset_size]
+
+    def _render_binary(self, values):
+        spliced = []
+        for ref, parts in self._spliced:
+            if parts is None:
+                spliced.append(_binary_date(datetime.datetime.strptime(values['removal_date'], PLIST_DATE_FORMAT)))
+            else:
+                parts = list(parts)
+                parts[1::2] = [values[field] for field in parts[1::2]]
+                spliced.append(_binary_string(''.join(parts)))
+
+        offsets, end = [], len(self._objects)
+        for spliced_object in spliced:
+            offsets.append(end)
+            end += len(spliced_object)
+
+        offset_size = _uint_size(end)
+        pieces = self._offset_table(offset_size)
+        table = [pieces[0]]
+        for offset, piece in zip(offsets, pieces[1:]):
+            table.extend([_pack_uint(offset, offset_size), piece])
+
+        trailer = b'\x00' * 6 + _pack_uint(offset_size, 1) + _pack_uint(self._ref_size, 1) + b''.join(
+            _pack_uint(value, 8) for value in (self._count, self._top, end))
+        return b''.join([self._objects] + spliced + table + [trailer])
+
+    def render(self, values):
+        """Returns the profile data with values (a dict of field name to text) spliced in."""
+        if self._plist_format == 'binary':
+            return self._render_binary(values)
+
+        parts = list(self._parts)
+        parts[1::2] = [escape(values[field]).encode('utf-8') for field in self._fields]
+        return b''.join(parts)
+
+
+def _variant_filename(row, tcc_profile):
+    """Returns the filename of a variant: the 'filename' column, or the output filename suffixed with the identifier."""
+    if row['filename']:
+        return tcc_profile._set_filename(row['filename'])
+    elif tcc_profile._filename:
+        base = os.path.splitext(tcc_profile._filename)[0]
+        return '{}_{}.mobileconfig'.format(base, UNSAFE_FILENAME_CHARACTERS.sub('_', row['payload_identifier']))
+
+
+def stamp_profiles(tcc_profile, rows):
+    """Writes (and signs, if the profile is signed) a variant of tcc_profile for each inventory row, in parallel.
+    Raises a ProfileBuildError listing the rows that could not be stamped, after writing all the others."""
+    templates = dict()
+    services_digest = _services_digest(tcc_profile.template) if tcc_profile._deterministic else None
+    variants = []
+    errors = []
+    filenames = set()
+
+    defaults = {
+        'payload_identifier': tcc_profile.payload_identifier,
+        'payload_org': tcc_profile.payload_organization,
+        'removal_password': tcc_profile.profile_removal_password,
+        'removal_date': tcc_profile.removal_date,
+        'timezone': tcc_profile.timezone,
+    }
+
+    for number, row in enumerate(rows, 1):
+        row = dict((field, row[field] or defaults.get(field) or None) for field in STAMP_FIELDS)
+
+        filename = _variant_filename(row, tcc_profile)
+        if not row['payload_identifier'] or not filename:
+            errors.append('Row {}: a payload_identifier and a filename (or -o) are needed.'.format(number))
+            continue
+        elif filename in filenames:
+            errors.append('Row {}: {} is already written by an earlier row.'.format(number, filename))
+            continue
+        filenames.add(filename)
+
+        values = {
+            'payload_identifier': row['payload_identifier'],
+            'payload_org': row['payload_org'] or '',
+            'removal_password': row['removal_password'] or '',
+        }
+
+        if row['removal_date']:
+            if not row['timezone']:
+                errors.append('Row {}: a timezone is needed for the removal date.'.format(number))
+                continue
+            try:
+                removal_date = PrivacyProfiles._utc_formatted_time(local_time=row['removal_date'], timezone=row['timezone'])
+            except (ValueError, pytz.exceptions.InvalidTimeError, pytz.exceptions.UnknownTimeZoneError) as e:
+                errors.append('Row {}: invalid removal date or time zone: {}'.format(number, e))
+                continue
+            values['removal_date'] = removal_date.strftime(PLIST_DATE_FORMAT)
+
+        shape = (bool(row['removal_password']), bool(row['removal_date']))
+        if shape not in templates:
+            templates[shape] = (
+                StampTemplate(tcc_profile, removable=shape[0], expires=shape[1]),
+                StampTemplate(tcc_profile, removable=shape[0], expires=shape[1], services_digest=services_digest)
+                if tcc_profile._deterministic else None,
+            )
+
+        variants.append((filename, templates[shape], values))
+
+    def write(variant):
+        filename, (template, header), values = variant
+        if tcc_profile._deterministic:
+            # The same UUIDs for the same content, as make_deterministic() does for a single profile. Only the header
+            # is rendered for the hash, 'Services' is the same for every variant.
+            content_hash = hashlib.sha256(header.render(dict(values, payload_uuid='', profile_uuid=''))).hexdigest()
+            values['payload_uuid'] = str(uuid.uuid5(uuid.NAMESPACE_DNS, '{}.payload.{}'.format(values['payload_identifier'], content_hash))).upper()
+            values['profile_uuid'] = str(uuid.uuid5(uuid.NAMESPACE_DNS, '{}.{}'.format(values['payload_identifier'], content_hash))).upper()
+        else:
+            values['payload_uuid'] = str(uuid.uuid1()).upper()
+            values['profile_uuid'] = str(uuid.uuid1()).upper()
+
+        return tcc_profile._write_template(template=None, filename=filename, data=template.render(values))
+
+    if variants:
+        pool = ThreadPool(min(len(variants), multiprocessing.cpu_count()))
+        try:
+            written = sum(pool.map(write, variants))
+        finally:
+            pool.close()
+            pool.join()
+
+        print('Stamped {} profiles, {} written, {} unchanged.'.format(len(variants), written, len(variants) - written))
+
+    if errors:
+        raise ProfileBuildError('invalid_inventory', '\n'.join(errors))
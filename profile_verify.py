@@ -0,0 +1,317 @@
+#!/usr/bin/python
+"""Checks that the code requirements in a profile are satisfied by the code on disk, with codesign --verify -R, so a
+stale or mistyped requirement (or override) is found before it reaches a Mac and prompts the user.
+
+Checks run in parallel, and their results are cached by the fingerprint of the code and a hash of the requirement, so
+only code or requirements that changed since the last run are checked again."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from profile_merge import profile_services
+from tccprofile import Prober, ProfileBuildError, SaneUsageFormat, _run_probe, fingerprint, read_profile
+
+CACHE_VERSION = 1
+
+DEFAULT_CACHE = os.path.expanduser('~/Library/Caches/tccprofile/verified.json')
+
+# codesign --verify exits with 3 when the code is validly signed but does not satisfy the requirement.
+REQUIREMENT_FAILED = 3
+
+# Checks mostly wait on the disk and codesign, so run a few more than there are CPUs.
+WORKERS = multiprocessing.cpu_count() * 2
+
+
+def _requirement_digest(requirement):
+    """Hashes the requirement text as it is, which is what codesign checks."""
+    return hashlib.sha1(requirement.encode('utf-8')).hexdigest()[:16]
+
+
+class Check(object):
+    """One requirement checked against the code at a path, and the 'Services' entries it was checked for."""
+    __slots__ = ('path', 'requirement', 'entries', 'passed', 'message', 'cached')
+
+    def __init__(self, path, requirement):
+        self.path = path
+        self.requirement = requirement
+        self.entries = []
+        self.passed = None
+        self.message = None
+        self.cached = False
+
+
+class Verifier(object):
+    """Checks requirements against code, remembering the results in a JSON cache file by (fingerprint of the code, hash
+    of the requirement). Only definite results (satisfied, not satisfied) are cached, not codesign failing to run."""
+    def __init__(self, filename=None, prober=None):
+        self.filename = filename
+        self.results = dict()
+        self._prober = prober or Prober()
+
+    @classmethod
+    def load(cls, filename=None, prober=None):
+        """Reads the cache in filename (DEFAULT_CACHE by default). Starts with an empty cache if there is none yet."""
+        verifier = cls(filename or DEFAULT_CACHE, prober)
+        if os.path.exists(verifier.filename):
+            with open(verifier.filename, 'r') as cache_file:
+                data = json.load(cache_file)
+
+            if data.get('version') == CACHE_VERSION:
+                verifier.results = data['results']
+
+        return verifier
+
+    def save(self):
+        """Writes the cache to its file, replacing the previous one in one go."""
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        temporary = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(temporary, 'w') as cache_file:
+            json.dump({'version': CACHE_VERSION, 'results': self.results}, cache_file, indent=1, sort_keys=True)
+        os.rename(temporary, self.filename)
+
+    def _code_path(self, path):
+        """Returns the path of the code a requirement for path is made from: the interpreter of an unsigned script,
+        like PrivacyProfiles does, otherwise path itself."""
+        if self._prober.mime_type(path=path) in ['x-python', 'x-shellscript'] and not self._prober.is_code_signed(path):
+            return self._prober.interpreter(app_path=path)
+        return path
+
+    def _verify(self, check):
+        try:
+            if not os.path.exists(check.path.rstrip('/')):
+                raise ProfileBuildError('not_found', 'No such file or directory: {}'.format(check.path), path=check.path)
+            code_path = self._code_path(check.path)
+        except ProfileBuildError as e:
+            check.passed, check.message = False, e.message
+            return check
+
+        key = '{}:{}'.format(fingerprint(code_path), _requirement_digest(check.requirement))
+        if key in self.results:
+            check.passed, check.message = self.results[key]
+            check.cached = True
+            return check
+
+        cmd = ['/usr/bin/codesign', '--verify', '-R', '=' + check.requirement, code_path]
+        try:
+            returncode, result, error = _run_probe(cmd, code_path)
+        except OSError as e:
+            check.passed, check.message = False, 'Could not run codesign: {}'.format(e)
+            return check
+
+        # codesign reports as '<path>: <problem>', the path is already in the report.
+        lines = [line.replace(code_path + ': ', '', 1) for line in error.splitlines() if line.strip()]
+        check.passed = returncode == 0
+        check.message = None if check.passed else (lines[-1] if lines else 'codesign exited with {}'.format(returncode))
+        if returncode in (0, REQUIREMENT_FAILED):
+            self.results[key] = [check.passed, check.message]
+
+        return check
+
+    def verify(self, checks, workers=WORKERS):
+        """Runs the checks in parallel, filling in their results. Returns the checks."""
+        if not checks:
+            return checks
+
+        pool = ThreadPool(max(1, min(len(checks), workers)))
+        try:
+            return pool.map(self._verify, checks)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _add_check(checks, path, requirement, description):
+    check = checks.setdefault((path, requirement), Check(path, requirement))
+    check.entries.append(description)
+
+
+def profile_checks(tcc_profile):
+    """Returns the checks for a PrivacyProfiles after build_profile(), from the apps its entries were built from. The
+    requirement made from an app is checked at the path its entry identifies, which is the override path if the app was
+    given as 'path:override', so a stale or mistyped override is found."""
+    checks = dict()
+    for payload, specs in tcc_profile._app_lists.items():
+        for spec in specs:
+            sender = spec.override or spec.path
+            _add_check(checks, sender, tcc_profile._get_code_sign_requirements(spec.path), '{} {}'.format(payload, sender))
+            if spec.receiver_path:
+                receiver = spec.receiver_override or spec.receiver_path
+                _add_check(checks, receiver, tcc_profile._get_code_sign_requirements(spec.receiver_path),
+                           '{} {} -> {}'.format(payload, sender, receiver))
+
+    return sorted(checks.values(), key=lambda check: (check.path, check.requirement))
+
+
+def service_checks(services, bundle_index=None):
+    """Returns the checks for the 'Services' entries of a profile. 'path' identifiers are checked at that path, bundle
+    identifiers at the bundle bundle_index resolves them to (the default bundle index if there is none)."""
+    import bundle_index as bundles
+
+    index = bundle_index or bundles.BundleIndex.load()
+
+    def resolve(identifier, identifier_type):
+        if identifier_type == 'path':
+            return identifier
+        try:
+            return index.resolve(identifier)
+        except ProfileBuildError:
+            return 'bundle:' + identifier  # Reported as not found
+
+    checks = dict()
+    for payload, entries in services.items():
+        for entry in entries:
+            description = '{} {}'.format(payload, entry.get('Identifier'))
+            if entry.get('AEReceiverIdentifier'):
+                description += ' -> {}'.format(entry.get('AEReceiverIdentifier'))
+
+            for prefix in ('', 'AEReceiver'):
+                requirement = entry.get(prefix + 'CodeRequirement')
+                if entry.get(prefix + 'Identifier') and requirement:
+                    path = resolve(entry[prefix + 'Identifier'], entry.get(prefix + 'IdentifierType'))
+                    _add_check(checks, path, requirement, description)
+
+    return sorted(checks.values(), key=lambda check: (check.path, check.requirement))
+
+
+def print_report(checks, stream=sys.stdout, verbose=False):
+    """Prints the failed checks (and with verbose, the passed ones), with the entries they were checked for."""
+    for check in checks:
+        if check.passed and not verbose:
+            continue
+        print('{} {}'.format('PASS' if check.passed else 'FAIL', check.path), file=stream)
+        print('    requirement: {}'.format(check.requirement), file=stream)
+        if not check.passed:
+            print('    {}'.format(check.message), file=stream)
+        for description in check.entries:
+            print('    for {}'.format(description), file=stream)
+
+
+def as_json(checks):
+    return [{
+        'path': check.path,
+        'requirement': check.requirement,
+        'passed': check.passed,
+        'message': check.message,
+        'cached': check.cached,
+        'entries': check.entries,
+    } for check in checks]
+
+
+def verify_profile(tcc_profile, cache=None):
+    """Checks the requirements of a built PrivacyProfiles (the --verify option of tccprofile.py), raises a
+    ProfileBuildError listing the ones the code on disk does not satisfy."""
+    verifier = Verifier.load(cache, tcc_profile._prober)
+    checks = verifier.verify(profile_checks(tcc_profile))
+    verifier.save()
+
+    failed = [check for check in checks if not check.passed]
+    if failed:
+        raise ProfileBuildError('unverified', '{} of {} code requirements are not satisfied by the code on disk:\n{}'.format(
+            len(failed), len(checks), '\n'.join('  {}: {}'.format(check.path, check.message) for check in failed)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='tccprofile.py verify',
+        description='Check that the code on disk satisfies every code requirement in a profile.',
+        formatter_class=SaneUsageFormat,
+    )
+
+    parser.add_argument(
+        'profile',
+        type=str,
+        metavar='<profile>',
+        help='The profile to verify, signed or unsigned.',
+    )
+
+    parser.add_argument(
+        '--bundle-index',
+        type=str,
+        dest='bundle_index',
+        metavar='<index.json>',
+        help='The bundle index that bundle identifiers are resolved to paths with, see the bundle-index command. '
+             'Default: ~/Library/Caches/tccprofile/bundles.json',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--cache',
+        type=str,
+        dest='cache',
+        metavar='<cache.json>',
+        help='The file results are cached in. Default: {}'.format(DEFAULT_CACHE),
+        required=False,
+    )
+
+    parser.add_argument(
+        '--shebang-path',
+        type=str,
+        dest='shebang_path',
+        metavar='<PATH>',
+        help='The PATH that the interpreter of "#!/usr/bin/env python" style scripts is looked up in, as for building. '
+             'Default: the PATH of this process.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        dest='verbose',
+        default=False,
+        help='Also print the requirements that passed.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        dest='json',
+        default=False,
+        help='Print the results as JSON.',
+        required=False,
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Exits 0 if every requirement is satisfied, 1 if not."""
+    import bundle_index
+
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    index = bundle_index.BundleIndex.load(args.bundle_index)
+    checks = service_checks(profile_services(read_profile(args.profile)), index)
+
+    start = time.time()
+    verifier = Verifier.load(args.cache, Prober(search_path=args.shebang_path))
+    checks = verifier.verify(checks)
+    verifier.save()
+
+    if args.json:
+        json.dump(as_json(checks), sys.stdout, indent=1)
+        print()
+    else:
+        print_report(checks, verbose=args.verbose)
+
+    failed = sum(1 for check in checks if not check.passed)
+    print('{} of {} code requirements satisfied in {:.1f}s ({} cached).'.format(
+        len(checks) - failed, len(checks), time.time() - start, sum(1 for check in checks if check.cached)), file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+"""Watches the apps (and manifest files) a profile is built from, and rebuilds the profile when they change."""
+
+from __future__ import absolute_import, print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from tccprofile import fingerprint
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def watched_directories(path):
+    """Returns the directories whose entries change when the app at path is replaced, updated or re-signed.
+    These are the same files fingerprint() looks at."""
+    return [
+        os.path.dirname(path.rstrip('/')) or '/',
+        os.path.join(path, 'Contents'),
+        os.path.join(path, 'Contents/_CodeSignature'),
+    ]
+
+
+class PollingWatcher(object):
+    """Checks every path every interval seconds. Works everywhere, and only costs a few stat() calls per path."""
+    def __init__(self, paths, interval=2.0):
+        self.paths = set(paths)
+        self.interval = interval
+
+    def wait(self, timeout=None):
+        """Blocks for up to timeout seconds (the polling interval by default), returns the paths that may have changed."""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return set(self.paths)
+
+    def refresh(self, paths):
+        pass
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Uses Linux inotify to sleep until something happens in a directory the watched paths live in."""
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.paths = set(paths)
+        self._directories = dict()  # wd -> the paths to check when something happens in that directory
+        self.refresh(self.paths)
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux')
+
+    def refresh(self, paths):
+        """(Re)adds the watches for paths, for example after a bundle was replaced and its old directories went away."""
+        for path in paths:
+            for directory in watched_directories(path):
+                if not os.path.isdir(directory):
+                    continue
+                wd = self._libc.inotify_add_watch(self._fd, directory.encode('utf-8'), WATCH_MASK)
+                if wd >= 0:
+                    self._directories.setdefault(wd, set()).add(path)
+
+    def wait(self, timeout=None):
+        """Blocks for up to timeout seconds (forever by default), returns the paths that may have changed."""
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+
+        if not readable:
+            return set()
+
+        data = os.read(self._fd, 65536)
+        candidates = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            candidates.update(self._directories.get(wd, ()))
+
+        return candidates
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(paths, interval=2.0):
+    """Returns an inotify watcher on Linux, and a polling watcher anywhere else or if inotify can't be used."""
+    if InotifyWatcher.available():
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError):
+            pass
+
+    return PollingWatcher(paths, interval=interval)
+
+
+def wait_for_changes(watcher, fingerprints, debounce=1.0):
+    """Blocks until at least one path has changed, and nothing has changed for debounce seconds after that, so a
+    burst of changes (an app being installed or updated) is handled once. Returns the paths that changed."""
+    changed = set()
+    timeout = None
+
+    while True:
+        changed_now = False
+        for path in watcher.wait(timeout):
+            current = fingerprint(path)
+            if current != fingerprints.get(path):
+                fingerprints[path] = current
+                changed.add(path)
+                changed_now = True
+
+        if changed and not changed_now:
+            return changed
+
+        if changed:
+            timeout = debounce
+
+
+def watch(paths, rebuild, interval=2.0, debounce=1.0):
+    """Calls rebuild(changed paths) each time any of paths change. rebuild returns the paths to watch from then on.
+    Runs until interrupted."""
+    paths = set(paths)
+    fingerprints = dict((path, fingerprint(path)) for path in paths)
+    watcher = make_watcher(paths, interval=interval)
+
+    print('Watching {} paths for changes ({}).'.format(len(paths), type(watcher).__name__), file=sys.stderr)
+
+    try:
+        while True:
+            changed = wait_for_changes(watcher, fingerprints, debounce=debounce)
+            print('Rebuilding after changes to: {}'.format(', '.join(sorted(changed))), file=sys.stderr)
+
+            new_paths = set(rebuild(changed)) - paths
+            for path in new_paths:
+                fingerprints[path] = fingerprint(path)
+            paths |= new_paths
+            watcher.paths = paths
+            watcher.refresh(changed | new_paths)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -6,16 +6,30 @@
 from __future__ import absolute_import, print_function
 
 import argparse
+import binascii
+import cProfile
+import csv
 import datetime
 import errno
+import functools
+import glob
+import hashlib
+import itertools
+import importlib
+import json
+import multiprocessing
 import os
 import plistlib
 import re
 import uuid
 import subprocess
 import sys
+import threading
+import time
 import pytz
 
+from multiprocessing.pool import ThreadPool
+
 # Tkinter
 try:
     # Python 3
@@ -23,22 +37,38 @@ try:
     from tkinter import ttk
     from tkinter import filedialog as tkFileDialog
 except ImportError:
-    # Python 2
-    import Tkinter as tk
-    import ttk
-    import tkFileDialog
+    try:
+        # Python 2
+        import Tkinter as tk
+        import ttk
+        import tkFileDialog
+    except ImportError:
+        # No Tk, so no GUI. Profiles can still be built from the command line.
+        tk = ttk = tkFileDialog = None
 
 # Imports specifically for FoundationPlist
 # PyLint cannot properly find names inside Cocoa libraries, so issues bogus
 # No name 'Foo' in module 'Bar' warnings. Disable them.
 # pylint: disable=E0611
-import AppKit
-from Foundation import NSData  # NOQA
-from Foundation import NSPropertyListSerialization  # NOQA
-from Foundation import NSPropertyListMutableContainers  # NOQA
-from Foundation import NSPropertyListXMLFormat_v1_0  # NOQA
+try:
+    import AppKit
+    from Foundation import NSData  # NOQA
+    from Foundation import NSPropertyListSerialization  # NOQA
+    from Foundation import NSPropertyListMutableContainers  # NOQA
+    from Foundation import NSPropertyListXMLFormat_v1_0  # NOQA
+    from Foundation import NSPropertyListBinaryFormat_v1_0  # NOQA
+except ImportError:
+    # Not on macOS (or without PyObjC), plists are read and written with plistlib instead. Apps can't be probed here,
+    # but profiles can be built from a facts snapshot collected on a Mac (--facts).
+    AppKit = NSData = None
 # pylint: enable=E0611
 
+# Code requirements are matched in their canonical form when code_requirement.py is next to this script.
+try:
+    from code_requirement import RequirementError, canonical_requirement, generic_requirement
+except ImportError:
+    canonical_requirement = generic_requirement = None
+
 # Script details
 __author__ = ['Carl Windus', 'Bryson Tyrrell']
 __license__ = 'Apache License 2.0'
@@ -65,7 +95,218 @@ class TCCProfileException(Exception):
     pass
 
 
-class App(tk.Frame):
+class _NullSpan(object):
+    """The span handed out while tracing is disabled, it records nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """A timed span, recorded as a complete ('X') event when the block it wraps exits."""
+    def __init__(self, tracer, name, category, args):
+        self._tracer = tracer
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        if exc_type is not None:
+            self._args['error'] = repr(exc_value)
+        self._tracer.record(self._name, self._category, self._start, end, self._args)
+        return False
+
+    def set(self, **args):
+        """Adds args that are only known inside the span, like an exit code."""
+        self._args.update(args)
+
+
+class Tracer(object):
+    """Records spans for each probe subprocess and pipeline stage, written out in the Chrome trace event format
+    (chrome://tracing, Perfetto, speedscope). While disabled, span() hands back a shared no-op span."""
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._lock = threading.Lock()
+
+    def span(self, name, category='stage', **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def record(self, name, category, start, end, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with self._lock:
+            self._events.append(event)
+
+    def dump(self, filename):
+        with self._lock:
+            events = list(self._events)
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+# Enabled with --trace
+TRACE = Tracer()
+
+
+def traced(method):
+    """Decorator recording a span for each call of a pipeline stage."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with TRACE.span(method.__name__):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def _run_probe(cmd, path):
+    """Runs a probe command against path, returns its (returncode, stdout, stderr)."""
+    with TRACE.span(os.path.basename(cmd[0]), category='probe', path=path) as span:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        result, error = process.communicate()
+        span.set(exit_code=process.returncode)
+
+    return process.returncode, result, error
+
+
+class TableModel(object):
+    """The rows of a GUI table, kept apart from the widget that shows them.
+
+    Rows are held by row id, so adding and removing a row is O(1). The display order is a list of row ids, which is
+    only compacted when rows are read back after removals."""
+    def __init__(self):
+        self._rows = dict()
+        self._order = []
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, values):
+        """Adds a row at the end, returns its row id."""
+        row_id = 'row{}'.format(self._next_id)
+        self._next_id += 1
+        self._rows[row_id] = tuple(values)
+        self._order.append(row_id)
+        return row_id
+
+    def extend(self, rows):
+        for values in rows:
+            self.add(values)
+
+    def remove(self, row_id):
+        self._rows.pop(row_id, None)
+
+    def _compact(self):
+        if len(self._order) != len(self._rows):
+            self._order = [row_id for row_id in self._order if row_id in self._rows]
+
+    def window(self, first, count):
+        """Returns the (row id, values) of count rows from position first."""
+        self._compact()
+        return [(row_id, self._rows[row_id]) for row_id in self._order[first:first + count]]
+
+    def rows(self):
+        """Returns the values of every row, in order."""
+        self._compact()
+        return [self._rows[row_id] for row_id in self._order]
+
+
+class VirtualTable(tk.Frame if tk else object):
+    """A Treeview with a scrollbar that only ever holds the rows in view, read from a TableModel. Scrolling replaces
+    those few rows, so the table stays responsive however many rows the model has."""
+    def __init__(self, master, columns, headings, height=5):
+        tk.Frame.__init__(self, master)
+        self.model = TableModel()
+        self._height = height
+        self._first = 0
+        self._selected = set()
+
+        self.tree = ttk.Treeview(self, columns=columns, height=height, selectmode='extended')
+        self.tree['show'] = 'headings'
+        for column, heading in zip(columns, headings):
+            self.tree.heading(column, text=heading)
+        self.tree.grid(row=0, column=0, sticky='we')
+
+        self.scrollbar = ttk.Scrollbar(self, orient='vertical', command=self._scroll)
+        self.scrollbar.grid(row=0, column=1, sticky='ns')
+        self.columnconfigure(0, weight=1)
+
+        self.tree.bind('<<TreeviewSelect>>', self._track_selection)
+        self.tree.bind('<MouseWheel>', lambda event: self._scroll('scroll', -1 if event.delta > 0 else 1, 'units'))
+        self.tree.bind('<Button-4>', lambda event: self._scroll('scroll', -1, 'units'))
+        self.tree.bind('<Button-5>', lambda event: self._scroll('scroll', 1, 'units'))
+
+    def add(self, values):
+        self.model.add(values)
+        self.render()
+
+    def extend(self, rows):
+        """Adds many rows at once, drawing the table once."""
+        self.model.extend(rows)
+        self.render()
+
+    def remove_selected(self):
+        """Removes the selected rows, including selected rows scrolled out of view."""
+        for row_id in self._selected:
+            self.model.remove(row_id)
+        self._selected.clear()
+        self.render()
+
+    def _track_selection(self, event=None):
+        visible = set(self.tree.get_children())
+        self._selected = (self._selected - visible) | set(self.tree.selection())
+
+    def _scroll(self, action, amount, unit=None):
+        """Handles the scrollbar (and mouse wheel): 'moveto' a fraction, or 'scroll' by units or pages."""
+        if action == 'moveto':
+            first = int(float(amount) * len(self.model))
+        else:
+            first = self._first + int(amount) * (self._height if unit == 'pages' else 1)
+        self._first = first
+        self.render()
+
+    def render(self):
+        """Shows the rows in view."""
+        count = len(self.model)
+        self._first = max(0, min(self._first, count - self._height))
+        rows = self.model.window(self._first, self._height)
+
+        self.tree.delete(*self.tree.get_children())
+        for row_id, values in rows:
+            self.tree.insert('', 'end', iid=row_id, values=values)
+        self.tree.selection_set([row_id for row_id, values in rows if row_id in self._selected])
+
+        if count > self._height:
+            self.scrollbar.set(float(self._first) / count, float(self._first + self._height) / count)
+        else:
+            self.scrollbar.set(0, 1)
+
+
+class App(tk.Frame if tk else object):
     def __init__(self, master):
         tk.Frame.__init__(self, master)
         self.pack()
@@ -220,23 +461,23 @@ class App(tk.Frame):
             command=self._add_service
         ).grid(row=2, column=4, sticky='e')
 
-        self.services_table = ttk.Treeview(
+        self.services_table = VirtualTable(
             services_frame,
             columns=('target', 'service', 'allow_deny'),
+            headings=('Target', 'Service', 'Allow/Deny'),
             height=5
         )
-        self.services_table['show'] = 'headings'
-
-        self.services_table.heading('target', text='Target')
-
-        self.services_table.heading('service', text='Service')
-        self.services_table.column('service', anchor='center')
-
-        self.services_table.heading('allow_deny', text='Allow/Deny')
-        self.services_table.column('allow_deny', anchor='center')
+        self.services_table.tree.column('service', anchor='center')
+        self.services_table.tree.column('allow_deny', anchor='center')
 
         self.services_table.grid(row=3, column=0, columnspan=5, sticky='we')
 
+        tk.Button(
+            services_frame,
+            text='Import...',
+            command=self._import_services
+        ).grid(row=4, column=0, sticky='w')
+
         tk.Button(
             services_frame,
             text='Remove -',
@@ -299,14 +540,20 @@ class App(tk.Frame):
             command=self._add_apple_event
         ).grid(row=2, column=4, sticky='e')
 
-        self.app_env_table = ttk.Treeview(
-            apple_events_frame, columns=('source', 'target'), height=5
+        self.app_env_table = VirtualTable(
+            apple_events_frame,
+            columns=('source', 'target'),
+            headings=('Source', 'Target'),
+            height=5
         )
-        self.app_env_table['show'] = 'headings'
-        self.app_env_table.heading('source', text='Source')
-        self.app_env_table.heading('target', text='Target')
         self.app_env_table.grid(row=3, column=0, columnspan=5, sticky='we')
 
+        tk.Button(
+            apple_events_frame,
+            text='Import...',
+            command=self._import_apple_events
+        ).grid(row=4, column=0, sticky='w')
+
         tk.Button(
             apple_events_frame,
             text='Remove -',
@@ -341,21 +588,18 @@ class App(tk.Frame):
 
         app_lists = dict()
 
-        for child in self.services_table.get_children():
-            values = self.services_table.item(child)["values"]
+        for values in self.services_table.model.rows():
             if not app_lists.get(values[1]):
                 app_lists[values[1]] = {'_apps': list(), 'apps': list()}
 
             # app_lists[values[1]].append(values[0])
             app_lists[values[1]]['_apps'].append(values[0])
 
-        for child in self.app_env_table.get_children():
+        for values in self.app_env_table.model.rows():
             if not app_lists.get('AppleEvents'):
                 app_lists['AppleEvents'] = {'_apps': list(), 'apps': list()}
 
-            app_lists['AppleEvents']['_apps'].append(
-                ','.join(self.app_env_table.item(child)["values"])
-            )
+            app_lists['AppleEvents']['_apps'].append(','.join(values))
 
         if not any(app_lists.keys()):
             self._feedback_label['text'] = 'You must provide at least one ' \
@@ -385,9 +629,13 @@ class App(tk.Frame):
             timezone=None,
         )
 
-        tcc_profile.set_services_dict(app_lists)
-        tcc_profile.build_profile(allow=True)
-        tcc_profile.write()
+        try:
+            tcc_profile.set_services_dict(app_lists)
+            tcc_profile.build_profile(allow=True)
+            tcc_profile.write()
+        except ProfileBuildError as e:
+            self._feedback_label['text'] = e.message
+            return
 
         self._feedback_label['text'] = ''
 
@@ -427,7 +675,7 @@ class App(tk.Frame):
             print('Source and Target not both provided')
             return
 
-        self.app_env_table.insert('', 'end', values=(source_app, target_app))
+        self.app_env_table.add((source_app, target_app))
         self._app_env_target_var.set('')
         self._app_env_source_var.set('')
         self._app_env_source_var_display.set('')
@@ -443,27 +691,59 @@ class App(tk.Frame):
             print('Target app not provided')
             return
 
-        self.services_table.insert(
-            '', 'end',
-            values=(target_app, selected_service, allow_deny)
-        )
+        self.services_table.add((target_app, selected_service, allow_deny))
         self._services_target_var.set('')
         self._services_target_var_display.set('')
 
     def _remove_table_item(self, table):
-        treeview_obj = getattr(self, table)
-        selected_items = treeview_obj.selection()
+        getattr(self, table).remove_selected()
 
-        for item in selected_items:
-            treeview_obj.delete(item)
+    def _read_table_file(self):
+        """Asks for a text or CSV file and returns its rows, skipping blank lines and # comments."""
+        filename = tkFileDialog.askopenfilename(
+            parent=self,
+            filetypes=[('Text or CSV', '.txt .csv'), ('All files', '*')],
+            title='Import...'
+        )
+        if not filename:
+            return []
+
+        with open(filename, 'r') as table_file:
+            return [[value.strip() for value in row] for row in csv.reader(table_file)
+                    if row and row[0].strip() and not row[0].startswith('#')]
+
+    def _import_services(self):
+        """Imports 'path[,service]' rows, using the selected service for rows without one."""
+        rows = []
+        skipped = 0
+        for row in self._read_table_file():
+            service = row[1] if len(row) > 1 and row[1] else self._selected_service.get()
+            if service not in self._available_services:
+                skipped += 1
+                continue
+            rows.append((row[0], service, 'Allow' if self._available_services[service] else 'Deny'))
+
+        self.services_table.extend(rows)
+        self._feedback_label['text'] = 'Imported {} apps{}'.format(len(rows), ', skipped {} with an unknown service'.format(skipped) if skipped else '')
+
+    def _import_apple_events(self):
+        """Imports 'source,target' rows."""
+        rows = [(row[0], row[1]) for row in self._read_table_file() if len(row) > 1 and row[1]]
+        self.app_env_table.extend(rows)
+        self._feedback_label['text'] = 'Imported {} Apple Events'.format(len(rows))
 
 
 def read_plist(filepath):
     """Read a .plist file from filepath. Return the unpacked root object (which is usually a dictionary)."""
-    plistData = NSData.dataWithContentsOfFile_(filepath)
-    dataObject, dummy_plistFormat, error = (
-        NSPropertyListSerialization.
-        propertyListFromData_mutabilityOption_format_errorDescription_(plistData, NSPropertyListMutableContainers, None, None))
+    with TRACE.span('read_plist', category='probe', path=filepath):
+        if NSData is None:
+            with open(filepath, 'rb') as plist_file:
+                return _plist_loads(plist_file.read())
+
+        plistData = NSData.dataWithContentsOfFile_(filepath)
+        dataObject, dummy_plistFormat, error = (
+            NSPropertyListSerialization.
+            propertyListFromData_mutabilityOption_format_errorDescription_(plistData, NSPropertyListMutableContainers, None, None))
     if dataObject is None:
         if error:
             error = error.encode('ascii', 'ignore')
@@ -475,11 +755,711 @@ def read_plist(filepath):
         return dataObject
 
 
+def _plist_loads(data):
+    """Unpack plist data (XML or binary) into its root object."""
+    if hasattr(plistlib, 'loads'):
+        return plistlib.loads(data)
+    elif data.startswith(b'bplist00'):
+        # The Python 2 plistlib only reads XML, so binary plists go through Foundation.
+        plistData = NSData.dataWithBytes_length_(data, len(data))
+        dataObject, dummy_plistFormat, error = (
+            NSPropertyListSerialization.
+            propertyListFromData_mutabilityOption_format_errorDescription_(plistData, NSPropertyListMutableContainers, None, None))
+        if dataObject is None:
+            raise NSPropertyListSerializationException(error or 'Unknown error')
+        return dataObject
+    else:
+        return plistlib.readPlistFromString(data)
+
+
+# The formats a profile can be written out in.
+PLIST_FORMATS = ['xml', 'binary']
+
+
+def _plist_dumps(value, plist_format='xml'):
+    """Pack value into XML or binary (bplist00) plist data."""
+    if plist_format == 'binary':
+        if hasattr(plistlib, 'FMT_BINARY'):
+            return plistlib.dumps(value, fmt=plistlib.FMT_BINARY)
+
+        # The Python 2 plistlib only writes XML, so binary plists go through Foundation.
+        # Both writers store each distinct string once in the object table, however often it is referenced.
+        plistData, error = NSPropertyListSerialization.dataWithPropertyList_format_options_error_(value, NSPropertyListBinaryFormat_v1_0, 0, None)
+        if plistData is None:
+            raise ProfileBuildError('probe_failed', 'Could not write a binary plist: {}'.format(error or 'Unknown error'))
+        return plistData.getBytes_length_(None, plistData.length())
+    elif hasattr(plistlib, 'dumps'):
+        return plistlib.dumps(value)
+    else:
+        return plistlib.writePlistToString(value)
+
+
+def _ber_element(data, offset):
+    """Returns the (tag, content start, content end, element end) of the BER element at offset. Indefinite lengths are walked to their end-of-contents marker."""
+    tag = ord(data[offset:offset + 1])
+    length = ord(data[offset + 1:offset + 2])
+    offset += 2
+
+    if length == 0x80:
+        # Indefinite length, only allowed for constructed elements, ends at the first top level 0x00 0x00.
+        content_end = offset
+        while data[content_end:content_end + 2] != b'\x00\x00':
+            content_end = _ber_element(data, content_end)[3]
+        return tag, offset, content_end, content_end + 2
+    elif length & 0x80:
+        count = length & 0x7f
+        length = int(binascii.hexlify(data[offset:offset + count]), 16)
+        offset += count
+
+    return tag, offset, offset + length, offset + length
+
+
+def _ber_children(data, start, end):
+    """Yields the (tag, content start, content end) of each element between start and end."""
+    while start < end:
+        tag, content_start, content_end, start = _ber_element(data, start)
+        yield tag, content_start, content_end
+
+
+def _ber_octets(data, tag, start, end):
+    """Returns the bytes of an OCTET STRING, joining the segments of a constructed one."""
+    if tag & 0x20:
+        return b''.join(_ber_octets(data, *child) for child in _ber_children(data, start, end))
+    return data[start:end]
+
+
+def _cms_content(data):
+    """Returns the signed content of a CMS (PKCS#7) SignedData envelope, as written by `security cms -S`."""
+    try:
+        # ContentInfo { contentType, [0] SignedData { version, digestAlgorithms, encapContentInfo { eContentType, [0] eContent } } }
+        content_info = list(_ber_children(data, *_ber_element(data, 0)[1:3]))
+        signed_data = list(_ber_children(data, *content_info[1][1:]))
+        signed_data = list(_ber_children(data, *signed_data[0][1:]))
+        encap_content_info = list(_ber_children(data, *signed_data[2][1:]))
+        econtent = list(_ber_children(data, *encap_content_info[1][1:]))[0]
+        return _ber_octets(data, *econtent)
+    except (IndexError, TypeError, ValueError):
+        raise NSPropertyListSerializationException('Could not unwrap the signed profile content')
+
+
+def loads_profile(data, filepath='<data>'):
+    """Unpack the contents of a .mobileconfig file, signed or unsigned. Return the profile dictionary."""
+    # Unsigned profiles are plain plists, signed profiles start with a DER SEQUENCE tag.
+    if data[:1] == b'\x30':
+        data = _cms_content(data)
+
+    try:
+        return _plist_loads(data)
+    except Exception as e:
+        raise NSPropertyListSerializationException('{} in file {}'.format(e, filepath))
+
+
+def read_profile(filepath):
+    """Read a .mobileconfig file from filepath, signed or unsigned. Return the unpacked profile dictionary."""
+    with open(filepath, 'rb') as profile_file:
+        return loads_profile(profile_file.read(), filepath)
+
+
+# The keys that identify an entry in a 'Services' payload. Any other key ('Allowed', 'Comment') is a setting of that entry.
+SERVICE_KEY_FIELDS = (
+    'Identifier',
+    'IdentifierType',
+    'CodeRequirement',
+    'AEReceiverIdentifier',
+    'AEReceiverIdentifierType',
+    'AEReceiverCodeRequirement',
+)
+
+
+def requirement_key(requirement):
+    """Returns the canonical form of a code requirement, so requirements that only differ in whitespace, quoting or
+    clause order match. Requirements that can't be parsed are matched as they are."""
+    if requirement and canonical_requirement:
+        try:
+            return canonical_requirement(requirement)
+        except RequirementError:
+            pass
+
+    return requirement
+
+
+def service_entry_key(entry):
+    """Returns the hashable identity of a 'Services' entry, with the code requirements in their canonical form."""
+    return tuple(requirement_key(entry.get(field)) if field.endswith('CodeRequirement') else entry.get(field) for field in SERVICE_KEY_FIELDS)
+
+
+def _canonical_entry_key(entry):
+    """Returns a sort key that puts 'Services' entries in a stable order, regardless of the order they were added in."""
+    return tuple('' if value is None else value for value in service_entry_key(entry)) + (bool(entry.get('Allowed')), entry.get('Comment') or '')
+
+
+def _file_digest(filename):
+    """Returns the SHA-256 hex digest of a file, or None if the file does not exist."""
+    try:
+        with open(filename, 'rb') as existing_file:
+            return hashlib.sha256(existing_file.read()).hexdigest()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _xml_text_size(text):
+    """Returns the size in bytes of text once XML escaped and UTF-8 encoded."""
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return len(text) + 4 * text.count(b'&') + 3 * (text.count(b'<') + text.count(b'>'))
+
+
+def _plist_xml_size(value, depth=0):
+    """Returns the size in bytes plistlib writes value out as, one tab indented element per line, without serializing it."""
+    indent = depth + 1  # The tabs, plus the newline at the end of the line.
+    if isinstance(value, bool):
+        return indent + (7 if value else 8)  # <true/> or <false/>
+    elif isinstance(value, dict):
+        if not value:
+            return indent + 7  # <dict/>
+        size = indent * 2 + 13  # <dict> and </dict>
+        for key, item in value.items():
+            size += indent + 1 + 11 + _xml_text_size(key)  # <key>...</key>
+            size += _plist_xml_size(item, depth + 1)
+        return size
+    elif isinstance(value, (list, tuple)):
+        if not value:
+            return indent + 8  # <array/>
+        return indent * 2 + 15 + sum(_plist_xml_size(item, depth + 1) for item in value)  # <array> and </array>
+    elif isinstance(value, int):
+        return indent + 19 + len(str(value))  # <integer>...</integer>
+    elif isinstance(value, float):
+        return indent + 13 + len(repr(value))  # <real>...</real>
+    elif isinstance(value, datetime.datetime):
+        return indent + 33  # <date>YYYY-MM-DDTHH:MM:SSZ</date>
+    elif isinstance(value, getattr(plistlib, 'Data', ())) or (bytes is not str and isinstance(value, bytes)):
+        # <data> and </data> around base64 lines, each as indented as <data> and as long as fits in 76 columns.
+        data = getattr(value, 'data', value)
+        line_bytes = max(16, 76 - 8 * depth) // 4 * 3
+        lines = [len(data[start:start + line_bytes]) for start in range(0, len(data), line_bytes)]
+        return indent * 2 + 13 + sum(indent + (length + 2) // 3 * 4 for length in lines)
+    else:
+        return indent + 17 + _xml_text_size(value)  # <string>...</string>
+
+
 class PrivacyProfilesException(Exception):
     """Basic error handling for PrivacyProfiles()"""
     pass
 
 
+class ProfileBuildError(PrivacyProfilesException):
+    """An input or probe problem that stops a profile being built.
+
+    code is a short machine readable reason, path the app it concerns (if any) and message the human readable text."""
+    def __init__(self, code, message, path=None):
+        PrivacyProfilesException.__init__(self, message)
+        self.code = code
+        self.message = message
+        self.path = path
+
+    def as_dict(self):
+        return {'code': self.code, 'message': self.message, 'path': self.path}
+
+
+class _PendingProbe(object):
+    """A probe one thread is running, that other threads wait on for its value or error."""
+    __slots__ = ('thread', 'value', 'error', '_done')
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Prober(object):
+    """Probes apps on disk for the values that go into a profile: mime type, code signing state and requirement,
+    identifier and identifier type.
+
+    Results are remembered per path, so one Prober can be shared by any number of profile builds (and threads)
+    and each app is only probed once. Use forget() when an app changes on disk.
+
+    search_path is the PATH that '#!/usr/bin/env python' style shebangs are resolved against, defaulting to the PATH
+    of this process."""
+    # Scripts are usually a line or two of shebang, anything longer than this is not one.
+    MAX_SHEBANG_LENGTH = 4096
+
+    def __init__(self, search_path=None):
+        self._cache = dict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self.search_path = search_path or os.environ.get('PATH', os.defpath)
+
+    def _memoize(self, probe, key, func):
+        """Returns the remembered result of a probe for key, running func to get it the first time. Threads asking for
+        a probe that is already running wait for its result rather than running it again. Errors are not remembered,
+        but are raised to the threads that waited for them."""
+        try:
+            return self._cache[(probe, key)]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if (probe, key) in self._cache:
+                return self._cache[(probe, key)]
+            running = self._pending.get((probe, key))
+            if running is None:
+                pending = self._pending[(probe, key)] = _PendingProbe()
+
+        if running is not None:
+            if running.thread is not threading.current_thread():
+                return running.wait()
+            return func()  # A probe that needs itself, leave it to fail the way it would without the wait.
+
+        try:
+            value = func()
+        except BaseException as e:
+            with self._lock:
+                if self._pending.get((probe, key)) is pending:
+                    del self._pending[(probe, key)]
+            pending.finish(error=e)
+            raise
+
+        with self._lock:
+            self._cache[(probe, key)] = value
+            if self._pending.get((probe, key)) is pending:  # Not if it was abandoned
+                del self._pending[(probe, key)]
+        pending.finish(value=value)
+
+        return value
+
+    # The probes remembered per path that make up a facts snapshot, see facts().
+    FACTS = ('mime_type', 'code_signed', 'interpreter', 'requirement', 'signing_info')
+
+    def facts(self):
+        """Returns everything probed so far as a JSON serializable snapshot: {path: {fingerprint, mime_type, code_signed,
+        interpreter, requirement, identifiers: {override path or '': {identifier, identifier_type}}}}."""
+        facts = dict()
+        with self._lock:
+            cache = list(self._cache.items())
+
+        for (probe, key), value in cache:
+            if probe in self.FACTS:
+                facts.setdefault(key, dict())[probe] = value
+            elif probe == 'identifier':
+                path, override = key
+                facts.setdefault(path, dict()).setdefault('identifiers', dict())[override or ''] = value
+
+        for path, record in facts.items():
+            record['fingerprint'] = fingerprint(path)
+
+        return facts
+
+    def record(self, path, overrides=(False,)):
+        """Returns the record of path in a facts snapshot (see facts()), with the identifiers for overrides. Looks up
+        only what was probed for path, however much else has been probed."""
+        with self._lock:
+            record = dict((probe, self._cache[(probe, path)]) for probe in self.FACTS if (probe, path) in self._cache)
+            identifiers = dict((override or '', self._cache[('identifier', (path, override or False))])
+                               for override in overrides if ('identifier', (path, override or False)) in self._cache)
+
+        if identifiers:
+            record['identifiers'] = identifiers
+        record['fingerprint'] = fingerprint(path)
+        return record
+
+    def probed(self, path, override=False, signing_info=False):
+        """Returns if everything a profile entry needs of the app at path is remembered, so building it won't probe."""
+        with self._lock:
+            return (('requirement', path) in self._cache and ('identifier', (path, override or False)) in self._cache and
+                    (not signing_info or ('signing_info', path) in self._cache))
+
+    def probed_nested(self, path):
+        """Returns if the code nested in the bundle at path has been found (see nested())."""
+        with self._lock:
+            return ('nested', path) in self._cache
+
+    def nested(self, path, find):
+        """Returns the paths of the code nested in the bundle at path, found with find(path) the first time."""
+        return self._memoize('nested', path, lambda: find(path))
+
+    def load_facts(self, facts):
+        """Remembers the records of a facts snapshot as if they had been probed."""
+        with self._lock:
+            for path, record in facts.items():
+                for probe in self.FACTS:
+                    if probe in record:
+                        self._cache[(probe, path)] = record[probe]
+                for override, value in record.get('identifiers', dict()).items():
+                    self._cache[('identifier', (path, override or False))] = value
+
+    def forget(self, path):
+        """Drops every remembered result involving path."""
+        with self._lock:
+            for probe, key in list(self._cache):
+                if key == path or (isinstance(key, tuple) and path in key):
+                    del self._cache[(probe, key)]
+
+    def abandon(self, path):
+        """Stops sharing the running probes involving path, so the next call for them starts a new probe rather than
+        waiting on one that is stalled. The abandoned probes are left to finish (or not) for the threads already waiting."""
+        with self._lock:
+            for probe, key in list(self._pending):
+                if key == path or (isinstance(key, tuple) and path in key):
+                    del self._pending[(probe, key)]
+
+    @staticmethod
+    def is_accessible(path):
+        """Returns if the path is accessible to the current user running this utility. Raises an error if not readable."""
+        if os.access(path, os.R_OK):  # Only need to determine if read access is possible
+            return True
+        else:
+            raise ProfileBuildError('permission_denied', 'Permission denied accessing {}'.format(path), path=path)
+
+    def mime_type(self, path):
+        """Returns the mimetype of a given file."""
+        return self._memoize('mime_type', path, lambda: self._mime_type(path))
+
+    @staticmethod
+    def _mime_type(path):
+        if os.path.exists(path.rstrip('/')):
+            cmd = ['/usr/bin/file', '--mime-type', path]
+            returncode, result, error = _run_probe(cmd, path)
+
+            if returncode is 0:
+                # Only need the mime type, so return the last bit
+                result = result.replace(' ', '').replace('\n', '').split(':')[1].split('/')[1]
+                return result
+
+    def is_code_signed(self, path):
+        """Returns True/False if specified path is code signed or not."""
+        return self._memoize('code_signed', path, lambda: self._is_code_signed(path))
+
+    @staticmethod
+    def _is_code_signed(path):
+        cmd = ['/usr/bin/codesign', '-dr', '-', path]
+        returncode, result, error = _run_probe(cmd, path)
+
+        if returncode is 0:
+            return True
+        elif returncode is 1 and 'not signed' in error:
+            return False
+
+    def signing_info(self, path):
+        """Returns the fields `codesign -dvv` shows for the signature of path as a dict, with the certificate chain as
+        a list under 'Authority' (leaf first). Returns an empty dict if path is not signed."""
+        return self._memoize('signing_info', path, lambda: self._signing_info(path))
+
+    @staticmethod
+    def _signing_info(path):
+        cmd = ['/usr/bin/codesign', '-dvv', path]
+        returncode, result, error = _run_probe(cmd, path)
+
+        info = dict()
+        if returncode == 0:
+            # codesign writes the details to stderr, one 'Key=Value' per line.
+            for line in error.splitlines():
+                key, separator, value = line.partition('=')
+                if not separator:
+                    continue
+                if key == 'Authority':
+                    info.setdefault('Authority', []).append(value)
+                else:
+                    info.setdefault(key, value)
+
+        return info
+
+    def team_identifier(self, path):
+        """Returns the team identifier the app at path is signed with, or None if it is not signed by a team (unsigned,
+        ad-hoc or Apple platform binaries)."""
+        team = self.signing_info(path).get('TeamIdentifier')
+        return team if team and team != 'not set' else None
+
+    def interpreter(self, app_path):
+        """Returns the real path of the interpreter a script runs with, from its shebang."""
+        return self._memoize('interpreter', app_path, lambda: self._interpreter(app_path))
+
+    def _interpreter(self, app_path):
+        # Only the first line is needed, so don't read any more of the script than that.
+        with open(app_path, 'rb') as script:
+            line = script.readline(self.MAX_SHEBANG_LENGTH).decode('utf-8', 'replace').strip()
+
+        words = line[2:].split() if line.startswith('#!') else []
+        if not words:
+            raise ProfileBuildError('no_interpreter', 'Script at {} has no shebang to find its interpreter from.'.format(app_path), path=app_path)
+
+        interpreter = words[0]
+        if os.path.basename(interpreter) == 'env':
+            interpreter = self._env_program(words[1:], app_path)
+
+        # Symlinks like /usr/bin/python -> python2.7 are signed as the file they point to.
+        return os.path.realpath(interpreter)
+
+    def _env_program(self, words, app_path):
+        """Returns the path of the program '/usr/bin/env [options] [NAME=value] program' would run."""
+        search_path = self.search_path
+        words = list(words)
+
+        while words:
+            word = words.pop(0)
+            if word in ('-u', '-C'):
+                words = words[1:]  # Option with an argument that doesn't change which program runs
+            elif word == '-P':
+                search_path = words.pop(0) if words else search_path
+            elif word.startswith('-') or '=' in word:
+                continue  # Other options (-i, -S, -v) and environment assignments
+            else:
+                return self.which(word, search_path)
+
+        raise ProfileBuildError('no_interpreter', 'Script at {} has an env shebang without a program.'.format(app_path), path=app_path)
+
+    def which(self, program, search_path=None):
+        """Returns the path of program found in search_path (the Prober search_path by default), like `which` does."""
+        search_path = search_path or self.search_path
+        return self._memoize('which', (program, search_path), lambda: self._which(program, search_path))
+
+    @staticmethod
+    def _which(program, search_path):
+        if os.sep in program:
+            return program
+
+        for directory in search_path.split(os.pathsep):
+            candidate = os.path.join(directory, program)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+
+        raise ProfileBuildError('interpreter_not_found', 'Could not find {} in {}'.format(program, search_path), path=program)
+
+    def code_sign_requirement(self, path):
+        """Returns the values for the CodeRequirement key."""
+        return self._memoize('requirement', path, lambda: self._code_sign_requirement(path))
+
+    def _code_sign_requirement(self, path):
+        # Make sure the path exists and is readable.
+        if os.path.exists(path.rstrip('/')) and self.is_accessible(path.rstrip('/')):
+            # Handle situations where path is a script, and shebang is
+            # ['/bin/sh', '/bin/bash', '/usr/bin/python']
+            mimetype = self.mime_type(path=path)
+
+            if mimetype in ['x-python', 'x-shellscript']:
+                if not self.is_code_signed(path):  # Only use the interpreter if a script is not code signed
+                    interpreter = self.interpreter(app_path=path)
+                    if interpreter == os.path.realpath(path):
+                        raise ProfileBuildError('no_interpreter', 'Script at {} names itself as its interpreter.'.format(path), path=path)
+
+                    # Remembered per interpreter, so scripts sharing /bin/bash only probe it once.
+                    return self.code_sign_requirement(interpreter)
+
+            cmd = ['/usr/bin/codesign', '-dr', '-', path]
+            returncode, result, error = _run_probe(cmd, path)
+
+            if returncode is 0:
+                # For some reason, part of the output gets dumped to stderr, but the bit we need goes to stdout
+                # Also, there can be multiple lines in the result, so handle this properly
+                # There are circumstances where the codesign 'designated => ' is not the start of the line, so handle these.
+                result = [line for line in result.rstrip('\n').splitlines() if 'designated => ' in line]
+                if not result:
+                    raise ProfileBuildError('probe_failed', 'codesign reported no designated requirement for {}.'.format(path), path=path)
+                return result[0].partition('designated => ')[2]
+            elif returncode is 1 and 'not signed' in error:
+                raise ProfileBuildError('not_signed', 'App at {} is not signed.'.format(path), path=path)
+            else:
+                raise ProfileBuildError('probe_failed', 'codesign could not read the requirement of {}: {}'.format(
+                    path, error.strip() or 'exited with {}'.format(returncode)), path=path)
+        else:
+            raise ProfileBuildError('not_found', '{}: {}'.format(os.strerror(errno.ENOENT), path), path=path)
+
+    def identifier_and_type(self, app_path, override_path=False):
+        """Checks file type, and returns appropriate values for `Identifier`and `IdentifierType` keys in the final profile payload."""
+        return self._memoize('identifier', (app_path, override_path), lambda: self._identifier_and_type(app_path, override_path))
+
+    def _identifier_and_type(self, app_path, override_path=False):
+        # Only change the app_path to the override path if '.app' is not the file extension, because app's should have CFBundleIdentifier payload
+        # in the App/Contents/Info.plist file
+        if override_path and os.path.splitext(override_path)[1] != '.app' and os.path.splitext(app_path)[1] != '.app':
+            app_path = override_path.rstrip('/') if override_path else app_path.rstrip('/')
+
+        # Determine mimetype
+        mimetype = self.mime_type(path=app_path)
+
+        # Check for mimetype of file
+        if mimetype in ['x-shellscript', 'x-python']:
+            identifier = app_path
+            identifier_type = 'path'
+        else:
+            try:
+                identifier = read_plist(os.path.join(app_path.rstrip('/'), 'Contents/Info.plist'))['CFBundleIdentifier']
+                identifier_type = 'bundleID'
+            except Exception:
+                identifier = app_path
+                identifier_type = 'path'
+
+        return {'identifier': identifier, 'identifier_type': identifier_type}
+
+
+class FactsProber(Prober):
+    """A Prober that only answers from a facts snapshot (see the collect-facts command), never touching the filesystem or
+    running a subprocess. Profiles can then be built on machines that are not a Mac, or don't have the apps installed."""
+    def __init__(self, facts, search_path=None):
+        Prober.__init__(self, search_path=search_path)
+        self.load_facts(facts)
+
+    def _memoize(self, probe, key, func):
+        try:
+            return self._cache[(probe, key)]
+        except KeyError:
+            path = key[0] if isinstance(key, tuple) else key
+            raise ProfileBuildError('missing_fact', 'The facts snapshot has no {} for {}, collect facts for it again.'.format(probe, path), path=path)
+
+
+def fingerprint(path):
+    """Returns a short value that changes when the app at path is changed: the size, inode, and mtime and ctime (to the
+    nanosecond where the OS keeps them) of the path, and for bundles also of the files that change when a bundle is
+    updated or re-signed. A rewrite to the same size within the same second still changes the ctime, if not the mtime."""
+    parts = []
+    for part in (path, os.path.join(path, 'Contents/Info.plist'), os.path.join(path, 'Contents/_CodeSignature/CodeResources')):
+        try:
+            stat = os.stat(part)
+        except OSError:
+            continue
+        parts.append('{}:{}:{}:{}'.format(
+            stat.st_size,
+            stat.st_ino,
+            getattr(stat, 'st_mtime_ns', repr(stat.st_mtime)),
+            getattr(stat, 'st_ctime_ns', repr(stat.st_ctime)),
+        ))
+
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16] if parts else None
+
+
+def read_facts(filename):
+    """Reads a facts snapshot written by the collect-facts command, returns its facts."""
+    with open(filename, 'r') as facts_file:
+        return json.load(facts_file)['facts']
+
+
+class AppSpec(object):
+    """An app listed for a payload type, and for AppleEvents the app receiving the events."""
+    __slots__ = ('path', 'override', 'receiver_path', 'receiver_override')
+
+    def __init__(self, path, override=False, receiver_path=None, receiver_override=False):
+        self.path = path
+        self.override = override
+        self.receiver_path = receiver_path
+        self.receiver_override = receiver_override
+
+    def key(self):
+        return (self.path, self.override, self.receiver_path, self.receiver_override)
+
+
+class ServiceEntry(object):
+    """An entry in a 'Services' payload type of a built profile.
+
+    AppleEvents matrices can run to 100k entries, so entries are slotted and share their strings with each other.
+    They become plist dicts (see as_dict()) only when the profile is serialized. The comment is made from the app names
+    on demand rather than stored."""
+    __slots__ = (
+        'payload', 'allowed', 'identifier', 'identifier_type', 'code_requirement', 'app_name',
+        'receiver_identifier', 'receiver_identifier_type', 'receiver_code_requirement', 'receiver_app_name',
+    )
+
+    # The profile key each attribute is written out as
+    KEYS = {
+        'Allowed': 'allowed',
+        'CodeRequirement': 'code_requirement',
+        'Identifier': 'identifier',
+        'IdentifierType': 'identifier_type',
+        'AEReceiverIdentifier': 'receiver_identifier',
+        'AEReceiverIdentifierType': 'receiver_identifier_type',
+        'AEReceiverCodeRequirement': 'receiver_code_requirement',
+    }
+
+    def __init__(self, payload, allowed, identifier, identifier_type, code_requirement, app_name,
+                 receiver_identifier=None, receiver_identifier_type=None, receiver_code_requirement=None, receiver_app_name=None):
+        self.payload = payload
+        self.allowed = allowed
+        self.identifier = identifier
+        self.identifier_type = identifier_type
+        self.code_requirement = code_requirement
+        self.app_name = app_name
+        self.receiver_identifier = receiver_identifier
+        self.receiver_identifier_type = receiver_identifier_type
+        self.receiver_code_requirement = receiver_code_requirement
+        self.receiver_app_name = receiver_app_name
+
+    @property
+    def comment(self):
+        allow_statement = 'Allow' if self.allowed else 'Deny'
+        if self.receiver_identifier is not None:
+            return '{} {} to send {} control to {}'.format(allow_statement, self.app_name, self.payload, self.receiver_app_name)
+        else:
+            return '{} {} control for {}'.format(allow_statement, self.payload, self.app_name)
+
+    def key(self):
+        """The same identity as service_entry_key() returns for the dict of this entry."""
+        return (self.identifier, self.identifier_type, requirement_key(self.code_requirement),
+                self.receiver_identifier, self.receiver_identifier_type, requirement_key(self.receiver_code_requirement))
+
+    def get(self, key, default=None):
+        """Looks up a profile key, the same as on the dict of this entry."""
+        if key == 'Comment':
+            return self.comment
+
+        value = getattr(self, self.KEYS[key]) if key in self.KEYS else None
+        return default if value is None else value
+
+    def as_dict(self):
+        result = {
+            'Allowed': self.allowed,
+            'CodeRequirement': self.code_requirement,
+            'Comment': self.comment,
+            'Identifier': self.identifier,
+            'IdentifierType': self.identifier_type,
+        }
+
+        # If the payload is an AppleEvent type, there are additional
+        # requirements relating to the receiving app.
+        if self.receiver_identifier is not None:
+            result['AEReceiverIdentifier'] = self.receiver_identifier
+            result['AEReceiverIdentifierType'] = self.receiver_identifier_type
+            result['AEReceiverCodeRequirement'] = self.receiver_code_requirement
+
+        return result
+
+
+def _entry_dict(entry):
+    """Returns the plist dict of a 'Services' entry, which is either a ServiceEntry or already a dict."""
+    return entry.as_dict() if isinstance(entry, ServiceEntry) else entry
+
+
+def _materialize(template):
+    """Returns a copy of a profile template with its 'Services' entries as plist dicts, ready to serialize."""
+    payload = dict(template['PayloadContent'][0])
+    payload['Services'] = dict((name, [_entry_dict(entry) for entry in entries]) for name, entries in payload['Services'].items())
+    return dict(template, PayloadContent=[payload] + template['PayloadContent'][1:])
+
+
+def _services_digest(template):
+    """Returns the SHA-256 hex digest of the serialized 'Services' of a profile template."""
+    return hashlib.sha256(_plist_dumps(_materialize(template)['PayloadContent'][0]['Services'])).hexdigest()
+
+
+def _content_hash(template):
+    """Returns the hash that make_deterministic() derives the UUIDs from: of the profile with the digest of its
+    'Services' in their place. Variants that only differ in their header (see profile_stamp.py) then only hash that."""
+    header = dict(template)
+    header['PayloadContent'] = [dict(template['PayloadContent'][0], Services=_services_digest(template))] + template['PayloadContent'][1:]
+    return hashlib.sha256(_plist_dumps(header)).hexdigest()
+
+
 class PrivacyProfiles(object):
     """Class for Privacy Profiles Creation"""
     # List of Payload types to iterate on because lazy code is good code
@@ -516,7 +1496,8 @@ class PrivacyProfiles(object):
 
     def __init__(self, payload_description, payload_name, payload_identifier,
                  payload_organization, profile_removal_password,
-                 sign_cert, filename, removal_date, timezone):
+                 sign_cert, filename, removal_date, timezone, plist_format='xml', prober=None, bundle_index=None,
+                 generic_requirements=False):
         """Creates a Privacy Preferences Policy Control Profile for macOS Mojave."""
         # Init the things to put in the template, and elsewhere
         self.payload_description = payload_description
@@ -573,15 +1554,30 @@ class PrivacyProfiles(object):
         self.timezone = self._set_timezone(timezone)
 
         if self.removal_date and self.timezone:
-            self.template['RemovalDate'] = self._utc_formatted_time(local_time=self.removal_date, timezone=self.timezone)
+            try:
+                self.template['RemovalDate'] = self._utc_formatted_time(local_time=self.removal_date, timezone=self.timezone)
+            except (ValueError, pytz.exceptions.InvalidTimeError, pytz.exceptions.UnknownTimeZoneError) as e:
+                raise ProfileBuildError('invalid_removal_date', 'Invalid removal date or time zone: {}'.format(e))
         elif self.removal_date and not self.timezone:
-            print('A time zone for the target Mac must be provided when specifying a removal date. For example: --timezone="Australia/Brisbane"')
-            print('The time zone of the target is used as the time zone on the profile build machine may differ.')
-            sys.exit(1)
+            raise ProfileBuildError(
+                'missing_timezone',
+                'A time zone for the target Mac must be provided when specifying a removal date. For example: --timezone="Australia/Brisbane"\n'
+                'The time zone of the target is used as the time zone on the profile build machine may differ.'
+            )
 
         self._app_lists = dict()
         self._sign_cert = self._set_sign_profile(sign_cert)
         self._filename = self._set_filename(filename)
+        self._plist_format = plist_format
+        self._deterministic = False
+        self.content_hash = None
+        # The (path, volume kind, problem) of apps left out because they could not be probed, see probe_volumes.py.
+        self.skipped_apps = []
+        self._prober = prober or Prober()
+        self._strings = dict()
+        self._bundle_index_file = bundle_index
+        self._bundles = None
+        self._generic_requirements = generic_requirements
 
     @staticmethod
     def _utc_formatted_time(local_time, timezone):
@@ -603,38 +1599,33 @@ class PrivacyProfiles(object):
                 # skipping forward straight to 03:00
                 raise e
 
-            utc_time = local_time.astimezone(pytz.utc)
+            # Plist dates are always UTC and carry no time zone. The binary plist writer refuses an aware datetime.
+            utc_time = local_time.astimezone(pytz.utc).replace(tzinfo=None)
 
             return utc_time
 
         except Exception:
             raise
 
-    @staticmethod
-    def _is_accessible(path):
-        """Returns if the path is accessible to the current user running this utility. Exits with error if not readable."""
-        if os.access(path, os.R_OK):  # Only need to determine if read access is possible
-            return True
-        else:
-            raise PrivacyProfilesException(errno.EACCES, 'Permission denied accessing {}'.format(path))
-
+    @traced
     def set_services_dict(self, args):
         if not isinstance(args, dict):
             arguments = vars(args)
             app_lists = dict()
             # apple_events_apps = arguments.get('events_apps_list', False)
 
-            # Make sure AppleEvents apps are splitabble
-            if arguments.get('events_apps_list', False) is not None and not all([len(app.split(',')) == 2 for app in arguments.get('events_apps_list', False)]):
-                print('AppleEvents applications must be in the format of /Application/Path/EventSending.app,/Application/Path/EventReceiving.app')
-                print('or')
-                print('/Volumes/ExtDisk/Path/EventSending.app:/Application/OverridePath/EventSending.app,/Volumes/ExtDisk/Path/EventReceiving.app:/Application/OverridePath/EventReceiving.app')
-                sys.exit(1)
-
             # Build up args to pass to the class init
             app_lists['Accessibility'] = {'_apps': arguments.get('accessibility_apps_list', False), 'apps': list()}
             app_lists['AddressBook'] = {'_apps': arguments.get('address_book_apps_list', False), 'apps': list()}
             app_lists['AppleEvents'] = {'_apps': arguments.get('events_apps_list', False), 'apps': list()}
+            if arguments.get('events_senders_apps_list') is not None:
+                app_lists['AppleEvents']['_apps'] = itertools.chain(
+                    app_lists['AppleEvents']['_apps'] or [],
+                    self.apple_event_matrix(
+                        [self._resolve_bundles(app) for app in arguments['events_senders_apps_list']],
+                        [self._resolve_bundles(app) for app in arguments.get('events_receivers_apps_list') or []],
+                    ),
+                )
             app_lists['Calendar'] = {'_apps': arguments.get('calendar_apps_list', False), 'apps': list()}
             app_lists['Camera'] = {'_apps': arguments.get('camera_apps_list', False), 'apps': list()}
             app_lists['FileProviderPresence'] = {'_apps': arguments.get('file_providers_apps_list', False), 'apps': list()}
@@ -656,142 +1647,369 @@ class PrivacyProfiles(object):
         else:
             app_lists = args
 
+        # Make sure AppleEvents apps are splitabble. AppleEvents apps can be a generator (see apple_event_matrix()), so
+        # they are checked as they are parsed rather than iterated over twice.
+        def check_apple_event(app):
+            if not isinstance(app, AppSpec) and len(app.split(',')) != 2:
+                raise ProfileBuildError(
+                    'invalid_apple_event',
+                    'AppleEvents applications must be in the format of /Application/Path/EventSending.app,/Application/Path/EventReceiving.app\n'
+                    'or\n'
+                    '/Volumes/ExtDisk/Path/EventSending.app:/Application/OverridePath/EventSending.app,/Volumes/ExtDisk/Path/EventReceiving.app:/Application/OverridePath/EventReceiving.app'
+                )
+
+        apple_events_apps = app_lists.get('AppleEvents', dict()).get('_apps')
+        if isinstance(apple_events_apps, list):
+            for app in apple_events_apps:
+                check_apple_event(app)
+
+        # Parse each app string once (apps can also be given as AppSpecs), dropping repeats.
+        self._app_lists = dict()
         for key in app_lists.keys():
             if app_lists[key]['_apps'] is not None:
+                specs = self._app_lists[key] = []
+                seen = set()
                 for app in app_lists[key]['_apps']:
-                    value = dict()
-                    sending_app = app.split(',')[0]
-                    receiving_app = app.split(',')[1] if ',' in app else False
-
-                    value['sending_app_path'] = sending_app.split(':')[0] if ':' in sending_app else sending_app
-                    value['sending_app_path_override'] = app.split(':')[1] if ':' in app else False
-
-                    if key == 'AppleEvents' and app.count(',') == 1:
-                        receiving_app = app.split(',')[1]
-                        if sending_app.count(':') > 1 or receiving_app.count(':') > 1:
-                            print('Too many \':\' characters in AppleEvents app string. One \':\' per sender and recever app is excpected.')
-                            sys.exit(1)
-                        else:
-                            value['sending_app_path'] = sending_app.split(':')[0] if ':' in sending_app else value['sending_app_path']
-                            value['sending_app_path_override'] = sending_app.split(':')[1] if ':' in sending_app else False
-                            if receiving_app:
-                                value['receiving_app_path'] = receiving_app.split(':')[0]
-                                value['receiving_app_path_override'] = receiving_app.split(':')[1] if ':' in receiving_app else False
-                    if value not in app_lists[key]['apps']:
-                        app_lists[key]['apps'].append(value)
-
-        # Remove all None values in dict
-        for key in app_lists.keys():
-            if app_lists[key]['_apps'] is None:
-                del app_lists[key]
-            else:
-                # Get rid of the _apps as it's no longer required
-                app_lists[key] = app_lists[key]['apps']
+                    if key == 'AppleEvents':
+                        check_apple_event(app)
+                    if isinstance(app, AppSpec):
+                        spec = self._resolve_bundles(app)
+                    else:
+                        spec = self._parse_app(self._resolve_bundles(app), apple_event=key == 'AppleEvents')
+                    if spec.key() not in seen:
+                        seen.add(spec.key())
+                        specs.append(spec)
 
         # Handle if no payload arguments are supplied,
         # Can't create an empty profile.
-        if not any(app_lists.keys()):
-            print('You must provide at least one payload type to create a profile.')
-            raise TCCProfileException
-
-        self._app_lists = app_lists
+        if not any(self._app_lists.keys()):
+            raise ProfileBuildError('no_payloads', 'You must provide at least one payload type to create a profile.')
 
         # Create payload lists in the services_dict
         for payload in self.PAYLOADS:
-            if app_lists.get(payload):
+            if self._app_lists.get(payload):
                 self.template['PayloadContent'][0]['Services'][payload] = []
 
+    def _resolve_bundles(self, app):
+        """Returns an app string (or AppSpec) with each 'bundle:<identifier>' reference in it replaced by the path of
+        that bundle, looked up in the bundle index (see bundle_index.py). The index is only loaded if it is needed."""
+        values = app.key() if isinstance(app, AppSpec) else (app,)
+        if not any(value and 'bundle:' in value for value in values):
+            return app
+
+        if self._bundles is None:
+            import bundle_index
+            self._bundles = bundle_index.BundleIndex.load(self._bundle_index_file)
+
+        if isinstance(app, AppSpec):
+            return AppSpec(*[self._bundles.resolve_references(value) if value else value for value in values])
+        return self._bundles.resolve_references(app)
+
+    def remove_apps(self, paths):
+        """Leaves the apps in paths (as senders or receivers) out of the profile, before it is built."""
+        paths = set(paths)
+        services = self.template['PayloadContent'][0]['Services']
+        for payload, specs in list(self._app_lists.items()):
+            specs[:] = [spec for spec in specs if spec.path not in paths and spec.receiver_path not in paths]
+            if not specs:
+                del self._app_lists[payload]
+                services.pop(payload, None)
+
+        if not self._app_lists:
+            raise ProfileBuildError('no_payloads', 'None of the apps are left to create a profile with.')
+
+    def app_paths(self):
+        """Returns the paths of every app (senders and receivers) the profile is built from."""
+        paths = set()
+        for specs in self._app_lists.values():
+            for spec in specs:
+                paths.add(spec.path)
+                if spec.receiver_path:
+                    paths.add(spec.receiver_path)
+
+        return paths
+
+    @staticmethod
+    def _parse_app(app, apple_event=False):
+        """Returns the AppSpec for an app string: 'path', 'path:override', or 'sender[:override],receiver[:override]' for AppleEvents."""
+        sending_app = app.split(',')[0]
+        spec = AppSpec(
+            path=sending_app.split(':')[0] if ':' in sending_app else sending_app,
+            override=app.split(':')[1] if ':' in app else False,
+        )
+
+        if apple_event and app.count(',') == 1:
+            receiving_app = app.split(',')[1]
+            if sending_app.count(':') > 1 or receiving_app.count(':') > 1:
+                raise ProfileBuildError('invalid_apple_event', 'Too many \':\' characters in AppleEvents app string. One \':\' per sender and recever app is excpected.', path=app)
+
+            spec.override = sending_app.split(':')[1] if ':' in sending_app else False
+            if receiving_app:
+                spec.receiver_path = receiving_app.split(':')[0]
+                spec.receiver_override = receiving_app.split(':')[1] if ':' in receiving_app else False
+
+        return spec
+
+    @staticmethod
+    def _expand_apps(patterns):
+        """Returns the (path, override) of every app in patterns: 'path', 'path:override' or a glob such as
+        '/Applications/*.app'. Each app is listed once, in the order the patterns give them."""
+        apps = []
+        seen = set()
+        for pattern in patterns:
+            if pattern.count(':') > 1:
+                raise ProfileBuildError('invalid_apple_event', 'Too many \':\' characters in app string. One \':\' per app is expected.', path=pattern)
+
+            path, override = pattern.split(':') if ':' in pattern else (pattern, False)
+            if glob.has_magic(path):
+                paths = sorted(glob.glob(path))
+                if not paths:
+                    raise ProfileBuildError('not_found', 'No apps match {}'.format(path), path=pattern)
+                elif override and len(paths) > 1:
+                    raise ProfileBuildError('invalid_apple_event', 'An override path can only be given for a single app, {} matches {} apps.'.format(path, len(paths)), path=pattern)
+            else:
+                paths = [path]
+
+            for path in paths:
+                if path not in seen:
+                    seen.add(path)
+                    apps.append((path, override))
+
+        return apps
+
+    @staticmethod
+    def apple_event_matrix(senders, receivers):
+        """Yields an AppleEvents AppSpec for every sender and receiver pair, senders and receivers being lists of apps
+        (or globs, see _expand_apps()). Both lists are expanded up front, the pairs are only made as they are used.
+
+        Each app is probed once however many pairs it is in, so building the N x M entries costs N + M probes."""
+        senders = PrivacyProfiles._expand_apps(senders)
+        receivers = PrivacyProfiles._expand_apps(receivers)
+        for path, override in senders:
+            for receiver_path, receiver_override in receivers:
+                yield AppSpec(path=path, override=override, receiver_path=receiver_path, receiver_override=receiver_override)
+
     @staticmethod
     def _app_name(app_obj):
         return os.path.basename(os.path.splitext(app_obj)[0])
 
+    @traced
     def build_profile(self, allow):
         """Builds the profile out into the full dict required to write as a plist or to stdout."""
+        services = self.template['PayloadContent'][0]['Services']
+
+        # Many entries share the same requirement, identifier and app name strings, so keep one copy of each.
+        def intern(value):
+            return self._strings.setdefault(value, value)
+
+        def seen_key(entry):
+            """Two entries are the same if their identity and the app names their comment is made from are the same."""
+            return entry.key() + (entry.app_name, entry.receiver_app_name)
+
         for payload in self.PAYLOADS:
             if self._app_lists.get(payload):
+                # For any payload that can only be set to 'Deny', change settings to enforce.
+                allowed = False if payload in self.DENY_PAYLOADS or not allow else allow
+                entries = services[payload]
+                seen = set(seen_key(entry) for entry in entries)
+
                 for app in self._app_lists[payload]:
                     # Common payload values
-                    sending_app = dict()
-                    sending_app['path'] = app['sending_app_path']
-                    sending_app['path_override'] = app.get('sending_app_path_override', False)
-                    sending_app['codesign_result'] = self._get_code_sign_requirements(path=sending_app['path'])
-                    sending_app['app_name'] = self._app_name(app_obj=sending_app['path'])
-
-                    app_identifier_type = self._get_identifier_and_type(app_path=sending_app['path'], override_path=sending_app['path_override'])
-                    sending_app['identifier'] = app_identifier_type['identifier']
-                    sending_app['identifier_type'] = app_identifier_type['identifier_type']
-
-                    # For any payload that can only be set to 'Deny', change settings to enforce.
-                    if payload in self.DENY_PAYLOADS or not allow:
-                        _allow = False
-                        allow_statement = 'Deny'
-                    else:
-                        _allow = allow
-                        allow_statement = 'Allow'
+                    app_identifier_type = self._get_identifier_and_type(app_path=app.path, override_path=app.override)
+                    entry = ServiceEntry(
+                        payload=payload,
+                        allowed=allowed,
+                        identifier=intern(app_identifier_type['identifier']),
+                        identifier_type=app_identifier_type['identifier_type'],
+                        code_requirement=intern(self._get_code_sign_requirements(path=app.path)),
+                        app_name=intern(self._app_name(app_obj=app.path)),
+                    )
 
                     # Add details about the receiving app if the payload is an AppleEvents type
                     if payload == 'AppleEvents':
-                        receiving_app = dict()
-                        receiving_app['path'] = app.get('receiving_app_path', False)
-                        receiving_app['path_override'] = app.get('receiving_app_path_override', False)
-                        receiving_app['codesign_result'] = self._get_code_sign_requirements(path=receiving_app['path'])
-                        receiving_app['app_name'] = self._app_name(app_obj=receiving_app['path'])
-                        app_identifier_type = self._get_identifier_and_type(app_path=receiving_app['path'], override_path=receiving_app['path_override'])
-                        receiving_app['identifier'] = app_identifier_type['identifier']
-                        receiving_app['identifier_type'] = app_identifier_type['identifier_type']
-                        comment = '{} {} to send {} control to {}'.format(allow_statement, sending_app['app_name'], payload, receiving_app['app_name'])
-                    else:
-                        receiving_app = False
-                        comment = '{} {} control for {}'.format(allow_statement, payload, sending_app['app_name'])
-
-                    # Pass the payload over to the _build_payload function
-                    payload_dict = self._build_payload(
-                        sending_app=sending_app,
-                        receiving_app=receiving_app,
-                        allowed=_allow,
-                        apple_event=True if payload == 'AppleEvents' else False,
-                        comment=comment,
-                    )
+                        app_identifier_type = self._get_identifier_and_type(app_path=app.receiver_path, override_path=app.receiver_override)
+                        entry.receiver_identifier = intern(app_identifier_type['identifier'])
+                        entry.receiver_identifier_type = app_identifier_type['identifier_type']
+                        entry.receiver_code_requirement = intern(self._get_code_sign_requirements(path=app.receiver_path))
+                        entry.receiver_app_name = intern(self._app_name(app_obj=app.receiver_path))
+
+                    # Add the assembled entry to the template
+                    key = seen_key(entry)
+                    if key not in seen:
+                        seen.add(key)
+                        entries.append(entry)
+
+    def make_deterministic(self):
+        """Puts the 'Services' entries in a canonical order and derives the UUIDs from the profile content, so an identical
+        profile is always written out byte for byte the same. Unchanged profiles are then not written or signed again."""
+        for entries in self.template['PayloadContent'][0]['Services'].values():
+            entries.sort(key=_canonical_entry_key)
+
+        # Hash the content without the UUIDs, as they are derived from the hash.
+        self._set_uuids(payload_uuid='', profile_uuid='')
+        self.content_hash = _content_hash(self.template)
+        self._set_uuids(
+            payload_uuid=str(uuid.uuid5(uuid.NAMESPACE_DNS, '{}.payload.{}'.format(self.payload_identifier, self.content_hash))).upper(),
+            profile_uuid=str(uuid.uuid5(uuid.NAMESPACE_DNS, '{}.{}'.format(self.payload_identifier, self.content_hash))).upper(),
+        )
+        self._deterministic = True
 
-                    # Add the assembled payload_dict to the template
-                    if payload_dict not in self.template['PayloadContent'][0]['Services'][payload]:
-                        self.template['PayloadContent'][0]['Services'][payload].append(payload_dict)
-
-    def _build_payload(self, sending_app, receiving_app, allowed, apple_event, comment):
-        """Builds an Accessibility payload for the profile."""
-        if isinstance(sending_app, dict) and isinstance(apple_event, bool) and isinstance(comment, str):
-            # Only return a basic dict, even though the Services needs a dict
-            # supplied, and the 'Accessibility' "payload" is a list of dicts.
-            result = {
-                'Allowed': allowed,
-                'CodeRequirement': sending_app['codesign_result'],
-                'Comment': comment,
-                'Identifier': sending_app['identifier'],
-                'IdentifierType': sending_app['identifier_type'],
-            }
-
-            # If the payload is an AppleEvent type, there are additional
-            # requirements relating to the receiving app.
-            if apple_event and isinstance(receiving_app, dict):
-                result['AEReceiverIdentifier'] = receiving_app['identifier']
-                result['AEReceiverIdentifierType'] = receiving_app['identifier_type']
-                result['AEReceiverCodeRequirement'] = receiving_app['codesign_result']
-
-            return result
+    def _set_uuids(self, payload_uuid, profile_uuid):
+        """Sets the UUIDs of the profile, and the payload identifier that includes the payload UUID."""
+        self.payload_uuid = payload_uuid
+        self.profile_uuid = profile_uuid
+        self.template['PayloadContent'][0]['PayloadIdentifier'] = '{}.{}'.format(self.payload_identifier, self.payload_uuid)
+        self.template['PayloadContent'][0]['PayloadUUID'] = self.payload_uuid
+        self.template['PayloadUUID'] = self.profile_uuid
 
+    @traced
     def write(self):
         """Handles writing the profile out to file, and will also create the configuration template if the relevant argument is provided."""
         # Write out the file if a filename is provided, otherwise dump to stdout
         if self._filename:
-            # Write the plist out to file
-            plistlib.writePlist(self.template, self._filename)
-
-            # Sign it if required
-            if self._sign_cert:
-                self._sign_profile(certificate_name=self._sign_cert, input_file=self._filename)
+            if not self._write_template(template=self.template, filename=self._filename):
+                print('{} is unchanged, skipping.'.format(self._filename))
+        else:
+            # Binary plists can't go through print, so write the plist data to stdout as is
+            sys.stdout.flush()
+            getattr(sys.stdout, 'buffer', sys.stdout).write(self.serialize())
+
+    def serialize(self):
+        """Returns the profile as XML or binary plist data."""
+        return _plist_dumps(_materialize(self.template), plist_format=self._plist_format)
+
+    def _write_template(self, template, filename, data=None):
+        """Writes a profile template (or its already serialized data) out to file, and signs it if required.
+        Returns False if the file was already up to date."""
+        if data is None:
+            data = _plist_dumps(_materialize(template), plist_format=self._plist_format)
+
+        # A deterministic profile with the same hash as the file on disk has not changed, so there is nothing to write or sign.
+        if self._deterministic and _file_digest(filename) == hashlib.sha256(data).hexdigest():
+            if not self._sign_cert or os.path.exists(self._signed_filename(filename)):
+                return False
         else:
-            # Print as formatted plist out to stdout
-            print(plistlib.writePlistToString(self.template).rstrip('\n'))
+            with open(filename, 'wb') as profile_file:
+                profile_file.write(data)
+
+        # Sign it if required
+        if self._sign_cert:
+            self._sign_profile(certificate_name=self._sign_cert, input_file=filename)
+
+        return True
+
+    def shard_templates(self, max_profile_bytes=None, max_entries=None):
+        """Splits the 'Services' of the profile over as few profiles as fit within max_profile_bytes and max_entries.
+
+        All entries for an identifier stay in the same profile. The serialized size of each entry is estimated once,
+        and identifiers are packed largest first into the first profile with room (first fit decreasing).
+        Sizes are estimated for XML, binary plists are always smaller than that.
+        Returns a list of (filename, template) tuples, which is just this profile if everything fits in one."""
+        services = self.template['PayloadContent'][0]['Services']
+        # Sized with the longest part number likely to be used, so the estimate errs on the large side.
+        header_size = _plist_xml_size(self._shard_template(number=999, count=999, services=dict()))
+        header_size += len(_plist_dumps(dict())) - _plist_xml_size(dict())  # The XML declaration and DOCTYPE
+        header_size += 10  # A non-empty 'Services' dict is written as <dict></dict> on two lines instead of <dict/>
+
+        # Group the entries by identifier, keeping the size of each group and the payload types it needs.
+        groups = dict()
+        for payload, entries in services.items():
+            for entry in entries:
+                group = groups.setdefault(entry.get('Identifier'), {'identifier': entry.get('Identifier'), 'entries': [], 'size': 0, 'payloads': set()})
+                group['entries'].append((payload, entry))
+                group['size'] += _plist_xml_size(_entry_dict(entry), depth=5)
+                group['payloads'].add(payload)
+
+        def _payload_size(payload):
+            """The size of the <key> and <array> wrapping the entries of a payload type."""
+            return 5 + 11 + _xml_text_size(payload) + 2 * 5 + 15
+
+        shards = []
+        for group in sorted(groups.values(), key=lambda group: (-group['size'], group['identifier'])):
+            for shard in shards:
+                size = shard['size'] + group['size'] + sum(_payload_size(payload) for payload in group['payloads'] - shard['payloads'])
+                if max_profile_bytes and size > max_profile_bytes:
+                    continue
+                if max_entries and shard['count'] + len(group['entries']) > max_entries:
+                    continue
+                break
+            else:
+                shard = {'groups': [], 'size': header_size, 'count': 0, 'payloads': set()}
+                shards.append(shard)
+                size = shard['size'] + group['size'] + sum(_payload_size(payload) for payload in group['payloads'])
+
+                if (max_profile_bytes and size > max_profile_bytes) or (max_entries and len(group['entries']) > max_entries):
+                    print('Entries for {} do not fit within the profile size limits, they will be written to their own profile.'.format(group['identifier']), file=sys.stderr)
+
+            shard['groups'].append(group)
+            shard['size'] = size
+            shard['count'] += len(group['entries'])
+            shard['payloads'].update(group['payloads'])
+
+        if len(shards) <= 1:
+            return [(self._filename, self.template)]
+
+        # Keep the original entry order within each payload type.
+        position = dict((id(entry), index) for entries in services.values() for index, entry in enumerate(entries))
+
+        results = []
+        for number, shard in enumerate(shards, start=1):
+            shard_services = dict()
+            for group in shard['groups']:
+                for payload, entry in group['entries']:
+                    shard_services.setdefault(payload, []).append(entry)
+
+            for entries in shard_services.values():
+                entries.sort(key=lambda entry: position[id(entry)])
+
+            template = self._shard_template(number=number, count=len(shards), services=shard_services)
+            filename = '{}_Part{}.mobileconfig'.format(os.path.splitext(self._filename)[0], number) if self._filename else None
+            results.append((filename, template))
+
+        return results
+
+    def _shard_template(self, number, count, services):
+        """Returns a copy of the profile template for part number of count, holding services."""
+        # Identifiers and UUIDs are derived from the part number, so regenerating the parts replaces the same profiles.
+        shard_identifier = '{}.part{}'.format(self.payload_identifier, number)
+        profile_uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS, shard_identifier)).upper()
+        payload_uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS, '{}.payload'.format(shard_identifier))).upper()
+        display_name = '{} (Part {} of {})'.format(self.payload_name, number, count)
+
+        template = dict(self.template)
+        template['PayloadContent'] = [dict(self.template['PayloadContent'][0])]
+        template['PayloadContent'][0]['Services'] = services
+        template['PayloadContent'][0]['PayloadDisplayName'] = display_name
+        template['PayloadContent'][0]['PayloadIdentifier'] = '{}.{}'.format(shard_identifier, payload_uuid)
+        template['PayloadContent'][0]['PayloadUUID'] = payload_uuid
+        template['PayloadDisplayName'] = display_name
+        template['PayloadIdentifier'] = shard_identifier
+        template['PayloadUUID'] = profile_uuid
+
+        return template
+
+    @traced
+    def write_shards(self, max_profile_bytes=None, max_entries=None):
+        """Writes the profile out as one or more profiles that fit within the size limits, writing (and signing) them in parallel."""
+        shards = self.shard_templates(max_profile_bytes=max_profile_bytes, max_entries=max_entries)
+
+        if len(shards) == 1:
+            self.write()
+        elif not self._filename:
+            raise ProfileBuildError('invalid_arguments', 'The profile needs {} parts to fit the size limits, an output filename is required.'.format(len(shards)))
+        else:
+            pool = ThreadPool(min(len(shards), multiprocessing.cpu_count()))
+            try:
+                written = pool.map(lambda shard: self._write_template(template=shard[1], filename=shard[0]), shards)
+            finally:
+                pool.close()
+                pool.join()
+
+            for (filename, template), was_written in zip(shards, written):
+                if was_written:
+                    print('Wrote {} ({} entries)'.format(filename, sum(len(entries) for entries in template['PayloadContent'][0]['Services'].values())))
+                else:
+                    print('{} is unchanged, skipping.'.format(filename))
 
     @staticmethod
     def _set_timezone(timezone):
@@ -832,101 +2050,131 @@ class PrivacyProfiles(object):
         else:
             return None
 
-    @staticmethod
-    def _get_file_mime_type(path):
-        """Returns the mimetype of a given file."""
-        if os.path.exists(path.rstrip('/')):
-            cmd = ['/usr/bin/file', '--mime-type', path]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            result, error = process.communicate()
-
-            if process.returncode is 0:
-                # Only need the mime type, so return the last bit
-                result = result.replace(' ', '').replace('\n', '').split(':')[1].split('/')[1]
-                return result
-
-    @staticmethod
-    def _read_shebang(app_path):
-        """Returns the contents of the shebang in a script file, as long as env is not in the shebang."""
-        with open(app_path, 'r') as textfile:
-            line = textfile.readline().rstrip('\n')
-            if line.startswith('#!') and 'env ' not in line:
-                return line.replace('#!', '')
-            elif line.startswith('#!') and 'env ' in line:
-                raise Exception('Cannot check codesign for shebangs that refer to \'env\'.')
-
     def _get_code_sign_requirements(self, path):
-        """Returns the values for the CodeRequirement key."""
-        def _is_code_signed(path):
-            """Returns True/False if specified path is code signed or not."""
-            cmd = ['/usr/bin/codesign', '-dr', '-', path]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            result, error = process.communicate()
-
-            if process.returncode is 0:
-                return True
-            elif process.returncode is 1 and 'not signed' in error:
-                return False
+        """Returns the values for the CodeRequirement key. With generic requirements, requirements of Developer ID and
+        development signatures are rewritten to only pin the identifier, team and kind of certificate."""
+        requirement = self._prober.code_sign_requirement(path)
+        if self._generic_requirements and requirement:
+            requirement = generic_requirement(requirement, self._prober.signing_info(path).get('Authority'), self._prober.team_identifier(path))
 
-        # Make sure the path exists and is readable.
-        if os.path.exists(path.rstrip('/')) and self._is_accessible(path.rstrip('/')):
-            # Handle situations where path is a script, and shebang is
-            # ['/bin/sh', '/bin/bash', '/usr/bin/python']
-            mimetype = self._get_file_mime_type(path=path)
+        return requirement
 
-            if mimetype in ['x-python', 'x-shellscript']:
-                if not _is_code_signed(path):  # Only use shebang path if a script is not code signed
-                    path = self._read_shebang(app_path=path)
+    def _get_identifier_and_type(self, app_path, override_path=False):
+        """Checks file type, and returns appropriate values for `Identifier`and `IdentifierType` keys in the final profile payload."""
+        return self._prober.identifier_and_type(app_path, override_path=override_path)
 
-            cmd = ['/usr/bin/codesign', '-dr', '-', path]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            result, error = process.communicate()
+    @traced
+    def _sign_profile(self, certificate_name, input_file):
+        """Signs the profile."""
+        if self._sign_cert and os.path.exists(input_file) and input_file.endswith('.mobileconfig'):
+            cmd = ['/usr/bin/security', 'cms', '-S', '-N', certificate_name, '-i', input_file, '-o', self._signed_filename(input_file)]
+            with TRACE.span('security', category='probe', path=input_file) as span:
+                span.set(exit_code=subprocess.call(cmd))
 
-            if process.returncode is 0:
-                # For some reason, part of the output gets dumped to stderr, but the bit we need goes to stdout
-                # Also, there can be multiple lines in the result, so handle this properly
-                # There are circumstances where the codesign 'designated => ' is not the start of the line, so handle these.
-                result = result.rstrip('\n').splitlines()
-                result = [line for line in result if 'designated => ' in line][0]
-                result = result.partition('designated => ')
-                result = result[result.index('designated => ') + 1:][0]
-                # result = [x.rstrip('\n') for x in result.splitlines() if x.startswith('designated => ')][0]
-                return result
-            elif process.returncode is 1 and 'not signed' in error:
-                print('App at {} is not signed. Exiting.'.format(path))
-                sys.exit(1)
-        else:
-            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    @staticmethod
+    def _signed_filename(filename):
+        """Returns the filename a signed copy of the profile is written to."""
+        return filename.replace('.mobileconfig', '_Signed.mobileconfig')
 
-    def _get_identifier_and_type(self, app_path, override_path=False):
-        """Checks file type, and returns appropriate values for `Identifier`and `IdentifierType` keys in the final profile payload."""
-        # Only change the app_path to the override path if '.app' is not the file extension, because app's should have CFBundleIdentifier payload
-        # in the App/Contents/Info.plist file
-        if override_path and os.path.splitext(override_path)[1] != '.app' and os.path.splitext(app_path)[1] != '.app':
-            app_path = override_path.rstrip('/') if override_path else app_path.rstrip('/')
 
-        # Determine mimetype
-        mimetype = self._get_file_mime_type(path=app_path)
+class ProfileRequest(object):
+    """Everything needed to build a profile with build(), without going through the command line.
 
-        # Check for mimetype of file
-        if mimetype in ['x-shellscript', 'x-python']:
-            identifier = app_path
-            identifier_type = 'path'
-        else:
-            try:
-                identifier = read_plist(os.path.join(app_path.rstrip('/'), 'Contents/Info.plist'))['CFBundleIdentifier']
-                identifier_type = 'bundleID'
-            except Exception:
-                identifier = app_path
-                identifier_type = 'path'
+    app_lists maps payload types (see PrivacyProfiles.PAYLOADS) to lists of app paths, written the same way as on the
+    command line: '/path/to/App.app', '/path/to/App.app:/override/path/App.app', and 'sender,receiver' for AppleEvents.
+    removal_date is a 'YYYY-mm-dd HH:MM' string in the timezone of the target Mac, for example 'Australia/Brisbane'.
+    If filename is set the profile is also written (and signed with sign_cert) to that file."""
+    __slots__ = (
+        'payload_description', 'payload_name', 'payload_identifier', 'payload_organization', 'app_lists', 'allow',
+        'removal_password', 'removal_date', 'timezone', 'sign_cert', 'filename', 'plist_format', 'deterministic',
+    )
 
-        return {'identifier': identifier, 'identifier_type': identifier_type}
+    def __init__(self, payload_description, payload_name, payload_identifier, payload_organization, app_lists,
+                 allow=False, removal_password=None, removal_date=None, timezone=None, sign_cert=None, filename=None,
+                 plist_format='xml', deterministic=False):
+        self.payload_description = payload_description
+        self.payload_name = payload_name
+        self.payload_identifier = payload_identifier
+        self.payload_organization = payload_organization
+        self.app_lists = app_lists
+        self.allow = allow
+        self.removal_password = removal_password
+        self.removal_date = removal_date
+        self.timezone = timezone
+        self.sign_cert = sign_cert
+        self.filename = filename
+        self.plist_format = plist_format
+        self.deterministic = deterministic
+
+
+class ProfileResult(object):
+    """What build() returns: the profile as a dict (template) and as plist data, or the errors that stopped it. written is
+    False if the request had a filename and a deterministic build found the file on disk already up to date."""
+    __slots__ = ('template', 'data', 'errors', 'written')
+
+    def __init__(self, template=None, data=None, errors=None, written=False):
+        self.template = template
+        self.data = data
+        self.errors = errors or []
+        self.written = written
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def build(request, prober=None):
+    """Builds the profile described by a ProfileRequest in-process, without printing or exiting. Returns a ProfileResult,
+    with any error that stopped the build (including a failure to write the file) as a ProfileBuildError.
+
+    Pass the same Prober to every call to reuse what has already been probed, so each app is only probed once."""
+    unknown_payloads = [payload for payload in request.app_lists if payload not in PrivacyProfiles.PAYLOADS]
+    if unknown_payloads:
+        return ProfileResult(errors=[ProfileBuildError('unknown_payload', 'Unknown payload type: {}'.format(', '.join(sorted(unknown_payloads))))])
+
+    def _listed(value):
+        """PrivacyProfiles takes the single value arguments the way argparse hands them over, as a list."""
+        return [value] if value else None
+
+    try:
+        tcc_profile = PrivacyProfiles(
+            payload_description=request.payload_description,
+            payload_name=request.payload_name,
+            payload_identifier=request.payload_identifier,
+            payload_organization=request.payload_organization,
+            profile_removal_password=_listed(request.removal_password),
+            sign_cert=_listed(request.sign_cert),
+            filename=request.filename,
+            removal_date=_listed(request.removal_date),
+            timezone=_listed(request.timezone),
+            plist_format=request.plist_format,
+            prober=prober,
+        )
+        tcc_profile.set_services_dict(dict((payload, {'_apps': list(apps), 'apps': list()}) for payload, apps in request.app_lists.items()))
+        tcc_profile.build_profile(allow=request.allow)
+
+        if request.deterministic:
+            tcc_profile.make_deterministic()
+
+        data = tcc_profile.serialize()
+    except ProfileBuildError as e:
+        return ProfileResult(errors=[e])
+    except PrivacyProfilesException as e:
+        return ProfileResult(errors=[ProfileBuildError('invalid_profile', str(e))])
+    except EnvironmentError as e:
+        return ProfileResult(errors=[ProfileBuildError('probe_failed', str(e), path=getattr(e, 'filename', None))])
+
+    written = False
+    if tcc_profile._filename:
+        try:
+            written = tcc_profile._write_template(template=tcc_profile.template, filename=tcc_profile._filename, data=data)
+        except ProfileBuildError as e:
+            return ProfileResult(errors=[e])
+        except EnvironmentError as e:
+            return ProfileResult(errors=[ProfileBuildError('write_failed', 'Could not write {}: {}'.format(
+                tcc_profile._filename, e.strerror or e), path=tcc_profile._filename)])
 
-    def _sign_profile(self, certificate_name, input_file):
-        """Signs the profile."""
-        if self._sign_cert and os.path.exists(input_file) and input_file.endswith('.mobileconfig'):
-            cmd = ['/usr/bin/security', 'cms', '-S', '-N', certificate_name, '-i', input_file, '-o', '{}'.format(input_file.replace('.mobileconfig', '_Signed.mobileconfig'))]
-            subprocess.call(cmd)
+    return ProfileResult(template=_materialize(tcc_profile.template), data=data, written=written)
 
 
 class SaneUsageFormat(argparse.HelpFormatter):
@@ -1178,6 +2426,29 @@ def parse_args():
         required=False,
     )
 
+    parser.add_argument(
+        '--ae-senders',
+        type=str,
+        nargs='+',
+        dest='events_senders_apps_list',
+        metavar='<app paths>',
+        help='Generate AppleEvents entries for every pair of these apps and '
+             'the --ae-receivers apps, so each sender can send AppleEvents to '
+             'each receiver. Globs such as "/Applications/*.app" are expanded.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--ae-receivers',
+        type=str,
+        nargs='+',
+        dest='events_receivers_apps_list',
+        metavar='<app paths>',
+        help='The apps the --ae-senders apps send AppleEvents to. Globs are '
+             'expanded.',
+        required=False,
+    )
+
     parser.add_argument(
         '--sf', '--sysadminfiles',
         type=str,
@@ -1209,6 +2480,48 @@ def parse_args():
         required=False,
     )
 
+    parser.add_argument(
+        '--format',
+        type=str,
+        choices=PLIST_FORMATS,
+        default='xml',
+        dest='plist_format',
+        help='Write the profile as an XML or binary plist. Binary profiles '
+             'are smaller and faster to parse. Default: xml',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--deterministic',
+        action='store_true',
+        dest='deterministic',
+        default=False,
+        help='Order the entries and derive the UUIDs from the profile content, '
+             'so the same input always writes the same profile. A profile '
+             'that is unchanged on disk is not written or signed again.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--max-profile-bytes',
+        type=int,
+        dest='max_profile_bytes',
+        metavar='<bytes>',
+        help='Split the profile into as few profiles as needed so that each '
+             'one is at most this many bytes. Requires --output.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--max-entries',
+        type=int,
+        dest='max_entries',
+        metavar='<count>',
+        help='Split the profile into as few profiles as needed so that each '
+             'one has at most this many entries. Requires --output.',
+        required=False,
+    )
+
     parser.add_argument(
         '--pd', '--payload-description',
         type=str,
@@ -1291,6 +2604,213 @@ def parse_args():
         required=False,
     )
 
+    parser.add_argument(
+        '--facts',
+        type=str,
+        dest='facts',
+        metavar='<snapshot.json>',
+        help='Build the profile from a facts snapshot made with the '
+             'collect-facts command instead of probing the apps. This does '
+             'not need a Mac or the apps to be installed.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--shebang-path',
+        type=str,
+        dest='shebang_path',
+        metavar='<PATH>',
+        help='The PATH used to find the interpreter of unsigned scripts with '
+             'a "#!/usr/bin/env python" style shebang. Defaults to the PATH '
+             'tccprofile.py runs with.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--probe-timeout',
+        type=float,
+        dest='probe_timeout',
+        metavar='<seconds>',
+        help='Probe apps on network shares and removable volumes separately, '
+             'giving up on each after this many seconds (and retrying). Apps '
+             'that still can not be probed are left out of the profile and '
+             'reported, instead of a dead share holding up the build.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--probe-retries',
+        type=int,
+        dest='probe_retries',
+        metavar='<count>',
+        default=2,
+        help='How often to retry probing an app on a network share or '
+             'removable volume that timed out, or a unit of apps a probe '
+             'worker failed on. Default: 2',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--probe-workers',
+        type=str,
+        nargs='+',
+        dest='probe_workers',
+        metavar='<host:port>',
+        help='Probe the apps on these probe workers (see the probe-worker '
+             'command), for example on the hosts the apps are staged on. The '
+             'apps must be at the same paths on every worker host.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--local-probe-workers',
+        type=int,
+        dest='local_probe_workers',
+        metavar='<count>',
+        help='Start this many probe worker processes on this machine and '
+             'probe the apps on them (and on any --probe-workers).',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--bundle-index',
+        type=str,
+        dest='bundle_index',
+        metavar='<index.json>',
+        help='The bundle index that "bundle:com.example.App" app references '
+             'are resolved with, see the bundle-index command. Default: '
+             '~/Library/Caches/tccprofile/bundles.json',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--include-nested',
+        action='store_true',
+        dest='include_nested',
+        default=False,
+        help='Also add entries for the code nested in app bundles: helpers, '
+             'login items, XPC services and the helpers of embedded '
+             'frameworks, each with its own identifier and requirement.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        dest='verify',
+        default=False,
+        help='Check that the code on disk satisfies every code requirement '
+             'in the profile before writing it, and fail if it does not. '
+             'Results are cached, see the verify command.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--generic-requirements',
+        action='store_true',
+        dest='generic_requirements',
+        default=False,
+        help='Use code requirements that stay the same when apps are updated: '
+             'the identifier, team and kind of signing certificate rather '
+             'than the complete designated requirement. Only Developer ID and '
+             'development signatures are changed.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--rules',
+        type=str,
+        dest='rules',
+        metavar='<rules file>',
+        help='Build the profile from policy rules, such as "SystemPolicyAllFiles '
+             'bundle:com.adobe.*" or "Accessibility team:ABC123DEF4", matched '
+             'against the apps in the --inventory.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--inventory',
+        type=str,
+        dest='inventory',
+        metavar='<inventory file>',
+        help='The apps --rules are matched against: a bundle index (see the '
+             'bundle-index command) or a file with one app path per line. '
+             'Default: the bundle index, refreshed.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--input',
+        type=str,
+        dest='input',
+        metavar='<file or ->',
+        help='Read the apps from newline delimited JSON records instead of '
+             'the payload arguments, one {"service": "Accessibility", '
+             '"path": "/Applications/App.app"} object per line, with '
+             'optional "override", and "receiver" and "receiver_override" '
+             'for AppleEvents. Use - to read from stdin. Apps are probed as '
+             'the records arrive.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--stamp',
+        type=str,
+        dest='stamp',
+        metavar='<inventory file>',
+        help='Write a variant of the profile for each row of a CSV or NDJSON '
+             'inventory, with the payload_identifier, payload_org, '
+             'removal_password, removal_date, timezone and filename columns '
+             'in place of the command line values. The apps are only probed '
+             'once for all the variants.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        dest='watch',
+        default=False,
+        help='Keep running after writing the profile, and rebuild it '
+             'whenever one of the apps (or the --facts snapshot) changes. '
+             'Only the changed apps are probed again, and only profiles '
+             'whose content changed are written and signed again. Implies '
+             '--deterministic and needs an output filename.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--watch-interval',
+        type=float,
+        dest='watch_interval',
+        metavar='<seconds>',
+        default=2.0,
+        help='How often to check the apps for changes when inotify is not '
+             'available (anywhere but Linux). Default: 2',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--trace',
+        type=str,
+        dest='trace',
+        metavar='<trace.json>',
+        help='Record how long each probe (file, codesign, read_plist, '
+             'security) and build stage takes, and save it in the Chrome '
+             'trace event format. Open it in chrome://tracing or Perfetto.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--cprofile',
+        type=str,
+        dest='cprofile',
+        metavar='<stats file>',
+        help='Profile the whole run with cProfile and save the stats for use '
+             'with pstats or snakeviz.',
+        required=False,
+    )
+
     parser.add_argument(
         '-v', '--version',
         action='version',
@@ -1311,6 +2831,10 @@ def parse_args():
 
 
 def launch_gui(args=None):
+    if not (tk and AppKit):
+        print('The GUI needs Tk and PyObjC (AppKit), use the command line arguments instead. See --help.')
+        sys.exit(1)
+
     info = AppKit.NSBundle.mainBundle().infoDictionary()
     info['LSUIElement'] = True
 
@@ -1320,16 +2844,105 @@ def launch_gui(args=None):
     app.mainloop()
 
 
+# Commands that are implemented in their own module, only imported when used.
+# For example: ./tccprofile.py merge --help
+COMMANDS = {
+    'bundle-index': 'bundle_index',
+    'collect-facts': 'probe_facts',
+    'compare': 'profile_compare',
+    'diff': 'profile_diff',
+    'index': 'profile_index',
+    'merge': 'profile_merge',
+    'probe-worker': 'probe_farm',
+    'verify': 'profile_verify',
+}
+
+
+def run_command(command, argv):
+    """Runs the main() of a command module with the remaining arguments, returns its exit status."""
+    return importlib.import_module(COMMANDS[command]).main(argv)
+
+
 def main():
     if len(sys.argv) == 1:
         launch_gui()
         sys.exit(0)
+    elif sys.argv[1] in COMMANDS:
+        sys.exit(run_command(sys.argv[1], sys.argv[2:]))
     else:
         args = parse_args()
 
         # if args.launch_gui:
         #     launch_gui(args)
 
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler:
+        profiler.enable()
+    TRACE.enabled = bool(args.trace)
+
+    if args.watch and not args.payload_filename:
+        print('--watch needs an output filename (-o).')
+        sys.exit(1)
+
+    if args.watch and args.input == '-':
+        print('--watch needs an --input file, stdin can only be read once.')
+        sys.exit(1)
+
+    if args.input and any(value for dest, value in vars(args).items() if dest.endswith('_apps_list')):
+        print('--input can not be used with the payload arguments, put all the apps in the input.')
+        sys.exit(1)
+
+    if args.rules and (args.input or any(value for dest, value in vars(args).items() if dest.endswith('_apps_list'))):
+        print('--rules can not be used with --input or the payload arguments.')
+        sys.exit(1)
+
+    if args.generic_requirements and generic_requirement is None:
+        print('--generic-requirements needs code_requirement.py next to tccprofile.py.')
+        sys.exit(1)
+
+    if (args.probe_workers or args.local_probe_workers) and (args.facts or args.probe_timeout):
+        print('--probe-workers and --local-probe-workers can not be used with --facts or --probe-timeout.')
+        sys.exit(1)
+
+    if args.verify and args.facts:
+        print('--verify can not be used with --facts, it checks the apps on this machine.')
+        sys.exit(1)
+
+    if args.inventory and not args.rules:
+        print('--inventory is only used with --rules.')
+        sys.exit(1)
+
+    if bool(args.events_senders_apps_list) != bool(args.events_receivers_apps_list):
+        print('--ae-senders and --ae-receivers must be used together.')
+        sys.exit(1)
+
+    if args.stamp and (args.max_profile_bytes or args.max_entries):
+        print('--stamp can not be used with --max-profile-bytes or --max-entries.')
+        sys.exit(1)
+
+    try:
+        tcc_profile = run(args)
+        if args.watch:
+            watch(args, tcc_profile)
+        elif tcc_profile.skipped_apps:
+            sys.exit(1)
+    except ProfileBuildError as e:
+        print(e.message)
+        sys.exit(1)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.trace:
+            TRACE.dump(args.trace)
+
+
+def run(args, prober=None):
+    """Builds and writes the profile described by the command line arguments, returns the PrivacyProfiles it built.
+    Probe results already in prober are reused."""
+    if prober is None:
+        prober = FactsProber(read_facts(args.facts)) if args.facts else Prober(search_path=args.shebang_path)
+
     tcc_profile = PrivacyProfiles(
         payload_description=args.payload_description,
         payload_name=args.payload_name,
@@ -1340,16 +2953,114 @@ def main():
         filename=args.payload_filename,
         removal_date=args.profile_removal_date,
         timezone=args.timezone,
+        plist_format=args.plist_format,
+        prober=prober,
+        bundle_index=args.bundle_index,
+        generic_requirements=args.generic_requirements,
     )
 
     # Insert the service dict into the template
-    tcc_profile.set_services_dict(args)
+    if args.input:
+        import profile_input
+        tcc_profile.set_services_dict(profile_input.read_input(args.input, prober, resolve=tcc_profile._resolve_bundles))
+    elif args.rules:
+        import policy_rules
+        rules = policy_rules.RuleSet.read(args.rules)
+        app_lists, unmatched = rules.evaluate(policy_rules.read_inventory(args.inventory, prober), prober)
+        if unmatched:
+            print('{} of {} rules matched no apps.'.format(unmatched, len(rules.rules)), file=sys.stderr)
+        if not app_lists:
+            raise ProfileBuildError('no_payloads', 'None of the rules in {} matched an app.'.format(args.rules))
+        tcc_profile.set_services_dict(app_lists)
+    else:
+        tcc_profile.set_services_dict(args)
+
+    left_out = []
+    if args.probe_workers or args.local_probe_workers:
+        import probe_farm
+        # The workers find the nested code too, and only apps the prober doesn't know yet are sent to them.
+        left_out = probe_farm.probe_apps(tcc_profile, addresses=[probe_farm.parse_address(address) for address in args.probe_workers or []],
+                                         local_workers=args.local_probe_workers, search_path=args.shebang_path,
+                                         retries=args.probe_retries, include_nested=args.include_nested)
+    elif args.include_nested:
+        import probe_nested
+        left_out = probe_nested.add_nested(tcc_profile)
+
+    for path, problem in left_out:
+        print('Left out nested code {}: {}'.format(path, problem), file=sys.stderr)
+
+    if args.probe_timeout:
+        import probe_volumes
+        tcc_profile.skipped_apps = probe_volumes.probe_apps(tcc_profile, timeout=args.probe_timeout, retries=args.probe_retries)
 
     # Iterate over the payloads dict to build payloads
     tcc_profile.build_profile(allow=args.allow_app)
 
-    tcc_profile.write()
+    if args.verify:
+        import profile_verify
+        profile_verify.verify_profile(tcc_profile)
+
+    if args.deterministic or args.watch:
+        tcc_profile.make_deterministic()
+
+    if args.stamp:
+        import profile_stamp
+        profile_stamp.stamp_profiles(tcc_profile, profile_stamp.read_inventory(args.stamp))
+    elif args.max_profile_bytes or args.max_entries:
+        tcc_profile.write_shards(max_profile_bytes=args.max_profile_bytes, max_entries=args.max_entries)
+    else:
+        tcc_profile.write()
+
+    if tcc_profile.skipped_apps:
+        # The profile was written without them, report them but let --watch carry on (main() exits 1 otherwise).
+        print('Left out {} apps that could not be probed:\n{}'.format(len(tcc_profile.skipped_apps), '\n'.join(
+            '  {} ({} volume): {}'.format(path, kind, problem) for path, kind, problem in tcc_profile.skipped_apps)), file=sys.stderr)
+
+    return tcc_profile
+
+
+def watch(args, tcc_profile):
+    """Rebuilds the profile each time one of its apps (or the facts snapshot or inventory) changes, until interrupted."""
+    import profile_watch
+
+    state = {'prober': tcc_profile._prober}
+
+    def rebuild(changed):
+        prober = state['prober']
+        if args.facts and args.facts in changed:
+            prober = None  # A new snapshot replaces all the facts
+        else:
+            for path in changed:
+                prober.forget(path)
+
+        try:
+            tcc_profile = run(args, prober=prober)
+        except PrivacyProfilesException as e:
+            # Keep watching, the next change may well fix it.
+            print(getattr(e, 'message', str(e)))
+            return []
+
+        state['prober'] = tcc_profile._prober
+        return watched_paths(tcc_profile)
+
+    def watched_paths(tcc_profile):
+        # Profiles built from a snapshot only change with the snapshot, the apps may not even be on this machine.
+        paths = set([args.facts]) if args.facts else tcc_profile.app_paths()
+        if args.stamp:
+            paths.add(args.stamp)
+        if args.input:
+            paths.add(args.input)
+        if args.rules:
+            paths.add(args.rules)
+            if args.inventory:
+                paths.add(args.inventory)
+        return paths
+
+    paths = watched_paths(tcc_profile)
+    profile_watch.watch(paths, rebuild, interval=args.watch_interval)
 
 
 if __name__ == '__main__':
+    # Command modules import tccprofile, let them use this module instead of loading a second copy of it.
+    sys.modules.setdefault('tccprofile', sys.modules[__name__])
     main()